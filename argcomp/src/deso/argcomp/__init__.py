@@ -21,5 +21,12 @@
 
 
 from deso.argcomp.parser import (
+  CandidateIndex,
+  COMPLETE_OPTION,
   CompletingArgumentParser,
 )
+from deso.argcomp.shell import (
+  exportSpec,
+  generateBash,
+  generateZsh,
+)
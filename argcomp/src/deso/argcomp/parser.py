@@ -25,6 +25,9 @@ from argparse import (
   REMAINDER,
   SUPPRESS,
 )
+from bisect import (
+  bisect_left,
+)
 from collections import (
   namedtuple,
 )
@@ -36,14 +39,35 @@ from functools import (
 )
 from itertools import (
   chain,
+  islice,
+)
+from os import (
+  chdir,
+  read,
+  write,
+)
+from select import (
+  select,
 )
 from sys import (
   argv,
   maxsize,
+  stdin,
+  stdout,
+)
+from traceback import (
+  print_exc,
 )
 
 
 COMPLETE_OPTION = "--_complete"
+COMPLETE_SCRIPT_OPTION = "--_complete-script"
+COMPLETE_SERVER_OPTION = "--_complete-server"
+# The default number of seconds a completion server waits for a request
+# before terminating.
+SERVER_TIMEOUT = 300
+# The shells for which we can generate completion scripts.
+SHELLS = ("bash", "zsh")
 
 
 class ParserError(BaseException):
@@ -56,6 +80,53 @@ def noCompletion(parser, values, word):
   return tuple()
 
 
+class CandidateIndex:
+  """A sorted set of completion candidates supporting fast prefix lookups."""
+  def __init__(self, candidates=()):
+    """Create an index from an iterable of candidates."""
+    # Candidates that are non-strings are allowed. For instance, integers
+    # are valid choices and understood by the ArgumentParser. At the end
+    # of the day, however, everything we emit is a string, so work with
+    # strings here.
+    self._candidates = sorted(set(map(str, candidates)))
+
+
+  def __iter__(self):
+    """Iterate over all candidates in sorted order."""
+    return iter(self._candidates)
+
+
+  def __len__(self):
+    """Retrieve the number of candidates."""
+    return len(self._candidates)
+
+
+  def add(self, candidate):
+    """Add a candidate to the index, if it is not contained already."""
+    candidate = str(candidate)
+    candidates = self._candidates
+    i = bisect_left(candidates, candidate)
+    if i == len(candidates) or candidates[i] != candidate:
+      candidates.insert(i, candidate)
+
+
+  def match(self, prefix):
+    """Yield all candidates starting with the given prefix, in sorted order."""
+    # All candidates sharing the prefix form a contiguous range in the
+    # sorted list, starting at the prefix' insertion point.
+    candidates = self._candidates
+    for i in range(bisect_left(candidates, prefix), len(candidates)):
+      if not candidates[i].startswith(prefix):
+        break
+
+      yield candidates[i]
+
+
+def completeChoice(parser, values, word, choices):
+  """Attempt completion of a word from the given choices (a CandidateIndex)."""
+  yield from choices.match(word)
+
+
 class Argument(namedtuple("Argument", ["min_", "max_", "comp"])):
   """A tuple describing arguments."""
   def __new__(cls, min_=0, max_=0, comp=noCompletion):
@@ -68,8 +139,13 @@ class Argument(namedtuple("Argument", ["min_", "max_", "comp"])):
     return Argument(self.min_ - 1, self.max_ - 1, self.comp)
 
 
-class Arguments(namedtuple("Arguments", ["positionals", "keywords"])):
-  """A tuple describing possible program options."""
+class Arguments(namedtuple("Arguments", ["positionals", "keywords", "index"])):
+  """A tuple describing possible program options.
+
+    The 'index' member is a CandidateIndex of all keywords. Keywords
+    should be added by means of the addKeyword method, which keeps it
+    up-to-date.
+  """
   def __new__(cls, positionals=None, keywords=None):
     """Overwrite class creation to provide proper default arguments."""
     if positionals is None:
@@ -77,7 +153,18 @@ class Arguments(namedtuple("Arguments", ["positionals", "keywords"])):
     if keywords is None:
       keywords = {}
 
-    return super().__new__(cls, positionals, keywords)
+    return super().__new__(cls, positionals, keywords, CandidateIndex(keywords))
+
+
+  def addKeyword(self, keyword, value):
+    """Add or replace a keyword, with the value being an Argument or Arguments object."""
+    self.keywords[keyword] = value
+    self.index.add(keyword)
+
+
+  def matchKeywords(self, prefix):
+    """Yield all keywords starting with the given prefix."""
+    return self.index.match(prefix)
 
 
 def escapeDoubleDash(args, index=0):
@@ -153,9 +240,7 @@ def complete(parser, values, arguments, words):
   # If there are open keyword-level positional arguments then we
   # should not start completion of keyword arguments.
   if key.min_ <= 0:
-    for word in arguments.keywords:
-      if word.startswith(to_complete):
-        yield word
+    yield from arguments.matchKeywords(to_complete)
 
 
 def decodeNargs(nargs):
@@ -231,6 +316,77 @@ def sandbox(parser):
     parser.exit = exit_
 
 
+def completeWords(parser, index, words):
+  """Complete the word at the given index in a list of words, yielding the completions."""
+  # We do not want clients invoking a parser and causing a failure to
+  # unconditionally exit the program and printing an error or the usage
+  # of the program, so we replace the methods causing trouble with
+  # benign ones temporarily.
+  with sandbox(parser):
+    completions = complete(parser, words, parser.arguments, words[:index])
+    yield from islice(completions, parser.completion_limit)
+
+
+def readLines(fd, timeout):
+  """Read lines from a file descriptor until end-of-file or until no data arrives for 'timeout' seconds."""
+  buffer = b""
+  while True:
+    while b"\n" in buffer:
+      line, buffer = buffer.split(b"\n", 1)
+      yield line.decode()
+
+    readable, _, _ = select([fd], [], [], timeout)
+    if not readable:
+      break
+
+    data = read(fd, 4096)
+    if not data:
+      break
+
+    buffer += data
+
+
+def answerRequest(parser, request):
+  """Answer a completion request."""
+  # A request is a single line comprised of tab separated fields: the
+  # working directory, the word index ($COMP_CWORD), and the words as
+  # parsed by the shell ($COMP_WORDS[@]).
+  try:
+    cwd, index, script, *words = request.split("\t")
+    index = int(index)
+    chdir(cwd)
+  except (OSError, ValueError):
+    # A malformed request or one for a directory that vanished has no
+    # completions.
+    return "0\n"
+
+  try:
+    completions = list(map(str, completeWords(parser, index, words)))
+  except ParserError:
+    # The parser rejected the words, meaning there is nothing to
+    # complete.
+    completions = []
+  except Exception:
+    # Completers may run arbitrary code. Whereas an error in there just
+    # terminates the program when completing a single request, a server
+    # has to stay alive for subsequent ones. So we catch everything but
+    # still report the error.
+    print_exc()
+    completions = []
+
+  # The response consists of the number of completions followed by the
+  # completions themselves, each on a separate line.
+  return "\n".join([str(len(completions))] + completions) + "\n"
+
+
+def serveCompletions(parser, fd_in, fd_out, timeout=SERVER_TIMEOUT):
+  """Answer completion requests read from a file descriptor until it is closed or idle for 'timeout' seconds."""
+  for request in readLines(fd_in, timeout):
+    data = answerRequest(parser, request).encode()
+    while data:
+      data = data[write(fd_out, data):]
+
+
 class CompleteAction(Action):
   """An action used for completing command line arguments."""
   def __call__(self, parser, namespace, values, option_string=None):
@@ -250,28 +406,55 @@ class CompleteAction(Action):
     # The approach we take here is to print all completions (separated
     # by a new line symbol) and then exit. The latter step is rather
     # clumsy but then no better solution that requires no additional
-    # work on the client side was found.
+    # work on the client side was found. Note that completions are
+    # printed as they are produced, so that we never have to keep all
+    # of them in memory.
+    count = 0
     try:
-      # We do not want clients invoking a parser and causing a failure
-      # to unconditionally exit the program and printing an error or the
-      # usage of the program, so we replace the methods causing trouble
-      # with benign ones temporarily.
-      with sandbox(parser):
-        completions = list(complete(parser, words, parser.arguments, words[:index]))
+      for completion in completeWords(parser, index, words):
+        print(completion)
+        count += 1
     except ParserError:
       parser.exit(1)
 
-    if len(completions) > 0:
-      print("\n".join(map(str, completions)))
+    parser.exit(0 if count > 0 else 1)
+
+
+class CompleteServerAction(Action):
+  """An action used for answering completion requests read from stdin."""
+  def __call__(self, parser, namespace, values, option_string=None):
+    """Invoke the action to serve completion requests until being idle for too long."""
+    # Starting up the program for every completion request is costly.
+    # In server mode we stay alive and answer an arbitrary number of
+    # requests, with the parser being set up only once.
+    timeout = SERVER_TIMEOUT if values is None else values
+    serveCompletions(parser, stdin.fileno(), stdout.fileno(), timeout)
+    parser.exit(0)
+
+
+class CompleteScriptAction(Action):
+  """An action used for emitting a shell script providing completion for the program."""
+  def __call__(self, parser, namespace, values, option_string=None):
+    """Invoke the action to print the completion script for the given shell."""
+    # The shell module depends on us, so we cannot import it globally.
+    from deso.argcomp.shell import (
+      generateScript,
+    )
 
-    parser.exit(0 if len(completions) > 0 else 1)
+    shell, = values
+    print(generateScript(parser.arguments, parser.prog, shell), end="")
+    parser.exit(0)
 
 
 class CompletingArgumentParser(ArgumentParser):
   """An ArgumentParser derivate with argument completion support."""
   def __init__(self, *args, prefix_chars=None, fromfile_prefix_chars=None,
-               arguments=None, **kwargs):
-    """Create an argument parser with argument completion support."""
+               arguments=None, completion_limit=None, **kwargs):
+    """Create an argument parser with argument completion support.
+
+      The number of completions reported for a single request can be
+      capped by means of the 'completion_limit' argument.
+    """
     assert prefix_chars is None, ("The prefix_chars argument is not "
                                   "supported. Got %s." % prefix_chars)
     assert fromfile_prefix_chars is None, ("The fromfile_prefix_chars "
@@ -283,6 +466,8 @@ class CompletingArgumentParser(ArgumentParser):
     else:
       self._arguments = arguments
 
+    self.completion_limit = completion_limit
+
     # Note that in case the add_help option is true the argment parser
     # will add two arguments -h/--help. Because it uses the add_argument
     # method to do so there is nothing to do special from our side.
@@ -292,20 +477,18 @@ class CompletingArgumentParser(ArgumentParser):
       COMPLETE_OPTION, action=CompleteAction, complete=False,
       default=SUPPRESS, nargs=REMAINDER, help=SUPPRESS,
     )
+    self.add_argument(
+      COMPLETE_SERVER_OPTION, action=CompleteServerAction, complete=False,
+      default=SUPPRESS, nargs="?", type=float, help=SUPPRESS,
+    )
+    self.add_argument(
+      COMPLETE_SCRIPT_OPTION, action=CompleteScriptAction, complete=False,
+      default=SUPPRESS, nargs=1, choices=SHELLS, help=SUPPRESS,
+    )
 
 
   def _addCompletion(self, arg, choices=None, completer=None, **kwargs):
     """Register a completion for the given argument."""
-    def completeChoice(parser, values, word, choices):
-      """Attempt completion of a word from the given choices."""
-      # Choices that are non-strings are allowed. For instance, integers
-      # are valid candidates and understood by the ArgumentParser.
-      # At the end of the day, however, everything we emit is a string,
-      # so work with strings here.
-      for choice in map(str, choices):
-        if choice.startswith(word):
-          yield choice
-
     # We only fall back to interpreting the action to deduce the
     # argument count if no nargs parameter is given.
     if "nargs" in kwargs:
@@ -320,7 +503,7 @@ class CompletingArgumentParser(ArgumentParser):
     if choices is not None:
       # The 'completer' argument and 'choices' are mutually exclusive.
       assert completer is None
-      completer = partial(completeChoice, choices=choices)
+      completer = partial(completeChoice, choices=CandidateIndex(choices))
 
     if completer is None:
       completer = noCompletion
@@ -329,7 +512,7 @@ class CompletingArgumentParser(ArgumentParser):
     keyword = arg.startswith("-")
     if keyword:
       # We are dealing with a keyword argument.
-      self._arguments.keywords[arg] = argument
+      self._arguments.addKeyword(arg, argument)
     else:
       # We are dealing with a positional argument.
       self._arguments.positionals.append(argument)
@@ -390,7 +573,7 @@ class CompletingArgumentParser(ArgumentParser):
     def addParser(add_parser, name, *args, **kwargs):
       """A replacement method for the add_parser method."""
       sub_arguments = Arguments()
-      self._arguments.keywords[name] = sub_arguments
+      self._arguments.addKeyword(name, sub_arguments)
 
       # Invoke the original add_parser function. We need to do that
       # because this function takes care of handling special keyword
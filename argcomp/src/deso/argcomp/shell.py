@@ -0,0 +1,341 @@
+# shell.py
+
+#/***************************************************************************
+# *   Copyright (C) 2026 Daniel Mueller (deso@posteo.net)                   *
+# *                                                                         *
+# *   This program is free software: you can redistribute it and/or modify  *
+# *   it under the terms of the GNU General Public License as published by  *
+# *   the Free Software Foundation, either version 3 of the License, or     *
+# *   (at your option) any later version.                                   *
+# *                                                                         *
+# *   This program is distributed in the hope that it will be useful,       *
+# *   but WITHOUT ANY WARRANTY; without even the implied warranty of        *
+# *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         *
+# *   GNU General Public License for more details.                          *
+# *                                                                         *
+# *   You should have received a copy of the GNU General Public License     *
+# *   along with this program.  If not, see <http://www.gnu.org/licenses/>. *
+# ***************************************************************************/
+
+"""Generation of static shell completion scripts.
+
+  Completing arguments by means of the --_complete option requires the
+  program in question to be started for each completion request. Yet,
+  most of the information required for completion, namely keyword
+  arguments, sub-commands, and choices, is static. This module exports
+  the completion information of a parser into a static specification
+  and generates shell functions from it that are able to answer most
+  completion requests without running the program. Only if a custom
+  completer is involved the program is invoked with --_complete. In
+  bash, the program is kept running as a completion server in a
+  coprocess, so that it does not have to be started over and over again.
+"""
+
+from deso.argcomp.parser import (
+  Arguments,
+  COMPLETE_OPTION,
+  COMPLETE_SERVER_OPTION,
+  completeChoice,
+  noCompletion,
+)
+from functools import (
+  partial,
+)
+from re import (
+  sub,
+)
+
+
+def exportArgument(argument):
+  """Export an Argument object into a dict."""
+  spec = {
+    "min": argument.min_,
+    "max": argument.max_,
+  }
+
+  if argument.comp is noCompletion:
+    pass
+  elif isinstance(argument.comp, partial) and argument.comp.func is completeChoice:
+    spec["choices"] = list(map(str, argument.comp.keywords["choices"]))
+  else:
+    # Any other completer may produce arbitrary results at run time.
+    spec["dynamic"] = True
+
+  return spec
+
+
+def exportSpec(arguments):
+  """Export an Arguments object into a static specification.
+
+    The specification only consists of dicts, lists, strings, integers,
+    and booleans and can be serialized (e.g., as JSON) as is.
+  """
+  keywords = {}
+  for name, value in arguments.keywords.items():
+    if isinstance(value, Arguments):
+      keywords[name] = exportSpec(value)
+    else:
+      keywords[name] = exportArgument(value)
+
+  return {
+    "positionals": [exportArgument(x) for x in arguments.positionals],
+    "keywords": keywords,
+  }
+
+
+def quote(string):
+  """Quote a string for use in a shell script."""
+  return "'%s'" % string.replace("'", "'\\''")
+
+
+def functionName(program):
+  """Retrieve the name of the completion function for a program."""
+  return "_complete_%s" % sub("[^A-Za-z0-9_]", "_", program)
+
+
+class _Tables:
+  """The tables describing a specification on the shell level."""
+  def __init__(self, spec):
+    """Create the tables by flattening the given specification."""
+    # For each specification (node) a string of four integers: the index
+    # of its first keyword name in 'names', the number of keywords, the
+    # index of its first positional in 'positionals', and the number of
+    # positionals.
+    self.nodes = []
+    self.names = []
+    # A mapping from "<node> <keyword>" to either an encoded argument or
+    # s<node>, in case the keyword represents a sub-command.
+    self.keywords = {}
+    self.positionals = []
+    self.choices = []
+
+    self._addNode(spec)
+
+
+  def _addNode(self, spec):
+    """Add a specification to the tables."""
+    node = len(self.nodes)
+    self.nodes.append(None)
+
+    names = list(spec["keywords"].keys())
+    self.nodes[node] = "%d %d %d %d" % (
+      len(self.names), len(names), len(self.positionals), len(spec["positionals"])
+    )
+    self.names += names
+    self.positionals += [self._encodeArgument(x) for x in spec["positionals"]]
+
+    for name, value in spec["keywords"].items():
+      key = "%d %s" % (node, name)
+      if "positionals" in value:
+        self.keywords[key] = "s%d" % self._addNode(value)
+      else:
+        self.keywords[key] = self._encodeArgument(value)
+
+    return node
+
+
+  def _encodeArgument(self, spec):
+    """Encode an argument as <min>:<max>:<completion>."""
+    if "choices" in spec:
+      comp = "c%d,%d" % (len(self.choices), len(spec["choices"]))
+      self.choices += spec["choices"]
+    elif spec.get("dynamic", False):
+      comp = "d"
+    else:
+      comp = "n"
+
+    return "%d:%d:%s" % (spec["min"], spec["max"], comp)
+
+
+# The completion functions emulate the logic of the 'complete' function
+# from the parser module. Note that they are written to work with bash
+# as well as zsh (with bashcompinit).
+SCRIPT = """\
+# Completion for {program}, generated by deso.argcomp.
+
+{function}_positional()
+{{
+  # Retrieve the positional argument at pos_idx of the current node.
+  read -r kwstart kwcount posstart poscount <<< "${{nodes[node]}}"
+  if ((pos_idx < poscount)); then
+    IFS=: read -r pmin pmax pcomp <<< "${{positionals[posstart + pos_idx]}}"
+  else
+    pmin=0 pmax=0 pcomp=n
+  fi
+}}
+
+{function}_choices()
+{{
+  # Add all choices described by the given completion matching $cur.
+  local start count j
+  case "${{1}}" in
+    c*)
+      IFS=, read -r start count <<< "${{1#c}}"
+      for ((j = start; j < start + count; j++)); do
+        [[ "${{choices[j]}}" == "${{cur}}"* ]] && COMPREPLY+=("${{choices[j]}}")
+      done
+      ;;
+  esac
+}}
+
+{function}_request()
+{{
+  # Query a completion server running as a coprocess, starting it if
+  # necessary. Our protocol is line based with tab separated fields, so
+  # requests containing tabs or newlines cannot be transferred.
+  local count=-1 line
+  [ -n "${{BASH_VERSION-}}" ] || return 1
+  [[ "${{PWD}}${{COMP_WORDS[*]}}" != *[$'\\t\\n']* ]] || return 1
+
+  if [ -z "${{{function}_server_PID-}}" ]; then
+    {{ coproc {function}_server {{ "${{1}}" {server} 2> /dev/null; }}; }} 2> /dev/null
+    disown "${{{function}_server_PID}}" 2> /dev/null
+  fi
+
+  # The server may have terminated already (e.g., because it was idle
+  # for too long), in which case we must not be killed by SIGPIPE.
+  local pipe_trap
+  pipe_trap=$(trap -p PIPE)
+  trap '' PIPE
+
+  local IFS=$'\\t'
+  printf '%s\\t%s\\t%s\\n' "${{PWD}}" "${{COMP_CWORD}}" "${{COMP_WORDS[*]}}" \\
+    2> /dev/null >&"${{{function}_server[1]}}" &&
+  read -r -t 5 count <&"${{{function}_server[0]}}"
+  eval "${{pipe_trap:-trap - PIPE}}"
+  [[ "${{count}}" =~ ^[0-9]+$ ]] || count=-1
+
+  for ((; count > 0; count--)); do
+    IFS= read -r -t 5 line <&"${{{function}_server[0]}}" || break
+    COMPREPLY+=("${{line}}")
+  done
+
+  if ((count != 0)); then
+    # We cannot be sure the server is still in a sane state and so we
+    # terminate it. A new one is started on the next request.
+    kill "${{{function}_server_PID-}}" 2> /dev/null
+    return 1
+  fi
+}}
+
+{function}()
+{{
+  [ -n "${{ZSH_VERSION-}}" ] && emulate -L ksh
+
+  local -a nodes=({nodes})
+  local -a names=({names})
+  local -A keywords=({keywords})
+  local -a positionals=({positionals})
+  local -a choices=({choices})
+
+  local cur="${{COMP_WORDS[COMP_CWORD]}}"
+  local node=0 pos_idx=0 pmin pmax pcomp kmin=0 kmax=0 kcomp=n
+  local kwstart kwcount posstart poscount word value i completions
+
+  COMPREPLY=()
+  {function}_positional
+
+  for ((i = 1; i < COMP_CWORD; i++)); do
+    word="${{COMP_WORDS[i]}}"
+    value="${{keywords["${{node}} ${{word}}"]-}}"
+    if [ -n "${{value}}" ]; then
+      kmin=0 kmax=0 kcomp=n
+      if [[ "${{value}}" == s* ]]; then
+        node="${{value#s}}" pos_idx=0
+        {function}_positional
+      else
+        IFS=: read -r kmin kmax kcomp <<< "${{value}}"
+      fi
+    elif ((kmax > 0)); then
+      ((kmin -= 1, kmax -= 1))
+    elif ((pmax > 0)); then
+      ((pmin -= 1, pmax -= 1))
+      if ((pmax == 0)); then
+        ((pos_idx += 1))
+        {function}_positional
+      fi
+    else
+      while true; do
+        ((pos_idx += 1))
+        ((pos_idx < poscount)) || return 0
+        {function}_positional
+        if ((pmax > 0)); then
+          ((pmin -= 1, pmax -= 1))
+          break
+        fi
+      done
+    fi
+  done
+
+  if {{ ((pmax > 0)) && [ "${{pcomp}}" = d ]; }} ||
+     {{ ((kmax > 0)) && [ "${{kcomp}}" = d ]; }}; then
+    # A custom completer is involved. Only the program itself can
+    # provide the completions.
+    {function}_request "${{1}}" && return 0
+
+    COMPREPLY=()
+    completions=$("${{1}}" {option} "${{COMP_CWORD}}" "${{COMP_WORDS[@]}}") || return 0
+    while IFS= read -r word; do
+      COMPREPLY+=("${{word}}")
+    done <<< "${{completions}}"
+    return 0
+  fi
+
+  ((pmax > 0)) && {function}_choices "${{pcomp}}"
+  ((kmax > 0)) && {function}_choices "${{kcomp}}"
+
+  # If there are open keyword-level positional arguments then we should
+  # not complete keyword arguments.
+  if ((kmin <= 0)); then
+    read -r kwstart kwcount posstart poscount <<< "${{nodes[node]}}"
+    for ((i = kwstart; i < kwstart + kwcount; i++)); do
+      [[ "${{names[i]}}" == "${{cur}}"* ]] && COMPREPLY+=("${{names[i]}}")
+    done
+  fi
+  return 0
+}}
+
+complete -F {function} {program}
+"""
+
+# Completion in zsh is provided by means of its bash compatibility layer.
+ZSH_PRELUDE = """\
+autoload -U +X bashcompinit && bashcompinit
+
+"""
+
+
+def generateBash(spec, program):
+  """Generate a bash completion script for the given specification."""
+  tables = _Tables(spec)
+
+  def array(values):
+    """Format a list of values as shell array content."""
+    return " ".join(map(quote, values))
+
+  keywords = " ".join("[%s]=%s" % (quote(k), quote(v)) for k, v in tables.keywords.items())
+  return SCRIPT.format(
+    program=program,
+    function=functionName(program),
+    option=COMPLETE_OPTION,
+    server=COMPLETE_SERVER_OPTION,
+    nodes=array(tables.nodes),
+    names=array(tables.names),
+    keywords=keywords,
+    positionals=array(tables.positionals),
+    choices=array(tables.choices),
+  )
+
+
+def generateZsh(spec, program):
+  """Generate a zsh completion script for the given specification."""
+  return ZSH_PRELUDE + generateBash(spec, program)
+
+
+def generateScript(arguments, program, shell):
+  """Generate a completion script for a program for the given shell."""
+  generators = {
+    "bash": generateBash,
+    "zsh": generateZsh,
+  }
+  return generators[shell](exportSpec(arguments), program)
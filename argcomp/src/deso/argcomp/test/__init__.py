@@ -34,6 +34,7 @@ def allTests():
   # to be able to easily deselect parts.
   tests = [
     "testCompletingArgumentParser.py",
+    "testShell.py",
   ]
 
   loader = TestLoader()
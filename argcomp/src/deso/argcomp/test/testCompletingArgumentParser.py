@@ -22,13 +22,18 @@
 from argparse import (
   Action,
 )
+from contextlib import (
+  redirect_stderr,
+)
 from deso.argcomp import (
   CompletingArgumentParser,
 )
 from deso.argcomp.parser import (
+  CandidateIndex,
   decodeAction,
   decodeNargs,
   escapeDoubleDash,
+  serveCompletions,
   unescapeDoubleDash,
 )
 from io import (
@@ -36,8 +41,12 @@ from io import (
 )
 from os import (
   chdir,
+  close,
   getcwd,
   listdir,
+  pipe,
+  read,
+  write,
 )
 from os.path import (
   basename,
@@ -47,6 +56,9 @@ from sys import (
   executable,
   maxsize,
 )
+from time import (
+  monotonic,
+)
 from tempfile import (
   NamedTemporaryFile,
   TemporaryDirectory,
@@ -123,6 +135,25 @@ class TestMisc(TestCase):
     self.assertEqual(max_, 13)
 
 
+  def testCandidateIndex(self):
+    """Verify that a CandidateIndex finds all candidates with a given prefix."""
+    index = CandidateIndex(["foo", "bar", "foobar", "baz", "fo", "foo", 42])
+    self.assertEqual(len(index), 6)
+    self.assertEqual(list(index), ["42", "bar", "baz", "fo", "foo", "foobar"])
+    self.assertEqual(list(index.match("")), list(index))
+    self.assertEqual(list(index.match("foo")), ["foo", "foobar"])
+    self.assertEqual(list(index.match("ba")), ["bar", "baz"])
+    self.assertEqual(list(index.match("4")), ["42"])
+    self.assertEqual(list(index.match("fooo")), [])
+    self.assertEqual(list(index.match("z")), [])
+
+    index.add("bax")
+    index.add("foo")
+    index.add(7)
+    self.assertEqual(list(index), ["42", "7", "bar", "bax", "baz", "fo", "foo", "foobar"])
+    self.assertEqual(list(index.match("ba")), ["bar", "bax", "baz"])
+
+
 class TestCompletingArgumentParser(TestCase):
   """Test cases for the CompletingArgumentParser class."""
   def testNoArgumentInNamespace(self):
@@ -407,6 +438,26 @@ class TestCompletingArgumentParser(TestCase):
     self.performCompletion(parser, ["--foo", "bar", "s"], {"scissors"})
 
 
+  def testCompleteManyChoices(self):
+    """Verify that completion works with a large number of choices."""
+    choices = ["branch-%06d" % i for i in range(100000)]
+    parser = CompletingArgumentParser(prog="manyChoices", add_help=False)
+    parser.add_argument("branch", choices=choices)
+
+    expected = {"branch-%06d" % i for i in range(12340, 12350)}
+    self.performCompletion(parser, ["branch-01234"], expected)
+    self.performCompletion(parser, ["branch-2"], set(), exit_code=1)
+
+
+  def testCompletionLimit(self):
+    """Verify that the number of reported completions can be capped."""
+    parser = CompletingArgumentParser(prog="limit", add_help=False, completion_limit=3)
+    parser.add_argument("number", choices=range(100))
+
+    self.performCompletion(parser, [""], {"0", "1", "10"})
+    self.performCompletion(parser, ["9"], {"9", "90", "91"})
+
+
   def testNonStrChoice(self):
     """Verify that non-string choices can be completed."""
     expected = {"0", "1", "2", "3", "4", "5", "6", "7", "8", "9"}
@@ -491,5 +542,68 @@ class TestCompletingArgumentParser(TestCase):
     self.performCompletion(parser, ["--foo", ""], set(), exit_code=1)
 
 
+  def testServeCompletions(self):
+    """Verify that a completion server answers all requests."""
+    def failingCompleter(parser, values, word):
+      """A completer raising an error."""
+      raise RuntimeError("completer failed")
+
+    parser = CompletingArgumentParser(prog="server", add_help=False)
+    parser.add_argument("--foo", action="store_true")
+    parser.add_argument("--move", choices=("rock", "paper", "scissors"))
+    parser.add_argument("--zzz", completer=failingCompleter)
+
+    with TemporaryDirectory() as dir_:
+      requests = [
+        "%s\t1\tserver\t--" % dir_,
+        "%s\t2\tserver\t--move\t" % dir_,
+        "%s\t2\tserver\t--move\tx" % dir_,
+        "malformed",
+        "%s\t2\tserver\t--zzz\t" % dir_,
+        "%s\t1\tserver\t--m" % dir_,
+      ]
+
+      in_r, in_w = pipe()
+      out_r, out_w = pipe()
+      old_cwd = getcwd()
+      try:
+        write(in_w, ("\n".join(requests) + "\n").encode())
+        close(in_w)
+        with redirect_stderr(StringIO()) as err:
+          serveCompletions(parser, in_r, out_w, timeout=10)
+        close(out_w)
+        response = read(out_r, 4096).decode()
+      finally:
+        # The server changes into the directory of each request.
+        chdir(old_cwd)
+        close(in_r)
+        close(out_r)
+
+    lines = response.splitlines()
+    self.assertEqual(lines[0], "3")
+    self.assertSetEqual(set(lines[1:4]), {"--foo", "--move", "--zzz"})
+    self.assertEqual(lines[4], "3")
+    self.assertSetEqual(set(lines[5:8]), {"rock", "paper", "scissors"})
+    # A failing completer does not bring down the server but its error
+    # is reported.
+    self.assertEqual(lines[8:], ["0", "0", "0", "1", "--move"])
+    self.assertIn("RuntimeError: completer failed", err.getvalue())
+
+
+  def testServerIdleTimeout(self):
+    """Verify that a completion server terminates after being idle for a while."""
+    parser = CompletingArgumentParser(prog="server")
+
+    in_r, in_w = pipe()
+    out_r, out_w = pipe()
+    try:
+      start = monotonic()
+      serveCompletions(parser, in_r, out_w, timeout=0.1)
+      self.assertLess(monotonic() - start, 5)
+    finally:
+      for fd in (in_r, in_w, out_r, out_w):
+        close(fd)
+
+
 if __name__ == "__main__":
   main()
@@ -0,0 +1,229 @@
+# testShell.py
+
+#/***************************************************************************
+# *   Copyright (C) 2026 Daniel Mueller (deso@posteo.net)                   *
+# *                                                                         *
+# *   This program is free software: you can redistribute it and/or modify  *
+# *   it under the terms of the GNU General Public License as published by  *
+# *   the Free Software Foundation, either version 3 of the License, or     *
+# *   (at your option) any later version.                                   *
+# *                                                                         *
+# *   This program is distributed in the hope that it will be useful,       *
+# *   but WITHOUT ANY WARRANTY; without even the implied warranty of        *
+# *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         *
+# *   GNU General Public License for more details.                          *
+# *                                                                         *
+# *   You should have received a copy of the GNU General Public License     *
+# *   along with this program.  If not, see <http://www.gnu.org/licenses/>. *
+# ***************************************************************************/
+
+"""Tests for the shell completion script generation."""
+
+from deso.argcomp import (
+  CompletingArgumentParser,
+  exportSpec,
+  generateBash,
+)
+from deso.argcomp.parser import (
+  complete,
+)
+from io import (
+  StringIO,
+)
+from json import (
+  dumps,
+  loads,
+)
+from os import (
+  getcwd,
+)
+from shutil import (
+  which,
+)
+from subprocess import (
+  PIPE,
+  run,
+)
+from sys import (
+  maxsize,
+)
+from unittest import (
+  main,
+  skipIf,
+  TestCase,
+)
+from unittest.mock import (
+  patch,
+)
+
+
+def completeDynamic(parser, values, word):
+  """A custom completer."""
+  yield "dynamic"
+
+
+def createParser():
+  """Create a parser exercising all sorts of arguments."""
+  parser = CompletingArgumentParser(prog="test-prog")
+  parser.add_argument("--foo", action="store_true")
+  parser.add_argument("-m", "--move", choices=("rock", "paper", "scissors"))
+  parser.add_argument("-d", "--dynamic", completer=completeDynamic)
+
+  subparsers = parser.add_subparsers()
+  sub1 = subparsers.add_parser("sub1", add_help=False)
+  sub1.add_argument("player")
+  sub1.add_argument("count", choices=range(3), nargs="+")
+  sub1.add_argument("-s", "--sub1opt", nargs=2)
+
+  sub2 = subparsers.add_parser("sub2", add_help=False)
+  sub2.add_argument("pos", nargs="?")
+  sub2.add_argument("file", completer=completeDynamic)
+
+  subparsers2 = sub2.add_subparsers()
+  sub21 = subparsers2.add_parser("sub21")
+  sub21.add_argument("--it's", action="store_true")
+  return parser
+
+
+class TestShell(TestCase):
+  """Tests for the shell completion script generation."""
+  def testExportSpec(self):
+    """Verify that a parser's arguments can be exported into a specification."""
+    parser = createParser()
+    spec = exportSpec(parser.arguments)
+
+    # The specification must be serializable.
+    self.assertEqual(loads(dumps(spec)), spec)
+
+    self.assertEqual(spec["positionals"], [])
+    self.assertEqual(spec["keywords"]["--foo"], {"min": 0, "max": 0})
+    self.assertEqual(spec["keywords"]["-m"], {
+      "min": 1,
+      "max": 1,
+      "choices": ["paper", "rock", "scissors"],
+    })
+    self.assertEqual(spec["keywords"]["-d"], {"min": 1, "max": 1, "dynamic": True})
+
+    sub1 = spec["keywords"]["sub1"]
+    self.assertEqual(sub1["positionals"], [
+      {"min": 1, "max": 1},
+      {"min": 1, "max": maxsize, "choices": ["0", "1", "2"]},
+    ])
+    self.assertEqual(set(sub1["keywords"].keys()), {"-s", "--sub1opt"})
+
+
+  def testCompleteScriptOption(self):
+    """Verify that the completion script can be retrieved through the parser."""
+    parser = createParser()
+
+    with patch("sys.stdout", new_callable=StringIO) as mock_stdout:
+      with self.assertRaises(SystemExit) as e:
+        parser.parse_args(["--_complete-script", "zsh"])
+
+      self.assertEqual(e.exception.code, 0)
+      script = mock_stdout.getvalue()
+
+    self.assertTrue(script.startswith("autoload -U +X bashcompinit"))
+    self.assertTrue(script.endswith("complete -F _complete_test_prog test-prog\n"))
+
+
+  def completeWithBash(self, script, words, server="exit 1"):
+    """Complete the last of the given words with the given script in bash."""
+    # We define a shell function as a stand-in for the program. It is
+    # invoked in case of dynamic completions. By default, it acts as a
+    # completion server failing all requests.
+    command = """\
+{script}
+test-prog() {{
+  if [ "${{1}}" = --_complete-server ]; then
+    {server}
+  else
+    printf '%s\\n' "${{@}}"
+  fi
+}}
+COMP_WORDS=("${{@}}")
+COMP_CWORD=$((${{#}} - 1))
+_complete_test_prog test-prog
+printf '%s\\n' "${{COMPREPLY[@]}}"
+""".format(script=script, server=server)
+
+    result = run(["bash", "-c", command, "bash", "test-prog"] + words,
+                 stdout=PIPE, check=True)
+    return set(result.stdout.decode().splitlines()) - {""}
+
+
+  @skipIf(which("bash") is None, "bash is not available")
+  def testStaticCompletion(self):
+    """Verify that bash completion yields the same results as the parser."""
+    parser = createParser()
+    script = generateBash(exportSpec(parser.arguments), "test-prog")
+
+    tests = [
+      [""],
+      ["-"],
+      ["--"],
+      ["--m"],
+      ["--move", ""],
+      ["--move", "r"],
+      ["-m", "rock", "-"],
+      ["--foo", "s"],
+      ["sub1", ""],
+      ["sub1", "-s", ""],
+      ["sub1", "-s", "a", "b", ""],
+      ["sub1", "player", ""],
+      ["sub1", "player", "1", ""],
+      ["sub1", "player", "1", "2", "-"],
+      ["--foo", "sub2", "pos", "file", ""],
+      ["sub2", "sub21", "--"],
+      ["sub2", "sub21", "--it"],
+      ["unknown", "positional", ""],
+    ]
+
+    for words in tests:
+      expected = set(complete(parser, words, parser.arguments, words))
+      self.assertSetEqual(self.completeWithBash(script, words), expected, words)
+
+
+  @skipIf(which("bash") is None, "bash is not available")
+  def testDynamicCompletion(self):
+    """Verify that bash completion invokes the program for custom completers."""
+    parser = createParser()
+    script = generateBash(exportSpec(parser.arguments), "test-prog")
+
+    # Our stand-in for the program simply echoes its arguments.
+    words = ["--foo", "-d", "x"]
+    expected = {"--_complete", "3", "test-prog", "--foo", "-d", "x"}
+    self.assertSetEqual(self.completeWithBash(script, words), expected)
+
+    words = ["sub2", "pos", ""]
+    expected = {"--_complete", "3", "test-prog", "sub2", "pos"}
+    self.assertSetEqual(self.completeWithBash(script, words), expected)
+
+
+  @skipIf(which("bash") is None, "bash is not available")
+  def testDynamicCompletionWithServer(self):
+    """Verify that bash completion queries a completion server for custom completers."""
+    parser = createParser()
+    script = generateBash(exportSpec(parser.arguments), "test-prog")
+
+    # A server echoing each request's fields in reverse order.
+    server = """\
+while IFS=$'\\t' read -r -a fields; do
+      printf '%s\\n' "${#fields[@]}"
+      for ((i = ${#fields[@]} - 1; i >= 0; i--)); do
+        printf '%s\\n' "${fields[i]}"
+      done
+    done"""
+    words = ["--foo", "-d", "x y"]
+    expected = {getcwd(), "3", "test-prog", "--foo", "-d", "x y"}
+    self.assertSetEqual(self.completeWithBash(script, words, server), expected)
+
+    # Words containing a tab cannot be transferred to a server, so the
+    # program should be invoked directly.
+    words = ["--foo", "-d", "x\ty"]
+    expected = {"--_complete", "3", "test-prog", "--foo", "-d", "x\ty"}
+    self.assertSetEqual(self.completeWithBash(script, words, server), expected)
+
+
+if __name__ == "__main__":
+  main()
@@ -25,9 +25,24 @@ from deso.execute.execute_ import (
   formatCommands,
   pipeline,
   ProcessError,
+  SpillBuffer,
   spring,
 )
 from deso.execute.util import (
   findCommand,
   isExecutable,
 )
+
+
+def __getattr__(name):
+  """Lazily import the Executor class."""
+  # The executor module depends on concurrent.futures which, in turn,
+  # pulls in logging and threading. The import is deferred until first
+  # use in order to not burden the start up time of all clients.
+  if name == "Executor":
+    from deso.execute.executor import (
+      Executor,
+    )
+    return Executor
+
+  raise AttributeError("module %r has no attribute %r" % (__name__, name))
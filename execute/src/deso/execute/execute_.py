@@ -56,6 +56,13 @@
 from deso.cleanup import (
   defer,
 )
+from errno import (
+  EINVAL,
+)
+from mmap import (
+  ACCESS_READ,
+  mmap,
+)
 from os import (
   O_RDWR,
   O_CLOEXEC,
@@ -78,6 +85,14 @@ from os import (
   WEXITSTATUS,
   WTERMSIG,
 )
+try:
+  from os import (
+    splice,
+  )
+except ImportError:
+  # splice(2) is Linux specific and only exposed starting with Python
+  # 3.10. Without it we simply relay data through user space.
+  splice = None
 from select import (
   PIPE_BUF,
   POLLERR,
@@ -88,11 +103,15 @@ from select import (
   POLLPRI,
   poll,
 )
-from sys import (
-  stderr as stderr_,
-  stdin as stdin_,
-  stdout as stdout_,
-)
+
+# The file descriptors of the standard streams in a child process. Note
+# that we deliberately do not query sys.stdin & friends: these objects
+# may have been closed or replaced (multiprocessing, for instance,
+# closes sys.stdin in worker processes) while the descriptors we are
+# interested in are still the same.
+STDIN_FILENO = 0
+STDOUT_FILENO = 1
+STDERR_FILENO = 2
 
 
 class ProcessError(RuntimeError):
@@ -172,6 +191,22 @@ def _exec(*args, env=None):
     execve(args[0], list(args), env)
 
 
+def _decodeStatus(status):
+  """Decode a status as reported by waitpid, return None if the process did not terminate."""
+  if WIFEXITED(status):
+    return WEXITSTATUS(status)
+  elif WIFSIGNALED(status):
+    # Signals are usually represented as the negated signal number.
+    return -WTERMSIG(status)
+  elif WIFSTOPPED(status) or WIFCONTINUED(status):
+    # In our current usage scenarios we can simply ignore SIGSTOP and
+    # SIGCONT.
+    return None
+  else:
+    assert False
+    return 1
+
+
 def _waitpid(pid):
   """Convenience wrapper around the original waitpid invocation."""
   # 0 and -1 trigger a different behavior in waitpid. We disallow those
@@ -182,18 +217,11 @@ def _waitpid(pid):
     pid_, status = waitpid_(pid, 0)
     assert pid_ == pid
 
-    if WIFEXITED(status):
-      return WEXITSTATUS(status)
-    elif WIFSIGNALED(status):
-      # Signals are usually represented as the negated signal number.
-      return -WTERMSIG(status)
-    elif WIFSTOPPED(status) or WIFCONTINUED(status):
-      # In our current usage scenarios we can simply ignore SIGSTOP and
-      # SIGCONT by restarting the wait.
-      continue
-    else:
-      assert False
-      return 1
+    status = _decodeStatus(status)
+    # If the process was merely stopped or continued we restart the
+    # wait.
+    if status is not None:
+      return status
 
 
 def execute(*args, env=None, stdin=None, stdout=None, stderr=b""):
@@ -222,24 +250,24 @@ def _pipeline(commands, env, fd_in, fd_out, fd_err):
     if child:
       if not first:
         # Establish communication channel with previous process.
-        dup2(fd_in_old, stdin_.fileno())
+        dup2(fd_in_old, STDIN_FILENO)
         close_(fd_in_old)
         close_(fd_out_old)
       else:
-        dup2(fd_in, stdin_.fileno())
+        dup2(fd_in, STDIN_FILENO)
 
       if not last:
         # Establish communication channel with next process.
         close_(fd_in_new)
-        dup2(fd_out_new, stdout_.fileno())
+        dup2(fd_out_new, STDOUT_FILENO)
         close_(fd_out_new)
       else:
-        dup2(fd_out, stdout_.fileno())
+        dup2(fd_out, STDOUT_FILENO)
 
       # Stderr is redirected for all commands in the pipeline because each
       # process' output should be rerouted and stderr is not affected by
       # the pipe between the processes in any way.
-      dup2(fd_err, stderr_.fileno())
+      dup2(fd_err, STDERR_FILENO)
 
       _exec(*command, env=env)
       # This statement should never be reached: either exec fails in
@@ -349,15 +377,22 @@ def _wait(pids, commands, data_err, status=0, failed=None):
   # command.
   assert status == 0 or len(failed) > 0
 
-  for i, pid in enumerate(pids):
-    this_status = _waitpid(pid)
+  statuses = [_waitpid(pid) for pid in pids]
+  _evaluate(statuses, commands, data_err, status=status, failed=failed)
+
+
+def _evaluate(statuses, commands, data_err, status=0, failed=None):
+  """Evaluate the exit statuses of a set of processes, raise an error on failure."""
+  for i, this_status in enumerate(statuses):
     if this_status != 0 and status == 0:
-      # Only remember the first failure here, then continue clean up.
+      # Only remember the first failure here.
       failed = formatCommands([commands[i]])
       status = this_status
 
   if status != 0:
-    error = data_err.decode("utf-8") if data_err is not None else None
+    # Note that stderr data might be an mmap object in case it got
+    # spilled to disk, so explicitly convert it to bytes.
+    error = bytes(data_err).decode("utf-8") if data_err is not None else None
     raise ProcessError(status, failed, error)
 
 
@@ -373,6 +408,15 @@ def _write(data):
 
 def _read(data):
   """Read data from one of our pipe dicts."""
+  # If the data is spilled into a file anyway we can have the kernel
+  # move it there directly, without it ever being copied into a Python
+  # buffer. Because no copying is involved, we can also make use of a
+  # much larger chunk size.
+  if isinstance(data["data"], SpillBuffer):
+    count = data["data"].relay(data["in"], 64 * 1024)
+    if count is not None:
+      return count == 0
+
   # We use 4 KiB as the maximum buffer size. This is quite a bit smaller
   # than the 64 KiB that /bin/cat apparently uses (and that seem to be
   # the default buffer size of pipes on some systems) but we expect way
@@ -390,12 +434,153 @@ def _read(data):
     return True
 
 
+class SpillBuffer:
+  """A capture buffer for stdout or stderr that spills to disk once it grows too large.
+
+    Objects of this class can be passed in wherever data is accepted
+    for reading from stdout or stderr. Output is accumulated in memory
+    until 'threshold' bytes are exceeded. At that point the content is
+    moved into an unlinked temporary file and all further output is
+    appended there. Once the command finished, the captured data is
+    returned either as a bytes object (if it never spilled) or as a
+    read-only mmap object of the temporary file.
+  """
+  def __init__(self, threshold=16 * 1024 * 1024, data=b""):
+    """Initialize the buffer with the given threshold and initial content."""
+    assert threshold >= 0, threshold
+
+    self._threshold = threshold
+    self._buffer = bytearray(data)
+    self._file = None
+    self._splice = splice is not None
+
+
+  def __iadd__(self, data):
+    """Append data to the buffer, spilling it into a file if necessary."""
+    if self._file is None:
+      self._buffer += data
+
+      if len(self._buffer) > self._threshold:
+        # The tempfile module is comparably expensive to import and only
+        # ever needed at this point, so we defer its import.
+        from tempfile import (
+          TemporaryFile,
+        )
+
+        # Note that the temporary file is unlinked from the file system
+        # right away, i.e., it vanishes the moment we close it (or
+        # terminate).
+        self._file = TemporaryFile(buffering=0)
+        self._write(self._buffer)
+        self._buffer = None
+    else:
+      self._write(data)
+
+    return self
+
+
+  def _write(self, data):
+    """Write data to the spill file."""
+    # We work on an unbuffered file because we splice into the
+    # underlying file descriptor. Unbuffered writes may be partial, so
+    # keep going until everything got written.
+    data = memoryview(data)
+    while data:
+      data = data[self._file.write(data):]
+
+
+  def __len__(self):
+    """Retrieve the number of bytes captured so far."""
+    if self._file is None:
+      return len(self._buffer)
+
+    return self._file.tell()
+
+
+  def relay(self, fd, count):
+    """Move up to 'count' bytes from a pipe into the spill file without copying them.
+
+      The method returns the number of bytes transferred (with zero
+      indicating end-of-file) or None if no zero-copy transfer is
+      possible, in which case the caller has to fall back to reading
+      the data and appending it.
+    """
+    if self._file is None or not self._splice:
+      return None
+
+    try:
+      return splice(fd, self._file.fileno(), count)
+    except OSError as e:
+      # Not all file systems support splicing into their files. If we
+      # hit one of those we permanently fall back to copying.
+      if e.errno != EINVAL:
+        raise
+
+      self._splice = False
+      return None
+
+
+  def spilled(self):
+    """Check whether the buffer spilled its content into a file."""
+    return self._file is not None
+
+
+  def value(self):
+    """Retrieve the captured data, either as bytes or as a read-only mmap object."""
+    if self._file is None:
+      return bytes(self._buffer)
+
+    # The mapping keeps its own reference to the underlying file, so we
+    # can close our file object right away.
+    with self._file:
+      return mmap(self._file.fileno(), 0, access=ACCESS_READ)
+
+
 # The event mask for which to poll for a write channel (such as stdin).
 _OUT = POLLOUT | POLLHUP | POLLERR
 # The event mask for which to poll for a read channel (such as stdout).
 _IN = POLLPRI | POLLHUP | POLLIN
 
 
+def _transfer(data, event):
+  """Transfer data for one of our pipe dicts, return whether the channel is done."""
+  close = False
+
+  # Note that reading (POLLIN or POLLPRI) and writing (POLLOUT) are
+  # mutually exclusive operations on a pipe. All can be combined with a
+  # HUP or with other errors (POLLERR or POLLNVAL; even though we did
+  # not subscribe to them), though.
+  if event & POLLOUT:
+    close = _write(data)
+  elif event & POLLIN or event & POLLPRI:
+    if event & POLLHUP:
+      # In case we received a combination of a data-is-available and a
+      # HUP event we need to make sure that we flush the entire pipe
+      # buffer before we stop the polling. Otherwise we might leave data
+      # unread that was successfully sent to us.
+      # Note that from a logical point of view this problem occurs only
+      # in the receive case. In the write case we have full control over
+      # the file descriptor ourselves and if the remote side closes its
+      # part there is no point in sending any more data.
+      while not _read(data):
+        pass
+    else:
+      close = _read(data)
+
+  return bool(event & POLLHUP) or close
+
+
+def _checkEvent(event):
+  """Check an event for errors, raise an exception if one is found."""
+  # All error codes are reported to clients such that they can deal
+  # with potentially incomplete data.
+  if event & (POLLERR | POLLNVAL):
+    string = eventToString(event)
+    error = "Error while polling for new data, event: {s} ({e})"
+    error = error.format(s=string, e=event)
+    raise ConnectionError(error)
+
+
 def eventToString(events):
   """Convert an event set to a human readable string."""
   errors = {
@@ -501,20 +686,6 @@ class _PipelineFileDescriptors:
       implicitly returns a generator rather as opposed to a "direct"
       result.
     """
-    def pollWrite(data):
-      """Conditionally set up polling for write events."""
-      if data:
-        poll_.register(data["out"], _OUT)
-        data["unreg"] = d.defer(poll_.unregister, data["out"])
-        polls[data["out"]] = data
-
-    def pollRead(data):
-      """Conditionally set up polling for read events."""
-      if data:
-        poll_.register(data["in"], _IN)
-        data["unreg"] = d.defer(poll_.unregister, data["in"])
-        polls[data["in"]] = data
-
     # We need a poll object if we want to send any data to stdin or want
     # to receive any data from stdout or stderr.
     if self._stdin or self._stdout or self._stderr:
@@ -527,56 +698,27 @@ class _PipelineFileDescriptors:
 
     with defer() as d:
       # Set up the polling infrastructure.
-      pollWrite(self._stdin)
-      pollRead(self._stdout)
-      pollRead(self._stderr)
+      for fd, mask, data in self.channels():
+        poll_.register(fd, mask)
+        data["unreg"] = d.defer(poll_.unregister, fd)
+        polls[fd] = data
 
       while polls:
         events = poll_.poll(self._timeout)
 
         for fd, event in events:
-          close = False
           data = polls[fd]
 
-          # Note that reading (POLLIN or POLLPRI) and writing (POLLOUT)
-          # are mutually exclusive operations on a pipe. All can be
-          # combined with a HUP or with other errors (POLLERR or
-          # POLLNVAL; even though we did not subscribe to them), though.
-          if event & POLLOUT:
-            close = _write(data)
-          elif event & POLLIN or event & POLLPRI:
-            if event & POLLHUP:
-              # In case we received a combination of a data-is-available
-              # and a HUP event we need to make sure that we flush the
-              # entire pipe buffer before we stop the polling. Otherwise
-              # we might leave data unread that was successfully sent to
-              # us.
-              # Note that from a logical point of view this problem
-              # occurs only in the receive case. In the write case we
-              # have full control over the file descriptor ourselves and
-              # if the remote side closes its part there is no point in
-              # sending any more data.
-              while not _read(data):
-                pass
-            else:
-              close = _read(data)
-
           # We explicitly (and early, compared to the defers we
           # scheduled previously) close the file descriptor on POLLHUP,
           # when we received EOF (for reading), or run out of data to
           # send (for writing).
-          if event & POLLHUP or close:
+          if _transfer(data, event):
             data["close"]()
             data["unreg"]()
             del polls[fd]
 
-          # All error codes are reported to clients such that they can
-          # deal with potentially incomplete data.
-          if event & (POLLERR | POLLNVAL):
-            string = eventToString(event)
-            error = "Error while polling for new data, event: {s} ({e})"
-            error = error.format(s=string, e=event)
-            raise ConnectionError(error)
+          _checkEvent(event)
 
         if self._timeout is not None:
           yield
@@ -584,6 +726,16 @@ class _PipelineFileDescriptors:
       yield
 
 
+  def channels(self):
+    """Retrieve (file descriptor, event mask, pipe dict) tuples for all channels to poll."""
+    if self._stdin:
+      yield self._stdin["out"], _OUT, self._stdin
+    if self._stdout:
+      yield self._stdout["in"], _IN, self._stdout
+    if self._stderr:
+      yield self._stderr["in"], _IN, self._stderr
+
+
   def blockable(self, can_block):
     """Set whether or not polling is allowed to block."""
     self._timeout = None if can_block else 0
@@ -606,8 +758,31 @@ class _PipelineFileDescriptors:
 
   def data(self):
     """Retrieve the data polled so far as a (stdout, stderr) tuple."""
-    return self._stdout["data"] if self._stdout else b"",\
-           self._stderr["data"] if self._stderr else b""
+    def value(data):
+      """Retrieve the data of one of our pipe dicts."""
+      if not data:
+        return b""
+
+      data = data["data"]
+      return data.value() if isinstance(data, SpillBuffer) else data
+
+    return value(self._stdout), value(self._stderr)
+
+
+def _result(stdout, stderr, data_out, data_err):
+  """Select the data to return to the caller based on the stdout and stderr arguments."""
+  # We mirror the logic from _PipelineFileDescriptors.__init__ in that
+  # we special case values of None and of type int and treating
+  # everything else as data.
+  stdout_valid = stdout is not None and not isinstance(stdout, int)
+  stderr_valid = stderr is not None and not isinstance(stderr, int)
+
+  if stdout_valid and stderr_valid:
+    return data_out, data_err
+  elif stdout_valid:
+    return data_out
+  elif stderr_valid:
+    return data_err
 
 
 def pipeline(commands, env=None, stdin=None, stdout=None, stderr=b""):
@@ -621,7 +796,9 @@ def pipeline(commands, env=None, stdin=None, stdout=None, stderr=b""):
     fed into the standard input of the first command (in case of stdin)
     or be used as the initial buffer content of data to read (stdout and
     stderr) of the last command (which means all actually read data will
-    just be appended).
+    just be appended). Instead of a byte-like object a SpillBuffer may
+    be supplied for stdout and stderr in order to capture large amounts
+    of output without keeping it in memory.
   """
   with defer() as later:
     with defer() as here:
@@ -642,17 +819,7 @@ def pipeline(commands, env=None, stdin=None, stdout=None, stderr=b""):
   # up.
   _wait(pids, commands, data_err if stderr is not None else None)
 
-  # We mirror the logic from __init__ in that we special case values of
-  # None and of type int and treating everything else as data.
-  stdout_valid = stdout is not None and not isinstance(stdout, int)
-  stderr_valid = stderr is not None and not isinstance(stderr, int)
-
-  if stdout_valid and stderr_valid:
-    return data_out, data_err
-  elif stdout_valid:
-    return data_out
-  elif stderr_valid:
-    return data_err
+  return _result(stdout, stderr, data_out, data_err)
 
 
 def _spring(commands, env, fds):
@@ -715,9 +882,9 @@ def _spring(commands, env, fds):
     child = pid == 0
 
     if child:
-      dup2(fd_in, stdin_.fileno())
-      dup2(fd_out_new, stdout_.fileno())
-      dup2(fd_err, stderr_.fileno())
+      dup2(fd_in, STDIN_FILENO)
+      dup2(fd_out_new, STDOUT_FILENO)
+      dup2(fd_err, STDERR_FILENO)
 
       if pipe_cmds:
         close_(fd_in_new)
@@ -802,12 +969,4 @@ def spring(commands, env=None, stdout=None, stderr=b""):
   error = data_err if stderr is not None else None
   _wait(pids, commands, error, status=status, failed=failed)
 
-  stdout_valid = stdout is not None and not isinstance(stdout, int)
-  stderr_valid = stderr is not None and not isinstance(stderr, int)
-
-  if stdout_valid and stderr_valid:
-    return data_out, data_err
-  elif stdout_valid:
-    return data_out
-  elif stderr_valid:
-    return data_err
+  return _result(stdout, stderr, data_out, data_err)
@@ -0,0 +1,282 @@
+# executor.py
+
+#/***************************************************************************
+# *   Copyright (C) 2026 Daniel Mueller (deso@posteo.net)                   *
+# *                                                                         *
+# *   This program is free software: you can redistribute it and/or modify  *
+# *   it under the terms of the GNU General Public License as published by  *
+# *   the Free Software Foundation, either version 3 of the License, or     *
+# *   (at your option) any later version.                                   *
+# *                                                                         *
+# *   This program is distributed in the hope that it will be useful,       *
+# *   but WITHOUT ANY WARRANTY; without even the implied warranty of        *
+# *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         *
+# *   GNU General Public License for more details.                          *
+# *                                                                         *
+# *   You should have received a copy of the GNU General Public License     *
+# *   along with this program.  If not, see <http://www.gnu.org/licenses/>. *
+# ***************************************************************************/
+
+"""Concurrent execution of many pipelines over a single poll loop.
+
+  The pipeline and execute functions block until the commands they run
+  finished. When a large number of (typically short-lived) commands is
+  to be run, doing so one after the other wastes a lot of time waiting.
+  The Executor class provided here allows for having many pipelines in
+  flight at the same time. All their file descriptors as well as the
+  processes themselves (in the form of pidfds) are multiplexed over a
+  single epoll instance. Each submitted pipeline is represented by a
+  concurrent.futures.Future object that is completed once all its
+  processes terminated.
+"""
+
+from collections import (
+  deque,
+)
+from concurrent.futures import (
+  Future,
+)
+from deso.cleanup import (
+  defer,
+)
+from deso.execute.execute_ import (
+  _checkEvent,
+  _decodeStatus,
+  _evaluate,
+  _pipeline,
+  _PipelineFileDescriptors,
+  _result,
+  _transfer,
+)
+from errno import (
+  ENOSYS,
+)
+from os import (
+  close as close_,
+  waitpid,
+  WNOHANG,
+)
+from select import (
+  POLLIN,
+)
+
+try:
+  from os import (
+    pidfd_open,
+  )
+  from select import (
+    epoll,
+  )
+except ImportError:
+  # Both epoll and pidfds are Linux specific.
+  epoll = None
+  pidfd_open = None
+
+
+class _Job:
+  """A pipeline submitted to an Executor."""
+  def __init__(self, commands, env, stdin, stdout, stderr):
+    """Initialize the job object."""
+    self.commands = commands
+    self.env = env
+    self.stdin = stdin
+    self.stdout = stdout
+    self.stderr = stderr
+    self.future = Future()
+    # The defer object responsible for closing the job's file
+    # descriptors once the job is done.
+    self.later = defer()
+    self.fds = None
+    self.statuses = []
+    # The number of file descriptors and processes we still wait for.
+    self.pending = 0
+    self.error = None
+
+
+class Executor:
+  """An executor running many pipelines concurrently over a single epoll instance.
+
+    Pipelines are submitted using the pipeline and execute methods,
+    which accept the same arguments as the equally named functions but
+    return a Future object instead of blocking. Nothing happens in the
+    background: progress is made while the run or poll methods are
+    invoked (or the with block the executor is used in is left).
+    Completion callbacks can be registered with the future objects'
+    add_done_callback method.
+  """
+  def __init__(self, jobs=None):
+    """Initialize the executor, optionally limiting the number of concurrently running pipelines."""
+    if epoll is None or pidfd_open is None:
+      raise OSError(ENOSYS, "The Executor requires epoll and pidfd support")
+
+    assert jobs is None or jobs > 0, jobs
+
+    self._epoll = epoll()
+    # A mapping from file descriptors to (serial, handler) tuples.
+    self._handlers = {}
+    self._serial = 0
+    self._queue = deque()
+    self._running = 0
+    self._jobs = jobs
+
+
+  def __enter__(self):
+    """The block enter handler returns the executor itself."""
+    return self
+
+
+  def __exit__(self, type_, value, traceback):
+    """The block exit handler waits for all pipelines to finish."""
+    try:
+      self.run()
+    finally:
+      self.close()
+
+
+  def close(self):
+    """Close the executor."""
+    self._epoll.close()
+
+
+  def execute(self, *args, env=None, stdin=None, stdout=None, stderr=b""):
+    """Submit a program for execution."""
+    return self.pipeline([list(args)], env, stdin, stdout, stderr)
+
+
+  def pipeline(self, commands, env=None, stdin=None, stdout=None, stderr=b""):
+    """Submit a pipeline for execution, return a Future representing its result."""
+    job = _Job(commands, env, stdin, stdout, stderr)
+    self._queue.append(job)
+    self._startJobs()
+    return job.future
+
+
+  def _startJobs(self):
+    """Start queued jobs as long as we have not reached the maximum number of running ones."""
+    while self._queue and (self._jobs is None or self._running < self._jobs):
+      self._start(self._queue.popleft())
+
+
+  def _start(self, job):
+    """Start the pipeline of a job and register all its file descriptors for polling."""
+    try:
+      with defer() as here:
+        job.fds = _PipelineFileDescriptors(job.later, here, job.stdin, job.stdout, job.stderr)
+        fds = job.fds
+        pids = _pipeline(job.commands, job.env, fds.stdin(), fds.stdout(), fds.stderr())
+    except BaseException as e:
+      job.later.destroy()
+      job.future.set_exception(e)
+      return
+
+    self._running += 1
+    job.statuses = [None] * len(pids)
+
+    for fd, mask, data in job.fds.channels():
+      self._register(fd, mask, lambda e, fd=fd, data=data: self._onData(job, fd, data, e))
+      job.pending += 1
+
+    for index, pid in enumerate(pids):
+      pidfd = pidfd_open(pid)
+      self._register(pidfd, POLLIN,
+                     lambda e, p=pid, fd=pidfd, i=index: self._onExit(job, p, fd, i))
+      job.pending += 1
+
+
+  def _register(self, fd, mask, handler):
+    """Register a handler for events on the given file descriptor."""
+    self._serial += 1
+    self._handlers[fd] = (self._serial, handler)
+    self._epoll.register(fd, mask)
+
+
+  def _unregister(self, fd):
+    """Unregister the handler of the given file descriptor."""
+    self._epoll.unregister(fd)
+    del self._handlers[fd]
+
+
+  def _onData(self, job, fd, data, event):
+    """Handle an event on one of a job's data channels."""
+    try:
+      done = _transfer(data, event)
+      _checkEvent(event)
+    except (ConnectionError, OSError) as e:
+      # Remember the first error and stop polling the channel. The job
+      # will report the error once all its processes terminated.
+      if job.error is None:
+        job.error = e
+      done = True
+
+    if done:
+      self._unregister(fd)
+      data["close"]()
+      job.pending -= 1
+      self._complete(job)
+
+
+  def _onExit(self, job, pid, pidfd, index):
+    """Handle the termination of one of a job's processes."""
+    pid_, status = waitpid(pid, WNOHANG)
+    if pid_ == 0:
+      return
+
+    status = _decodeStatus(status)
+    if status is None:
+      return
+
+    job.statuses[index] = status
+    self._unregister(pidfd)
+    close_(pidfd)
+    job.pending -= 1
+    self._complete(job)
+
+
+  def _complete(self, job):
+    """Complete a job's future once all its file descriptors and processes are done."""
+    if job.pending > 0:
+      return
+
+    job.later.destroy()
+    self._running -= 1
+
+    try:
+      if job.error is not None:
+        raise job.error
+
+      data_out, data_err = job.fds.data()
+      error = data_err if job.stderr is not None else None
+      _evaluate(job.statuses, job.commands, error)
+      result = _result(job.stdout, job.stderr, data_out, data_err)
+    except BaseException as e:
+      job.future.set_exception(e)
+    else:
+      job.future.set_result(result)
+
+    self._startJobs()
+
+
+  def poll(self, timeout=None):
+    """Wait for events and dispatch them, return whether there is work left."""
+    if not self._handlers:
+      return False
+
+    # Events received for a file descriptor that got closed while
+    # dispatching previous events of the same batch may refer to a
+    # new registration reusing the very same file descriptor number.
+    # Such stale events must not be dispatched.
+    serial = self._serial
+    events = self._epoll.poll(-1 if timeout is None else timeout)
+
+    for fd, event in events:
+      handler = self._handlers.get(fd)
+      if handler is not None and handler[0] <= serial:
+        handler[1](event)
+
+    return bool(self._handlers)
+
+
+  def run(self):
+    """Run until all submitted pipelines finished."""
+    while self.poll():
+      pass
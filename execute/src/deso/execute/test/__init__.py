@@ -34,6 +34,7 @@ def allTests():
   # to be able to easily deselect parts.
   tests = [
     "testExecute.py",
+    "testExecutor.py",
     "testUtil.py",
   ]
 
@@ -25,11 +25,15 @@ from deso.execute import (
   formatCommands,
   pipeline as pipeline_,
   ProcessError,
+  SpillBuffer,
   spring as spring_
 )
 from deso.execute.execute_ import (
   eventToString,
 )
+from mmap import (
+  mmap,
+)
 from os import (
   environ,
   remove,
@@ -67,6 +71,9 @@ from unittest import (
   TestCase,
   main,
 )
+from unittest.mock import (
+  patch,
+)
 
 
 _TRUE = findCommand("true")
@@ -530,6 +537,53 @@ class TestExecute(TestCase):
       self.assertEqual(len(out), len(data))
 
 
+  def testPipelineWithSpillBuffer(self):
+    """Verify that output exceeding a SpillBuffer's threshold is spilled to disk."""
+    data = b"abcdefgh" * 64 * 1024
+    commands = [[_DD], [_TR, "a", "A"]]
+
+    buffer_ = SpillBuffer(threshold=4096)
+    out = pipeline(commands, stdin=data, stdout=buffer_)
+
+    self.assertTrue(buffer_.spilled())
+    self.assertIsInstance(out, mmap)
+    self.assertEqual(len(out), len(data))
+    self.assertEqual(out[:], data.replace(b"a", b"A"))
+
+    # If the threshold is not exceeded we should just get bytes back.
+    buffer_ = SpillBuffer(threshold=len(data), data=b"x")
+    out = pipeline(commands, stdin=data[:1024], stdout=buffer_)
+
+    self.assertFalse(buffer_.spilled())
+    self.assertEqual(out, b"x" + data[:1024].replace(b"a", b"A"))
+
+
+  def testSpillBufferRelay(self):
+    """Verify that spilled data is transferred correctly with and without splice(2)."""
+    data = bytes(range(256)) * 4 * 1024
+
+    def doTest():
+      """Capture the data in a SpillBuffer and check the result."""
+      out = execute(_CAT, stdin=data, stdout=SpillBuffer(threshold=1024))
+      self.assertEqual(len(out), len(data))
+      self.assertEqual(out[:], data)
+
+    with patch("deso.execute.execute_.splice", None):
+      doTest()
+
+    doTest()
+
+
+  def testSpillBufferForStderr(self):
+    """Verify that a spilled stderr buffer is properly reported on failure."""
+    script = "import sys; sys.stderr.write('e' * 8192); sys.exit(1)"
+
+    with self.assertRaises(ProcessError) as e:
+      execute_(executable, "-c", script, stderr=SpillBuffer(threshold=1024))
+
+    self.assertEqual(e.exception.stderr, "e" * 8192)
+
+
   def testPipelineWithFailingCommand(self):
     """Verify that a failing command in a pipeline fails the entire execution."""
     identity = [_TR, "a", "a"]
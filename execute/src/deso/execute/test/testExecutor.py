@@ -0,0 +1,115 @@
+# testExecutor.py
+
+#/***************************************************************************
+# *   Copyright (C) 2026 Daniel Mueller (deso@posteo.net)                   *
+# *                                                                         *
+# *   This program is free software: you can redistribute it and/or modify  *
+# *   it under the terms of the GNU General Public License as published by  *
+# *   the Free Software Foundation, either version 3 of the License, or     *
+# *   (at your option) any later version.                                   *
+# *                                                                         *
+# *   This program is distributed in the hope that it will be useful,       *
+# *   but WITHOUT ANY WARRANTY; without even the implied warranty of        *
+# *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         *
+# *   GNU General Public License for more details.                          *
+# *                                                                         *
+# *   You should have received a copy of the GNU General Public License     *
+# *   along with this program.  If not, see <http://www.gnu.org/licenses/>. *
+# ***************************************************************************/
+
+"""Tests for the concurrent pipeline executor."""
+
+from deso.execute import (
+  Executor,
+  findCommand,
+  ProcessError,
+)
+from sys import (
+  executable,
+)
+from unittest import (
+  TestCase,
+  main,
+)
+
+
+_ECHO = findCommand("echo")
+_FALSE = findCommand("false")
+_TR = findCommand("tr")
+
+
+class TestExecutor(TestCase):
+  """A test case for the Executor class."""
+  def testManyPipelines(self):
+    """Verify that we can run a large number of pipelines concurrently."""
+    with Executor() as executor:
+      futures = []
+      for i in range(128):
+        commands = [[_ECHO, "-n", "a%d" % i], [_TR, "a", "b"]]
+        futures += [executor.pipeline(commands, stdout=b"", stderr=None)]
+
+    for i, future in enumerate(futures):
+      self.assertEqual(future.result(), b"b%d" % i)
+
+
+  def testInputOutput(self):
+    """Verify that data can be fed to and read from a pipeline."""
+    with Executor() as executor:
+      data = b"hello" * 64 * 1024
+      future = executor.execute(_TR, "e", "a", stdin=data, stdout=b"", stderr=None)
+
+    self.assertEqual(future.result(), data.replace(b"e", b"a"))
+
+
+  def testFailure(self):
+    """Verify that a failing command is reported through the future."""
+    script = "import sys; sys.stderr.write('failure'); sys.exit(3)"
+
+    with Executor() as executor:
+      success = executor.execute(_ECHO, "success", stdout=b"", stderr=None)
+      failure = executor.pipeline([[_ECHO], [executable, "-c", script]])
+
+    self.assertEqual(success.result(), b"success\n")
+
+    error = failure.exception()
+    self.assertIsInstance(error, ProcessError)
+    self.assertEqual(error.status, 3)
+    self.assertEqual(error.stderr, "failure")
+
+    with Executor() as executor:
+      future = executor.execute(_FALSE, stderr=None)
+
+    self.assertIsNone(future.exception().stderr)
+
+
+  def testCompletionCallbacks(self):
+    """Verify that callbacks are invoked in order when limiting concurrency."""
+    results = []
+
+    with Executor(jobs=1) as executor:
+      for i in range(8):
+        future = executor.execute(_ECHO, "%d" % i, stdout=b"", stderr=None)
+        future.add_done_callback(lambda f: results.append(f.result()))
+
+    self.assertEqual(results, [b"%d\n" % i for i in range(8)])
+
+
+  def testSubmitFromCallback(self):
+    """Verify that new pipelines can be submitted from a completion callback."""
+    results = []
+
+    def submit(future):
+      """Collect the result of a future and submit a follow-up command."""
+      results.append(future.result())
+      if len(results) < 4:
+        follow = executor.execute(_ECHO, "-n", "%d" % len(results), stdout=b"")
+        follow.add_done_callback(submit)
+
+    with Executor() as executor:
+      executor.execute(_ECHO, "-n", "0", stdout=b"").add_done_callback(submit)
+
+    self.assertEqual(results, [(b"%d" % i, b"") for i in range(4)])
+
+
+if __name__ == "__main__":
+  main()
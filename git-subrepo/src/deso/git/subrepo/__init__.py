@@ -21,7 +21,10 @@
 
 # The symbol names to export.
 to_import = [
+  "GitHistory",
   "GitImporter",
+  "GitObjectStore",
+  "GitRefStore",
   "Subrepo",
 ]
 
@@ -26,9 +26,15 @@ from bisect import (
   insort,
 )
 from collections import (
+  deque,
   namedtuple,
 )
+from contextlib import (
+  contextmanager,
+)
 from deso.argcomp import (
+  CandidateIndex,
+  COMPLETE_OPTION,
   CompletingArgumentParser as ArgumentParser,
 )
 from deso.execute import (
@@ -41,10 +47,32 @@ from deso.execute import (
 from functools import (
   lru_cache,
 )
+from heapq import (
+  heapify,
+  heappop,
+  heappush,
+)
+from mmap import (
+  ACCESS_READ,
+  mmap,
+)
 from os import (
+  chdir,
+  close,
   curdir,
   devnull,
+  dup,
+  dup2,
+  environ,
+  getcwd,
+  geteuid,
+  getpid,
+  listdir,
+  replace,
   sep,
+  stat,
+  umask,
+  unlink,
   walk,
 )
 from os.path import (
@@ -52,26 +80,44 @@ from os.path import (
   basename,
   commonprefix,
   dirname,
+  isdir,
+  isfile,
   join,
   lexists,
   normpath,
+  realpath,
   relpath,
 )
 from re import (
   compile as compileRe,
   IGNORECASE,
+  MULTILINE,
+)
+from stat import (
+  S_ISSOCK,
+)
+from struct import (
+  error as StructError,
+  unpack_from,
 )
 from sys import (
   argv as sysargv,
   stderr,
+  stdin,
+  stdout,
+)
+from time import (
+  localtime,
+  monotonic,
+  strftime,
 )
-from tempfile import (
-  mktemp,
+from zlib import (
+  decompress,
+  decompressobj,
+  error as ZlibError,
 )
 
 
-GIT = findCommand("git")
-ECHO = findCommand("echo")
 REPO_STR = "{prefix}:{repo}"
 PREFIX_R = r"([^:\n]+)"
 REPO_R = r"([^ \n]+)"
@@ -102,6 +148,90 @@ LS_TREE_RE = compileRe(LS_TREE_R)
 # is to happen in the root of the repository. This case needs some
 # special treatment later on.
 ROOT_PREFIX = "%s%s" % (curdir, sep)
+# The name of the (optional) manifest file listing the imported subrepos,
+# relative to the repository root.
+MANIFEST = ".gitsubrepo"
+MANIFEST_HEADER = "# Subrepos imported into this repository, maintained by git-subrepo."
+# Each line of the manifest represents an import. Lines indented by a
+# space describe the subrepos pulled in by the import above.
+MANIFEST_LINE_R = "( ?)%s (%s)" % (REPO_STR.format(prefix=PREFIX_R, repo=REPO_R), SHA1_R)
+MANIFEST_LINE_RE = compileRe(MANIFEST_LINE_R)
+# The subject of a commit recording the complete state of imports. Its
+# body lists the imports in the format of the manifest.
+CHECKPOINT_MSG = "Checkpoint subrepo imports"
+# The subject of a commit importing multiple subrepos at once. Its body
+# lists the imports, each followed by its dependencies indented by a
+# space.
+IMPORTS_MSG = "Import subrepos"
+# The name of the file (relative to the git directory) in which we
+# cache the imported subrepos for use by completions.
+COMPLETION_CACHE = "subrepo-completion-cache"
+# The name of the file (relative to the git directory) in which we
+# cache the results of scanning the history for imports.
+IMPORT_CACHE = "subrepo-import-cache"
+# The maximum number of history scan results kept in the import cache.
+IMPORT_CACHE_SIZE = 4
+# The environment variable pointing the command line client to the
+# socket of a server performing operations on its behalf.
+SERVER_SOCKET_ENV = "GIT_SUBREPO_SOCKET"
+# The commands a server performs on behalf of clients.
+SERVER_COMMANDS = ("import", "import-manifest", "reimport", "delete", "checkpoint", "tree")
+# The number of seconds a server waits for a client to send its request.
+SERVER_REQUEST_TIMEOUT = 30
+# The ref names we are willing to resolve without the help of git. Git
+# accepts a lot more but everything else is left for it to handle.
+REF_NAME_RE = compileRe(r"HEAD|refs/(?:[A-Za-z0-9_+-][A-Za-z0-9._+-]*/)*[A-Za-z0-9_+-][A-Za-z0-9._+-]*")
+# Refs (aside from HEAD) that are private to a worktree.
+WORKTREE_REFS = ("refs/bisect/", "refs/worktree/", "refs/rewritten/")
+# The maximum number of symbolic refs we follow, mirroring git.
+MAX_SYMREF_DEPTH = 5
+SHA1_RE = compileRe(rb"[0-9a-f]{40}")
+HEX_SHA1_RE = compileRe(r"[0-9a-f]{40}")
+# The git object types as encoded in pack files.
+PACK_OBJECT_TYPES = {1: "commit", 2: "tree", 3: "blob", 4: "tag"}
+PACK_OFS_DELTA = 6
+PACK_REF_DELTA = 7
+# The path of the commit-graph file relative to the objects directory.
+COMMIT_GRAPH = join("info", "commit-graph")
+# Special values of parent positions in commit-graph files.
+GRAPH_PARENT_NONE = 0x70000000
+GRAPH_EXTRA_EDGES = 0x80000000
+# The seeds of the two murmur3 hashes git derives the bit positions in
+# changed-path Bloom filters from.
+BLOOM_SEEDS = (0x293ae76f, 0x7e646e2c)
+# The number of (delta base) objects we keep unpacked.
+PACK_BASE_CACHE_SIZE = 64
+# The amount of compressed data we inflate at a time.
+INFLATE_CHUNK_SIZE = 16384
+# The date at the end of an identity line in a commit object, as in
+# "author Name <mail> 1577836800 +0100".
+IDENTITY_DATE_RE = compileRe(r"> (\d+) ([+-])(\d\d)(\d\d)$")
+# An entire identity, split into name, email, and date (in git's
+# internal format).
+IDENTITY_RE = compileRe(r"(.*) <(.*)> (\d+ [+-]\d{4})$")
+# The characters git considers whitespace when formatting subjects.
+WHITESPACE = " \t\n\r\v\f"
+# Bytes git quotes in file names when printing them (with core.quotePath
+# being enabled, which is the default).
+QUOTED_NAME_RE = compileRe(rb'[\x00-\x1f"\\\x7f-\xff]')
+# Settings in a repository's configuration that change the layout of or
+# the way git discovers the repository and that we do not support.
+UNSUPPORTED_CONFIG_RE = compileRe(rb"^\s*(?:\[extensions|bare\s*=\s*true|worktree\s*=)",
+                                  IGNORECASE | MULTILINE)
+# The configuration settings influencing how we create commits. Git
+# reports their names in lower case.
+CONFIG_R = r"^(commit\.gpgsign|subrepo\.manifest)$"
+# Environment variables influencing repository discovery or ref lookup.
+GIT_ENVIRONMENT = (
+  "GIT_CEILING_DIRECTORIES",
+  "GIT_ALTERNATE_OBJECT_DIRECTORIES",
+  "GIT_COMMON_DIR",
+  "GIT_DIR",
+  "GIT_DISCOVERY_ACROSS_FILESYSTEM",
+  "GIT_NAMESPACE",
+  "GIT_OBJECT_DIRECTORY",
+  "GIT_WORK_TREE",
+)
 
 
 class SubrepoError(RuntimeError):
@@ -131,6 +261,19 @@ class Subrepo(namedtuple("Subrepo", ["repo", "prefix"])):
     return REPO_STR.format(repo=self.repo, prefix=self.prefix)
 
 
+class Snapshot(namedtuple("Snapshot", ["head", "branch", "clean", "commits"])):
+  """A class representing the state of a repository as retrieved before an operation.
+
+    'head' is the SHA1 hash of HEAD (None if there is none), 'branch'
+    the name of the checked out branch (None if HEAD is detached or the
+    name is not known), 'clean' whether the index matches HEAD, and
+    'commits' maps (repo, commit) tuples to the SHA1 hash the commit
+    resolved to in the remote repository (None if it could not be
+    resolved).
+  """
+  pass
+
+
 def trail(path):
   """Ensure the path has a trailing separator."""
   return join(path, "")
@@ -144,12 +287,41 @@ def untrail(path):
     return path
 
 
+@lru_cache(maxsize=None)
+def _findCommand(name):
+  """Find the path to a command, caching the result."""
+  # Looking up a command involves a stat of each directory in PATH and
+  # so we only want to do that once per command. We also do not want to
+  # do it eagerly at import time, as it may not be required at all.
+  return findCommand(name)
+
+
+def _writeCacheFile(path, lines):
+  """Atomically replace a cache file with the given lines, ignoring failures."""
+  # We write into a temporary file first and then rename it, so that
+  # concurrent readers never see a partially written cache.
+  tmp_path = "%s.%d" % (path, getpid())
+  try:
+    with open(tmp_path, "w") as file_:
+      file_.write("\n".join(lines) + "\n")
+
+    replace(tmp_path, path)
+  except OSError:
+    # Failing to write a cache (e.g., because the repository is not
+    # writable for us) must not cause the operation to fail. We do not
+    # want to leave a stray temporary file behind, though.
+    try:
+      unlink(tmp_path)
+    except OSError:
+      pass
+
+
 def _git(root, *args):
   """Create a git command working in the given repository root."""
-  return [GIT, "-C", root] + list(args)
+  return [_findCommand("git"), "-C", root] + list(args)
 
 
-def _execute(*args, verbose):
+def _execute(*args, verbose, env=None, stdin=None):
   """Run a program, optionally print the full command."""
   if verbose:
     print(formatCommands(list(args)))
@@ -157,26 +329,34 @@ def _execute(*args, verbose):
   # We unconditionally read the stdout output. The overhead in our
   # context here is not much and we read stderr for error reporting
   # cases anyway.
-  out, _ = execute_(*args, stdout=b"")
+  out, _ = execute_(*args, env=env, stdin=stdin, stdout=b"")
   return out
 
 
-def _spring(commands, verbose):
+def _spring(commands, verbose, env=None):
   """Run a spring, optionally print the full command."""
   if verbose:
     print(formatCommands(commands))
 
-  return spring_(commands)
+  return spring_(commands, env=env)
 
 
 class GitExecutor:
   """A class for executing git commands."""
-  def __init__(self, root, verbose):
-    """Initialize an executor object in the given git repository root."""
+  def __init__(self, root, verbose, index_file=None):
+    """Initialize an executor object in the given git repository root.
+
+      If an index file is given, commands work on it instead of the
+      repository's index and never touch the working tree.
+    """
     assert abspath(root) == root, root
 
     self._root = root
     self._verbose = verbose
+    self._index_file = index_file
+    self._env = None
+    if index_file is not None:
+      self._env = dict(environ, GIT_INDEX_FILE=index_file)
 
 
   def _command(self, *args):
@@ -204,7 +384,12 @@ class GitExecutor:
     """Retrieve a git-diff-index command."""
     # Since we diff against an on-disk path, that will already act as
     # a prefix. So we pass in --no-prefix here.
-    return self._command("diff-index") + self._diffArgs(ROOT_PREFIX)
+    args = self._diffArgs(ROOT_PREFIX)
+    if self._index_file is not None:
+      # Without a working tree all we can diff against is the index.
+      args += ["--cached"]
+
+    return self._command("diff-index") + args
 
 
   def diffTreeCommand(self, prefix):
@@ -214,23 +399,37 @@ class GitExecutor:
 
   def applyCommand(self):
     """Retrieve a git-apply command."""
-    return self._command("apply", "-p0", "--binary", "--index", "--apply")
+    index = "--index" if self._index_file is None else "--cached"
+    return self._command("apply", "-p0", "--binary", index, "--apply")
+
 
+  def execute(self, *args, stdin=None, env=None):
+    """Execute a git command, optionally with additional environment variables."""
+    env_ = self._env
+    if env is not None:
+      env_ = dict(environ if self._env is None else self._env, **env)
 
-  def execute(self, *args):
-    """Execute a git command."""
-    return _execute(*self._command(*args), verbose=self._verbose)
+    return _execute(*self._command(*args), verbose=self._verbose, env=env_, stdin=stdin)
 
 
   def spring(self, commands):
     """Execute a git command spring."""
     # Note that currently there are no clients reading output from a
     # spring so this use-case is not supported.
-    return _spring(commands, verbose=self._verbose)
+    return _spring(commands, verbose=self._verbose, env=self._env)
+
+
+  def withIndex(self, index_file):
+    """Create an executor working on the given index file instead of the repository's index."""
+    return GitExecutor(self._root, self._verbose, index_file)
 
 
-  def springWithSafeApply(self, pipe_cmds):
-    """Create a spring comprising a pipeline of commands and running git-apply on the result."""
+  def springWithSafeApply(self, pipe_cmds, directory=None):
+    """Create a spring comprising a pipeline of commands and running git-apply on the result.
+
+      If a directory is given, it is prepended to all paths in the
+      patches (including those of renamed and copied files).
+    """
     # The idea here is: it is possible that a patch created by the given
     # pipeline of commands is empty. In such a case git-apply will fail,
     # which is undesired. We cannot work around this issue by catching
@@ -240,13 +439,26 @@ class GitExecutor:
     # name (without generating the actual file; and yes, we use a
     # deprecated function because that *is* the correct way and
     # deprecating it instead of educating people is simply wrong). We
-    # then tell git-apply to exclude this very file.
+    # then tell git-apply to exclude this very file. Note that the
+    # tempfile module is only imported here as it is comparably costly
+    # to load and not needed for most invocations (e.g., completions).
+    from tempfile import (
+      mktemp,
+    )
+
     file_ = basename(mktemp(prefix="null", dir=self._root))
+    apply = self.applyCommand()
+    if directory is not None:
+      # The exclusion is matched against paths with the directory
+      # prepended already.
+      apply += ["--directory=%s" % directory]
+      file_ = join(directory, file_)
+
     commands = [
       [
-        [ECHO, retrieveDummyPatch(file_)],
+        [_findCommand("echo"), retrieveDummyPatch(basename(file_))],
       ] + pipe_cmds,
-      self.applyCommand() + ["--exclude=%s" % file_],
+      apply + ["--exclude=%s" % file_],
     ]
     self.spring(commands)
 
@@ -257,6 +469,12 @@ class GitExecutor:
     return self._root
 
 
+  @property
+  def indexFile(self):
+    """Retrieve the private index file we work on, if any."""
+    return self._index_file
+
+
 def retrieveDummyPatch(file_):
   """Retrieve a dummy patch to stop git-apply from returning an error code on an empty diff."""
   return """\
@@ -304,24 +522,17 @@ def checkForGitRepo(function):
 @checkForGitRepo
 def completeRemoteRepo(parser, values, word):
   """Complete a remote repository."""
-  out, _ = execute_(GIT, "remote", stdout=b"")
-  remotes = out.decode().splitlines()
-
-  for remote in remotes:
-    if remote.startswith(word):
-      yield remote
+  out, _ = execute_(_findCommand("git"), "remote", stdout=b"")
+  remotes = CandidateIndex(out.decode().splitlines())
+  yield from remotes.match(word)
 
 
 @checkForGitRepo
 def completeImportedRepo(parser, values, word):
   """Complete an already imported repository."""
   importer = GitImporter()
-  if not importer._hasHead():
-    return
-
-  head = importer.resolveCommit("HEAD")
   # TODO: Need to check whether 'flat' should be true indeed.
-  remotes = importer._searchImportedSubrepos(head, flat=True)
+  remotes = importer.retrieveCompletionImports()
 
   for remote, _ in remotes:
     if remote.startswith(word):
@@ -339,12 +550,8 @@ def findImportedPrefixes(parser, values, word):
   # smoothly.
   namespace, _ = parser.parse_known_args(values + ["dummy"])
   importer = GitImporter()
-  if not importer._hasHead():
-    return
-
-  head = importer.resolveCommit("HEAD")
   # TODO: Need to check whether 'flat' should be true indeed.
-  remotes = importer._searchImportedSubrepos(head, flat=True)
+  remotes = importer.retrieveCompletionImports()
 
   for remote, prefix_ in remotes:
     # The reported prefix is relative to the git repository's root. We
@@ -397,22 +604,20 @@ def completeRemoteRefs(parser, values, word, remote_only=True):
   """Complete refs of a remote repository."""
   if remote_only:
     namespace, _ = parser.parse_known_args(values)
-    remote = getattr(namespace, "remote-repository")
+    pattern = "refs/remotes/%s/" % getattr(namespace, "remote-repository")
   else:
-    # Note that os.path.join simply ignores empty strings for as path
-    # components.
-    remote = ""
-
-  # We could also hack something together with "git branch --list -a
-  # <remote>/..." or the like but parsing the output gets really messy.
-  root = _retrieveRepositoryRoot()
-  refs = join(root, ".git", "refs", "remotes", remote)
-  for _, _, refs in walk(refs):
-    for ref in refs:
-      # Note that we might emit certain branches multiple times here if
-      # multiple repositories have ones with the same name.
-      if ref.startswith(word):
-        yield ref
+    pattern = "refs/remotes/"
+
+  # Refs may be stored in loose form or in the packed-refs file. Rather
+  # than dealing with both of them (and their precedence) ourselves we
+  # let git list them. By stripping the first three components we get
+  # rid of the refs/remotes/<remote>/ part.
+  out, _ = execute_(_findCommand("git"), "for-each-ref", "--format=%(refname:strip=3)",
+                    pattern, stdout=b"")
+  # Note that branches with the same name in multiple repositories are
+  # only reported once.
+  index = CandidateIndex(out.decode().splitlines())
+  yield from index.match(word)
 
 
 @checkForGitRepo
@@ -429,7 +634,8 @@ def addStandardArgs(parser):
   )
 
 
-def addOptionalArgs(parser, reimport=False, delete=False, tree=False):
+def addOptionalArgs(parser, reimport=False, delete=False, tree=False, fleet=False,
+                    checkpoint=False, maintenance=False, serve=False):
   """Add optional arguments to the argument parser."""
   parser.add_argument(
     "--debug-commands", action="store_true", default=False,
@@ -443,12 +649,13 @@ def addOptionalArgs(parser, reimport=False, delete=False, tree=False):
     help="In addition to the already provided error messages also print "
          "backtraces for encountered errors.",
   )
-  if not tree:
+  if not tree and not fleet and not maintenance and not serve:
     parser.add_argument(
       "-e", "--edit", action="store_true", default=False, dest="edit",
       help="Open up an editor to allow for editing the commit message.",
     )
-  if not reimport and not delete and not tree:
+  if not reimport and not delete and not tree and not checkpoint and\
+     not maintenance and not serve:
     parser.add_argument(
       "-f", "--force", action="store_true", default=False, dest="force",
       help="Force import of a subrepo at a given state even if the commit "
@@ -457,6 +664,22 @@ def addOptionalArgs(parser, reimport=False, delete=False, tree=False):
     )
 
 
+def addImportArgs(parser):
+  """Add the optional arguments shared by the import commands to the argument parser."""
+  parser.add_argument(
+    "--no-worktree", action="store_true", default=False, dest="no_worktree",
+    help="Build the new state in a private index and commit it on top of "
+         "HEAD without touching the working tree or the index. This "
+         "mode also works in bare repositories.",
+  )
+  parser.add_argument(
+    "--renames", action="store_true", default=False,
+    help="Update a subrepo whose files are unchanged since its previous "
+         "import using a patch with rename and copy detection. This "
+         "reduces the patch size if files were moved remotely.",
+  )
+
+
 def addImportParser(parser):
   """Add a parser for the 'import' command to another parser."""
   def completeImportPrefix(parser, values, word):
@@ -497,6 +720,28 @@ def addImportParser(parser):
   )
 
   optional = import_.add_argument_group("Optional arguments")
+  addImportArgs(optional)
+  addOptionalArgs(optional)
+  addStandardArgs(optional)
+
+
+def addImportManifestParser(parser):
+  """Add a parser for the 'import-manifest' command to another parser."""
+  import_ = parser.add_parser(
+    "import-manifest", add_help=False, formatter_class=SubLevelHelpFormatter,
+    help="Import all subrepos listed in a file in a single commit.",
+  )
+  import_.set_defaults(perform_command=performImportManifest)
+
+  required = import_.add_argument_group("Required arguments")
+  required.add_argument(
+    "manifest", action="store", metavar="file",
+    help="A file listing the subrepos to import, one "
+         "\"<remote-repository> <prefix> <commit>\" triple per line.",
+  )
+
+  optional = import_.add_argument_group("Optional arguments")
+  addImportArgs(optional)
   addOptionalArgs(optional)
   addStandardArgs(optional)
 
@@ -557,6 +802,19 @@ def addDeleteParser(parser):
   addStandardArgs(optional)
 
 
+def addCheckpointParser(parser):
+  """Add a parser for the 'checkpoint' command to another parser."""
+  checkpoint = parser.add_parser(
+    "checkpoint", add_help=False, formatter_class=SubLevelHelpFormatter,
+    help="Record the current state of imports in a commit.",
+  )
+  checkpoint.set_defaults(perform_command=performCheckpoint)
+
+  optional = checkpoint.add_argument_group("Optional arguments")
+  addOptionalArgs(optional, checkpoint=True)
+  addStandardArgs(optional)
+
+
 def addTreeParser(parser):
   """Add a parser for the 'tree' command to another parser."""
   tree = parser.add_parser(
@@ -570,8 +828,141 @@ def addTreeParser(parser):
   addStandardArgs(optional)
 
 
-def setupArgumentParser():
-  """Create and initialize an argument parser, ready for use."""
+def addMaintenanceParser(parser):
+  """Add a parser for the 'maintenance' command to another parser."""
+  maintenance = parser.add_parser(
+    "maintenance", add_help=False, formatter_class=SubLevelHelpFormatter,
+    help="Prepare the repository for fast subrepo operations.",
+  )
+  maintenance.set_defaults(perform_command=performMaintenance)
+
+  optional = maintenance.add_argument_group("Optional arguments")
+  optional.add_argument(
+    "--report", action="store_true", default=False,
+    help="Only report the state of the commit-graph and the caches "
+         "without updating them.",
+  )
+  addOptionalArgs(optional, maintenance=True)
+  addStandardArgs(optional)
+
+
+def addFleetParser(parser):
+  """Add a parser for the 'fleet' command to another parser."""
+  fleet = parser.add_parser(
+    "fleet", add_help=False, formatter_class=SubLevelHelpFormatter,
+    help="Import a subrepo into many repositories in parallel.",
+  )
+  fleet.set_defaults(perform_command=performFleet, repository=False)
+
+  required = fleet.add_argument_group("Required arguments")
+  required.add_argument(
+    "repositories", action="store",
+    help="A file listing the paths of the repositories to import into, "
+         "one per line. Use - to read the list from stdin.",
+  )
+  required.add_argument(
+    "remote-repository", action="store", completer=completeRemoteRepo,
+    help="The name of the remote repository to import. It must be known "
+         "to all repositories.",
+  )
+  required.add_argument(
+    "prefix", action="store",
+    help="The prefix where to import the subrepo, relative to the root "
+         "of each repository.",
+  )
+  required.add_argument(
+    "commit", action="store", completer=completeRemoteRefs,
+    help="A commit of the remote repository to import.",
+  )
+
+  optional = fleet.add_argument_group("Optional arguments")
+  optional.add_argument(
+    "-j", "--jobs", action="store", type=int, default=None,
+    help="The number of repositories to work on in parallel. Defaults to "
+         "the number of processors.",
+  )
+  optional.add_argument(
+    "--fetch", action="store_true", default=False,
+    help="Fetch the remote repository in each repository first.",
+  )
+  optional.add_argument(
+    "--status", action="store_true", default=False,
+    help="Do not import anything but only report whether each repository "
+         "has the subrepo imported at the given commit.",
+  )
+  addImportArgs(optional)
+  addOptionalArgs(optional, fleet=True)
+  addStandardArgs(optional)
+
+
+def addServeParser(parser):
+  """Add a parser for the 'serve' command to another parser."""
+  serve = parser.add_parser(
+    "serve", add_help=False, formatter_class=SubLevelHelpFormatter,
+    help="Perform subrepo operations requested over a Unix domain socket.",
+  )
+  serve.set_defaults(perform_command=performServe, repository=False)
+
+  required = serve.add_argument_group("Required arguments")
+  required.add_argument(
+    "socket", action="store",
+    help="The path of the Unix domain socket to listen on.",
+  )
+
+  optional = serve.add_argument_group("Optional arguments")
+  optional.add_argument(
+    "--timeout", action="store", type=float, default=None,
+    help="Terminate after not receiving a request for the given number "
+         "of seconds.",
+  )
+  addOptionalArgs(optional, serve=True)
+  addStandardArgs(optional)
+
+
+# A mapping from the name of a command to the function adding a parser
+# for it. Note that the order is significant, as it is reflected in the
+# help text.
+COMMANDS = {
+  "import": addImportParser,
+  "import-manifest": addImportManifestParser,
+  "reimport": addReimportParser,
+  "delete": addDeleteParser,
+  "checkpoint": addCheckpointParser,
+  "tree": addTreeParser,
+  "maintenance": addMaintenanceParser,
+  "fleet": addFleetParser,
+  "serve": addServeParser,
+}
+
+
+def findCommandName(args):
+  """Find the name of the command to be performed from the given arguments."""
+  try:
+    # If we are asked to perform a completion, the command (if any) is
+    # contained in the words preceding the one to complete.
+    index = args.index(COMPLETE_OPTION)
+    # The --_complete option's arguments are the index of the word to
+    # complete, the script name, and the words themselves.
+    index_, _, *words = args[index + 1:]
+    args = words[:int(index_) - 1]
+  except ValueError:
+    pass
+
+  # The top-level parser only knows options and no option takes an
+  # argument. Hence, the first non-option argument is the command.
+  for arg in args:
+    if not arg.startswith("-"):
+      return arg if arg in COMMANDS else None
+
+  return None
+
+
+def setupArgumentParser(command=None):
+  """Create and initialize an argument parser, ready for use.
+
+    If a command is given only the sub-parser for this command is
+    created, which is considerably cheaper than creating all of them.
+  """
   parser = ArgumentParser(prog="git-subrepo", add_help=False,
                           formatter_class=TopLevelHelpFormatter)
 
@@ -584,10 +975,10 @@ def setupArgumentParser():
   optional = parser.add_argument_group("Optional arguments")
   addStandardArgs(optional)
 
-  addImportParser(subparsers)
-  addReimportParser(subparsers)
-  addDeleteParser(subparsers)
-  addTreeParser(subparsers)
+  for name, addParser in COMMANDS.items():
+    if command is None or name == command:
+      addParser(subparsers)
+
   return parser
 
 
@@ -603,17 +994,25 @@ def importMessageForImports(imports, outer_prefix):
   # final import commit message to be somewhat consistent accross
   # multiple imports so we sort the entries by their final string
   # representation.
-  for subrepo, sha1 in imports.items():
-    # The prefix to embed in a commit message is comprised of the prefix
-    # we performed the import in and the prefix the original import
-    # happened in.
-    import_prefix = trail(normpath(join(outer_prefix, subrepo.prefix)))
-    message = importMessage(Subrepo(subrepo.repo, import_prefix), sha1)
+  for subrepo, sha1 in importDependencies(imports, outer_prefix):
+    message = importMessage(subrepo, sha1)
     insort(messages, message)
 
   return messages
 
 
+def importDependencies(imports, outer_prefix):
+  """Retrieve the subrepos pulled in by an import as list of (subrepo, sha1) tuples."""
+  dependencies = []
+  for subrepo, sha1 in imports.items():
+    # The prefix of a dependency is comprised of the prefix we performed
+    # the import in and the prefix the original import happened in.
+    import_prefix = trail(normpath(join(outer_prefix, subrepo.prefix)))
+    dependencies.append((Subrepo(subrepo.repo, import_prefix), sha1))
+
+  return dependencies
+
+
 def importMessageForCommit(subrepo, sha1, imports, space=True):
   """Craft a commit message for a subrepo import."""
   subject = importMessage(subrepo, sha1)
@@ -624,6 +1023,34 @@ def importMessageForCommit(subrepo, sha1, imports, space=True):
   return subject + ("\n\n" if space else "\n") + "\n".join(body)
 
 
+def importMessageForCommits(imports):
+  """Craft a commit message for the import of multiple subrepos given as (subrepo, sha1, imports) tuples."""
+  lines = []
+  for subrepo, sha1, imports_ in sorted(imports, key=lambda x: importMessage(x[0], x[1])):
+    lines.append(importMessage(subrepo, sha1))
+    lines += [" %s" % x for x in importMessageForImports(imports_, subrepo.prefix)]
+
+  return "\n".join([IMPORTS_MSG, ""] + lines)
+
+
+def importMessageGroups(message):
+  """Split a commit message into groups of lines, one per top-level import or deletion."""
+  lines = message.splitlines()
+  if not lines or lines[0] != IMPORTS_MSG:
+    return [message]
+
+  groups = []
+  for line in lines[1:]:
+    if line.startswith(" "):
+      # A dependency belongs to the import preceding it.
+      if groups:
+        groups[-1].append(line[1:])
+    elif line:
+      groups.append([line])
+
+  return ["\n".join(x) for x in groups]
+
+
 def deleteMessage(subrepo):
   """Retrieve a commit message for a subrepo deletion."""
   return DELETE_MSG.format(prefix=subrepo.prefix, repo=subrepo.repo)
@@ -657,174 +1084,1365 @@ def deleteMessageForCommit(subrepo, dependencies, space=True):
   return subject + ("\n\n" if space else "\n") + "\n".join(body)
 
 
-def _retrieveRepositoryRoot(print_commands=False):
-  """Retrieve the root directory of the current git repository."""
-  # This function does not invoke git with the "-C" parameter because it
-  # is the one that retrieves the argument to use with it.
-  out = _execute(GIT, "rev-parse", "--show-toplevel", verbose=print_commands)
-  return out[:-1].decode("utf-8")
+def manifestForImports(imports):
+  """Craft the content of a manifest file for the given tree of imports."""
+  def line(subrepo, sha1):
+    """Format a single import."""
+    return "%s %s" % (subrepo, sha1)
+
+  lines = [MANIFEST_HEADER]
+  # Just like the lines of commit messages, those of the manifest are
+  # sorted, so that the file is stable across imports and the changes
+  # made on different branches are likely to merge cleanly.
+  for subrepo, (sha1, dependencies) in sorted(imports.items(), key=lambda x: str(x[0])):
+    lines.append(line(subrepo, sha1))
+    lines += sorted(" %s" % line(*x) for x in dependencies)
+
+  return "\n".join(lines) + "\n"
+
+
+def parseManifest(data):
+  """Parse the content of a manifest file into a tree of imports, return None if it is malformed."""
+  imports = {}
+  dependencies = None
+  for line in data.splitlines():
+    if not line or line.startswith("#"):
+      continue
+
+    match = MANIFEST_LINE_RE.fullmatch(line)
+    if match is None:
+      return None
+
+    indent, prefix, repo, sha1 = match.groups()
+    if not indent:
+      dependencies = []
+      imports[Subrepo(repo, prefix)] = (sha1, dependencies)
+    elif dependencies is not None:
+      dependencies.append((Subrepo(repo, prefix), sha1))
+    else:
+      return None
 
+  return imports
 
-class GitImporter:
-  """A class handling subrepo imports."""
-  def __init__(self, debug_commands=False):
-    """Initialize the git subrepo importer object."""
-    root = _retrieveRepositoryRoot(debug_commands)
-    self._git = GitExecutor(root, debug_commands)
 
+def checkpointMessage(imports):
+  """Craft the message of a checkpoint commit for the given tree of imports."""
+  # The manifest's header would be stripped as a comment by git.
+  body = manifestForImports(imports).splitlines()[1:]
+  return "\n".join([CHECKPOINT_MSG, ""] + body)
 
-  def resolveCommit(self, commit):
-    """Resolve a commit into a SHA1 hash."""
-    out = self._git.execute("rev-parse", "--verify", "%s^{commit}" % commit)
-    return out.decode("utf-8")[:-1]
 
+def _readFile(path):
+  """Read the content of a file, return None if it cannot be read."""
+  try:
+    with open(path, "rb") as file_:
+      return file_.read()
+  except OSError:
+    return None
+
+
+class GitRefStore:
+  """A reader for the refs of a git repository not requiring git to be run.
+
+    Most of the time, resolving a ref boils down to reading a file or
+    two and so forking git for it is wasteful. Objects of this class
+    resolve refs by reading loose ref files and searching the
+    packed-refs file directly. Whenever something unusual is
+    encountered, no answer is provided and clients are expected to
+    ask git instead. Note that refs are not peeled, unless the
+    packed-refs file contains the peeled value, i.e., clients should
+    only resolve refs known to reference commits.
+  """
+  def __init__(self, root, git_dir, common_dir):
+    """Initialize the ref store of a repository."""
+    self._root = root
+    self._git_dir = git_dir
+    self._common_dir = common_dir
+    self._packed_refs = None
 
-  def resolveRemoteCommit(self, repo, commit):
-    """Resolve a potentially symbolic commit name in a remote repository to a SHA1 hash.
 
-      Note that there no guarantee is provided that the given commit
-      (which may be a symbolic name), truly belongs to the given remote
-      repository. Further checks are required to enforce this constraint
-      on the client side.
-    """
-    try:
-      to_import = "refs/remotes/%s/%s" % (repo, commit)
-      return self.resolveCommit(to_import)
-    except ProcessError as e:
-      # If we already got supplied a SHA1 hash the above command will fail
-      # because we prefixed the hash with the repository, which git will
-      # not understand. In such a case we want to make sure we are really
-      # dealing with the SHA1 hash (and not something else we do not know
-      # how to handle correctly) and ask git to parse it again.
-      try:
-        return self.resolveCommit(commit)
-      except ProcessError:
-        raise e
+  @staticmethod
+  def _isGitDir(path):
+    """Check whether a directory looks like a git directory."""
+    return isfile(join(path, "HEAD")) and isdir(join(path, "refs"))
 
 
-  def belongsToRepository(self, repo, sha1):
-    """Check whether a given commit belongs to a remote repository."""
-    def countRemoteCommits(*args):
-      """Count the number of reachable commits in a remote repository."""
-      out = self._git.execute("rev-list", "--count", "--remotes=%s" % repo, *args)
-      return int(out[:-1].decode("utf-8"))
+  @classmethod
+  def _readGitFile(cls, path):
+    """Read a .git file and retrieve the git directory it references."""
+    content = _readFile(path)
+    if content is None or not content.startswith(b"gitdir: "):
+      return None
 
-    # It is tougher than anticipated to simply find out whether a given
-    # commit belongs to a given remote repository or not. The approach
-    # chosen here is to count the number of reachable commits in a remote
-    # repository with and without the given commit. If there is a
-    # difference in commit count then we deduce that the commit is indeed
-    # part of this repository. A potentially simpler approach is to do a
-    # git-rev-list showing all commits and then "grep" for the commit of
-    # interest. The problem with this approach is that either we need to
-    # read a potentially huge list of commits into a Python string or we
-    # have a dependency to the 'grep' program -- neither of which is
-    # deemed acceptable.
-    including = countRemoteCommits()
-    excluding = countRemoteCommits("^%s" % sha1)
-    # We excluded a single commit but it might be the parent of others
-    # that now are also not listed. So every difference greater zero
-    # indicates that the commit is indeed part of the repository.
-    return including - excluding > 0
+    git_dir = normpath(join(dirname(path), content[8:].rstrip(b"\n").decode("utf-8")))
+    return git_dir if isdir(git_dir) else None
 
 
-  def hasCachedChanges(self):
-    """Check if the repository has changes."""
-    try:
-      # When using the --exit-code option the command will return 1 (i.e.,
-      # cause an exception to be raised) in case there are changes and 0
-      # otherwise.
-      # Note that we cannot safely use git-diff-index or git-diff-tree
-      # here because we cannot guarantee that a HEAD exists (and those
-      # commands require some form of tree-ish or commit to be provided).
-      self._git.execute("diff", "--cached", "--no-patch", "--exit-code", "--quiet")
-      return False
-    except ProcessError:
-      return True
+  @classmethod
+  def discover(cls, path=None):
+    """Discover the repository the given directory (or the current working directory) belongs to.
+
+      None is returned if no repository was found or the repository has
+      properties that we do not support.
+    """
+    if any(x in environ for x in GIT_ENVIRONMENT):
+      return None
+
+    path = getcwd() if path is None else abspath(path)
+    while True:
+      if cls._isGitDir(path):
+        # We are inside of a git directory (or a bare repository), in
+        # which case there is no working tree.
+        return None
+
+      dot_git = join(path, ".git")
+      if isdir(dot_git):
+        git_dir = dot_git
+        break
+      elif isfile(dot_git):
+        git_dir = cls._readGitFile(dot_git)
+        if git_dir is None:
+          return None
+        break
+
+      parent = dirname(path)
+      if parent == path:
+        return None
+      path = parent
+
+    # Linked worktrees share most of their state with the main
+    # repository, which is referenced by the commondir file.
+    common_dir = _readFile(join(git_dir, "commondir"))
+    if common_dir is not None:
+      common_dir = normpath(join(git_dir, common_dir.rstrip(b"\n").decode("utf-8")))
+    else:
+      common_dir = git_dir
 
+    if not isfile(join(git_dir, "HEAD")) or not cls._isGitDir(common_dir):
+      return None
 
-  @staticmethod
-  def removeSubsumedFiles(files):
-    """Remove files that are subsumed by directories."""
-    if len(files) <= 1:
-      return files
+    try:
+      # Git refuses to work with repositories owned by somebody else
+      # unless configured otherwise. We leave this check to git.
+      if stat(git_dir).st_uid != geteuid():
+        return None
+    except OSError:
+      return None
 
-    # We work on a sorted list of files. This way we are sure that
-    # directories potentially subsuming files appear before said files.
-    files = sorted(files)
-    subsumer, *files = files
+    config = _readFile(join(common_dir, "config"))
+    if config is None or UNSUPPORTED_CONFIG_RE.search(config):
+      return None
 
-    new_files = [subsumer]
-    subsumer = trail(subsumer)
+    return cls(path, git_dir, common_dir)
 
-    for file_ in files:
-      # Find the longest string both paths have in common. Note that
-      # commonprefix really operates on a string/character level. It has
-      # no knowledge of paths and path components. For that reason we need
-      # some more checks below to not detect a subsumes relationship where
-      # there is none. Consider for example the paths
-      #   foo/bar
-      #   foo/barbaz
-      # where foo/bar is a common prefix of foo/barbaz on a string-level
-      # but not on a path-level.
-      prefix = commonprefix([file_, subsumer])
-      if prefix == subsumer:
-        # We determined that the given file could indeed be subsumed by
-        # 'subsumer'. However, we need to rule out false positives caused
-        # by working on a string level as opposed on a path level by
-        # checking the determined prefix does not lie in the middle of
-        # file_'s path. Note that usage of commonpath (available starting
-        # from Python 3.5) instead of commonprefix above would relieve us
-        # from these additional checks.
-        length = len(prefix)
-        is_file = length < len(file_) and file_[length - 1] == sep
-        is_same = length == len(file_)
 
-        if is_file or is_same:
-          continue
+  def _retrievePackedRefs(self):
+    """Retrieve a memory map of the packed-refs file, or None if it is not sorted."""
+    path = join(self._common_dir, "packed-refs")
+    try:
+      # The file is replaced whenever refs get packed. We may be long
+      # running (e.g., as a completion server) and so have to make sure
+      # to notice that.
+      info = stat(path)
+      key = (info.st_ino, info.st_size, info.st_mtime_ns)
+    except OSError:
+      return b""
+
+    if self._packed_refs is None or self._packed_refs[0] != key:
+      try:
+        with open(path, "rb") as file_:
+          data = mmap(file_.fileno(), 0, access=ACCESS_READ)
+      except (OSError, ValueError):
+        # Note that an empty file cannot be mapped.
+        data = b""
 
-      new_files += [file_]
-      subsumer = trail(file_)
+      header = data[:data.find(b"\n") + 1]
+      # We can only perform a binary search on sorted packed refs. Those
+      # not known to be sorted are rare and we leave them to git.
+      if data and (not header.startswith(b"# pack-refs with:") or b" sorted" not in header):
+        data = None
 
-    return new_files
+      self._packed_refs = (key, data, len(header))
 
+    return self._packed_refs[1]
 
-  def _diffAwayFiles(self, files):
-    """Create a git command pipeline for removing a set of files/directories."""
-    def diffAwayFile(file_):
-      """If a file object exists, create a git command for creating a patch to remove it."""
-      # Note that we deliberately choose to perform the weakest check
-      # possible here to detect presence of the given file/directory (that
-      # is, we just check if it exists at all, not if we have write access
-      # etc.). We let git handle the rest.
-      if lexists(join(self.root, file_)):
-        return [git_diff_index + ["-R", empty_tree, "--", file_]]
+
+  @staticmethod
+  def _parsePackedRef(data, start):
+    """Parse the packed ref starting at the given offset, return a (ref, sha1, next) tuple."""
+    def lineEnd(start):
+      """Find the end of the line starting at the given offset."""
+      end = data.find(b"\n", start)
+      return end if end >= 0 else len(data)
+
+    end = lineEnd(start)
+    sha1 = data[start:start + 40]
+    next_ = end + 1
+    if data[next_:next_ + 1] == b"^":
+      # The ref references a tag and the following line contains the
+      # peeled value, i.e., the commit the tag references.
+      peeled_end = lineEnd(next_)
+      sha1 = data[next_ + 1:peeled_end]
+      next_ = peeled_end + 1
+
+    return data[start + 41:end], sha1, next_
+
+
+  def _seekPackedRefs(self, data, name):
+    """Find the offset of the first packed ref not sorting before the given name."""
+    lo = self._packed_refs[2]
+    hi = len(data)
+
+    while lo < hi:
+      mid = (lo + hi) // 2
+      start = data.rfind(b"\n", 0, mid) + 1
+      if data[start:start + 1] == b"^":
+        # We hit the line containing the peeled value of a tag. The ref
+        # it belongs to is on the previous line.
+        start = data.rfind(b"\n", 0, start - 1) + 1
+
+      ref, _, next_ = self._parsePackedRef(data, start)
+      if ref < name:
+        lo = next_
       else:
-        return []
+        hi = start
 
-    commands = []
-    empty_tree = self._retrieveEmptyTree()
-    git_diff_index = self._git.diffIndexCommand()
+    return lo
 
-    for file_ in files:
-      commands += diffAwayFile(file_)
 
-    return commands
+  def _searchPackedRefs(self, name):
+    """Search the packed-refs file for the given ref, return its (peeled) SHA1 hash or None."""
+    data = self._retrievePackedRefs()
+    if not data:
+      return None
 
+    name = name.encode("utf-8")
+    offset = self._seekPackedRefs(data, name)
+    if offset < len(data):
+      ref, sha1, _ = self._parsePackedRef(data, offset)
+      if ref == name and SHA1_RE.fullmatch(sha1):
+        return sha1.decode("utf-8")
 
-  def import_(self, subrepo, sha1):
-    """Import a remote repository at a given commit at a given prefix."""
-    assert trail(subrepo.prefix) == subrepo.prefix, subrepo.prefix
-    assert self.resolveRemoteCommit(subrepo.repo, sha1) == sha1, sha1
+    return None
 
-    pipe_cmds = []
-    empty_tree = self._retrieveEmptyTree()
-    remote_tree = "%s^{tree}" % sha1
 
-    git_diff_tree = self._git.diffTreeCommand(subrepo.prefix)
-    files = self._readCommitFiles(sha1, subrepo.prefix)
+  def listRefs(self, prefix):
+    """List the names of all refs starting with the given prefix (which has to end in a slash).
 
-    # If we can find a subrepo import commit for the same repository at
+      None is returned if the refs could not be listed.
+    """
+    assert prefix.startswith("refs/") and prefix.endswith("/"), prefix
+    if prefix.startswith(WORKTREE_REFS) or not REF_NAME_RE.fullmatch(prefix[:-1]):
+      return None
+
+    data = self._retrievePackedRefs()
+    if data is None:
+      return None
+
+    refs = set()
+    if data:
+      encoded = prefix.encode("utf-8")
+      offset = self._seekPackedRefs(data, encoded)
+      while offset < len(data):
+        ref, _, offset = self._parsePackedRef(data, offset)
+        if not ref.startswith(encoded):
+          break
+        refs.add(ref.decode("utf-8"))
+
+    for directory, _, files in walk(join(self._common_dir, prefix)):
+      directory = relpath(directory, self._common_dir).replace(sep, "/")
+      for file_ in files:
+        if not file_.endswith(".lock"):
+          refs.add("%s/%s" % (directory, file_))
+
+    if not all(REF_NAME_RE.fullmatch(x) for x in refs):
+      return None
+
+    return sorted(refs)
+
+
+  def resolve(self, name):
+    """Resolve a ref (e.g., HEAD or refs/remotes/origin/master) to a SHA1 hash.
+
+      None is returned if the ref does not exist or could not be
+      resolved for other reasons.
+    """
+    for _ in range(MAX_SYMREF_DEPTH):
+      if not REF_NAME_RE.fullmatch(name) or name.endswith(".lock"):
+        return None
+
+      if name == "HEAD" or name.startswith(WORKTREE_REFS):
+        directory = self._git_dir
+      else:
+        directory = self._common_dir
+
+      content = _readFile(join(directory, name))
+      if content is None:
+        return self._searchPackedRefs(name)
+
+      content = content.rstrip(b"\n")
+      if content.startswith(b"ref: "):
+        name = content[5:].decode("utf-8")
+      elif SHA1_RE.fullmatch(content):
+        return content.decode("utf-8")
+      else:
+        return None
+
+    return None
+
+
+  @property
+  def root(self):
+    """Retrieve the root directory of the repository's working tree."""
+    return self._root
+
+
+  @property
+  def gitDir(self):
+    """Retrieve the git directory of the repository."""
+    return self._git_dir
+
+
+  @property
+  def commonDir(self):
+    """Retrieve the git directory shared by all worktrees of the repository."""
+    return self._common_dir
+
+
+def _mapFile(path):
+  """Map a file into memory."""
+  with open(path, "rb") as file_:
+    return mmap(file_.fileno(), 0, access=ACCESS_READ)
+
+
+def _inflate(data, offset, size):
+  """Inflate the zlib stream starting at the given offset of a buffer."""
+  # We do not know the length of the compressed data. Handing the entire
+  # remainder of a (potentially huge) pack file to zlib would cause it to
+  # be copied, though, so we inflate chunk by chunk.
+  view = memoryview(data)
+  decompressor = decompressobj()
+  chunks = []
+  try:
+    while not decompressor.eof:
+      chunk = view[offset:offset + INFLATE_CHUNK_SIZE]
+      if not chunk:
+        raise ValueError("Unexpected end of compressed data")
+
+      chunks.append(decompressor.decompress(chunk))
+      offset += len(chunk)
+  finally:
+    view.release()
+
+  result = b"".join(chunks)
+  if len(result) != size:
+    raise ValueError("Inflated object has unexpected size")
+  return result
+
+
+def _readDeltaSize(delta, pos):
+  """Read a size from a delta's header."""
+  size = 0
+  shift = 0
+  while True:
+    c = delta[pos]
+    pos += 1
+    size |= (c & 0x7f) << shift
+    shift += 7
+    if not c & 0x80:
+      return size, pos
+
+
+def _applyDelta(base, delta):
+  """Apply a git delta to a base object."""
+  base_size, pos = _readDeltaSize(delta, 0)
+  result_size, pos = _readDeltaSize(delta, pos)
+  if len(base) != base_size:
+    raise ValueError("Delta base has unexpected size")
+
+  result = bytearray()
+  while pos < len(delta):
+    c = delta[pos]
+    pos += 1
+    if c & 0x80:
+      # Copy a range of the base object. The bits of the opcode
+      # determine which bytes of offset and size are present.
+      offset = 0
+      size = 0
+      for i in range(4):
+        if c & (1 << i):
+          offset |= delta[pos] << (8 * i)
+          pos += 1
+      for i in range(3):
+        if c & (0x10 << i):
+          size |= delta[pos] << (8 * i)
+          pos += 1
+
+      result += base[offset:offset + (size or 0x10000)]
+    elif c:
+      # Insert data contained in the delta itself.
+      result += delta[pos:pos + c]
+      pos += c
+    else:
+      raise ValueError("Invalid delta opcode")
+
+  if len(result) != result_size:
+    raise ValueError("Delta result has unexpected size")
+  return bytes(result)
+
+
+def _searchSha1Table(data, fanout, table, sha1):
+  """Search a sorted table of binary SHA1 hashes with a fanout table, return the index of the given hash or None."""
+  first = sha1[0]
+  lo = fanout[first - 1] if first > 0 else 0
+  hi = fanout[first]
+
+  while lo < hi:
+    mid = (lo + hi) // 2
+    start = table + mid * 20
+    name = data[start:start + 20]
+    if name == sha1:
+      return mid
+    elif name < sha1:
+      lo = mid + 1
+    else:
+      hi = mid
+
+  return None
+
+
+class _Pack:
+  """A pack file along with its (version 2) index."""
+  def __init__(self, path):
+    """Map the index and pack file with the given path (without extension)."""
+    self._index = _mapFile("%s.idx" % path)
+    if self._index[0:8] != b"\377tOc\x00\x00\x00\x02":
+      raise ValueError("Unsupported pack index")
+
+    self._pack = _mapFile("%s.pack" % path)
+    if self._pack[0:4] != b"PACK":
+      raise ValueError("Invalid pack file")
+
+    self._fanout = unpack_from(">256I", self._index, 8)
+    self._count = self._fanout[255]
+
+
+  def find(self, sha1):
+    """Find the offset of an object (given as binary SHA1 hash) in the pack file."""
+    names = 8 + 256 * 4
+    index = _searchSha1Table(self._index, self._fanout, names, sha1)
+    if index is None:
+      return None
+
+    offsets = names + self._count * 24
+    offset, = unpack_from(">I", self._index, offsets + index * 4)
+    if offset & 0x80000000:
+      # The offset is stored in the table of large offsets.
+      large = offsets + self._count * 4 + (offset & 0x7fffffff) * 8
+      offset, = unpack_from(">Q", self._index, large)
+
+    return offset
+
+
+  def entry(self, offset):
+    """Read the entry at the given offset, return a (type, data, base) tuple.
+
+      For deltified objects the base is either an offset or a binary
+      SHA1 hash, for all others it is None.
+    """
+    pack = self._pack
+    start = offset
+    c = pack[offset]
+    offset += 1
+    type_ = (c >> 4) & 7
+    size = c & 0x0f
+    shift = 4
+    while c & 0x80:
+      c = pack[offset]
+      offset += 1
+      size |= (c & 0x7f) << shift
+      shift += 7
+
+    base = None
+    if type_ == PACK_OFS_DELTA:
+      c = pack[offset]
+      offset += 1
+      distance = c & 0x7f
+      while c & 0x80:
+        c = pack[offset]
+        offset += 1
+        distance = ((distance + 1) << 7) | (c & 0x7f)
+      base = start - distance
+    elif type_ == PACK_REF_DELTA:
+      base = pack[offset:offset + 20]
+      offset += 20
+    elif type_ not in PACK_OBJECT_TYPES:
+      raise ValueError("Invalid pack object type")
+
+    return type_, _inflate(pack, offset, size), base
+
+
+class GitObjectStore:
+  """A reader for the objects of a git repository not requiring git to be run.
+
+    Objects are read from memory mapped pack files (resolving deltas
+    along the way) and from loose object files. Objects that cannot be
+    found (e.g., because they live in an alternate object store) or
+    read are not reported and clients are expected to ask git instead.
+  """
+  def __init__(self, objects_dir):
+    """Initialize the object store for the given objects directory."""
+    self._objects_dir = objects_dir
+    self._packs = None
+    # Resolving a delta chain requires all objects in it to be unpacked.
+    # Objects in a history are often deltified against the same bases
+    # and so we keep the most recently used ones around.
+    self._unpackBase = lru_cache(maxsize=PACK_BASE_CACHE_SIZE)(self._unpack)
+
+
+  def _retrievePacks(self, refresh=False):
+    """Retrieve all the packs in the object store."""
+    if self._packs is None or refresh:
+      directory = join(self._objects_dir, "pack")
+      try:
+        names = sorted(x[:-4] for x in listdir(directory) if x.endswith(".idx"))
+      except OSError:
+        names = []
+
+      packs = []
+      for name in names:
+        try:
+          packs.append(_Pack(join(directory, name)))
+        except (OSError, ValueError):
+          # Unsupported or broken packs are ignored and the objects in
+          # them left to git to read.
+          pass
+
+      self._packs = packs
+      self._unpackBase.cache_clear()
+
+    return self._packs
+
+
+  def _unpack(self, pack, offset):
+    """Unpack the object at the given offset in a pack, return a (type, data) tuple."""
+    type_, data, base = pack.entry(offset)
+    if type_ == PACK_OFS_DELTA:
+      type_, base = self._unpackBase(pack, base)
+    elif type_ == PACK_REF_DELTA:
+      object_ = self._readBinary(base, self._unpackBase, refresh=False)
+      if object_ is None:
+        raise ValueError("Delta base not found")
+      type_, base = object_
+    else:
+      return PACK_OBJECT_TYPES[type_], data
+
+    return type_, _applyDelta(base, data)
+
+
+  def _readLoose(self, sha1):
+    """Read a loose object, return a (type, data) tuple or None."""
+    content = _readFile(join(self._objects_dir, sha1[:2], sha1[2:]))
+    if content is None:
+      return None
+
+    content = decompress(content)
+    header, _, data = content.partition(b"\0")
+    type_, size = header.decode("ascii").split(" ")
+    if int(size) != len(data):
+      raise ValueError("Loose object has unexpected size")
+
+    return type_, data
+
+
+  def _readBinary(self, sha1, unpack, refresh=True):
+    """Read an object given as binary SHA1 hash, using the given function for unpacking."""
+    for refresh_ in (False, True) if refresh else (False,):
+      # Objects may have been packed (and their loose counterparts
+      # removed) since we looked at the packs and so we retry once with
+      # a fresh list of packs.
+      for pack in self._retrievePacks(refresh_):
+        offset = pack.find(sha1)
+        if offset is not None:
+          return unpack(pack, offset)
+
+      object_ = self._readLoose(sha1.hex())
+      if object_ is not None:
+        return object_
+
+    return None
+
+
+  def read(self, sha1):
+    """Read an object, return a (type, data) tuple or None if it could not be read."""
+    try:
+      return self._readBinary(bytes.fromhex(sha1), self._unpack)
+    except (IndexError, OSError, ValueError, ZlibError):
+      return None
+
+
+def _murmur3(seed, data):
+  """Compute the 32 bit murmur3 hash of some data, the way git does for its Bloom filters."""
+  def rotate(value, count):
+    """Rotate a 32 bit value to the left."""
+    return ((value << count) | (value >> (32 - count))) & 0xffffffff
+
+  def scramble(value):
+    """Scramble a block of data."""
+    value = (value * 0xcc9e2d51) & 0xffffffff
+    return (rotate(value, 15) * 0x1b873593) & 0xffffffff
+
+  hash_ = seed
+  end = len(data) - len(data) % 4
+  for i in range(0, end, 4):
+    hash_ ^= scramble(int.from_bytes(data[i:i + 4], "little"))
+    hash_ = (rotate(hash_, 13) * 5 + 0xe6546b64) & 0xffffffff
+
+  if end < len(data):
+    hash_ ^= scramble(int.from_bytes(data[end:], "little"))
+
+  hash_ ^= len(data)
+  hash_ ^= hash_ >> 16
+  hash_ = (hash_ * 0x85ebca6b) & 0xffffffff
+  hash_ ^= hash_ >> 13
+  hash_ = (hash_ * 0xc2b2ae35) & 0xffffffff
+  return hash_ ^ (hash_ >> 16)
+
+
+class _CommitGraph:
+  """A (non-split) commit-graph file."""
+  def __init__(self, path):
+    """Map the commit-graph file with the given path."""
+    self._data = _mapFile(path)
+    # We support version 1 of the format with SHA1 hashes and without
+    # base graphs.
+    if self._data[0:6] != b"CGPH\x01\x01" or self._data[7] != 0:
+      raise ValueError("Unsupported commit-graph file")
+
+    chunks = {}
+    for i in range(self._data[6]):
+      id_, offset = unpack_from(">4sQ", self._data, 8 + i * 12)
+      chunks[id_] = offset
+
+    self._chunks = chunks
+
+    self._fanout = unpack_from(">256I", self._data, chunks[b"OIDF"])
+    self._oids = chunks[b"OIDL"]
+    self._commits = chunks[b"CDAT"]
+    self._edges = chunks.get(b"EDGE")
+    self._bloom_index = chunks.get(b"BIDX")
+    self._bloom_data = chunks.get(b"BDAT")
+    # Commit-graph files written by ancient versions of git do not
+    # contain generation numbers.
+    if self._fanout[255] > 0 and self.commit(0)[1] == 0:
+      raise ValueError("Commit-graph file lacks generation numbers")
+
+
+  @property
+  def count(self):
+    """Retrieve the number of commits in the graph."""
+    return self._fanout[255]
+
+
+  @property
+  def hasBloomFilters(self):
+    """Check whether the graph contains changed-path Bloom filters."""
+    return self._bloom_index is not None and self._bloom_data is not None
+
+
+  @property
+  def bloomSettings(self):
+    """Retrieve the hash version and the number of hashes of the changed-path Bloom filters."""
+    version, hashes = unpack_from(">II", self._data, self._bloom_data)
+    return version, hashes
+
+
+  def bloomFilter(self, position):
+    """Retrieve the changed-path Bloom filter of the commit at the given position."""
+    # The index contains the offset of the end of each commit's filter
+    # in the data chunk, which starts with a 12 byte header.
+    end, = unpack_from(">I", self._data, self._bloom_index + position * 4)
+    start = 0
+    if position > 0:
+      start, = unpack_from(">I", self._data, self._bloom_index + (position - 1) * 4)
+
+    base = self._bloom_data + 12
+    return self._data[base + start:base + end]
+
+
+  def find(self, sha1):
+    """Find the position of a commit (given as binary SHA1 hash) in the graph."""
+    return _searchSha1Table(self._data, self._fanout, self._oids, sha1)
+
+
+  def sha1(self, position):
+    """Retrieve the binary SHA1 hash of the commit at the given position."""
+    start = self._oids + position * 20
+    return self._data[start:start + 20]
+
+
+  def commit(self, position):
+    """Retrieve the commit at the given position as (parents, generation, date) tuple."""
+    parent1, parent2, high, low = unpack_from(">20xIIII", self._data, self._commits + position * 36)
+    parents = []
+    if parent1 != GRAPH_PARENT_NONE:
+      parents.append(parent1)
+
+    if parent2 & GRAPH_EXTRA_EDGES:
+      # Octopus merges have their second and all further parents stored
+      # in the list of extra edges.
+      index = parent2 & ~GRAPH_EXTRA_EDGES
+      while True:
+        edge, = unpack_from(">I", self._data, self._edges + index * 4)
+        parents.append(edge & ~GRAPH_EXTRA_EDGES)
+        if edge & GRAPH_EXTRA_EDGES:
+          break
+        index += 1
+    elif parent2 != GRAPH_PARENT_NONE:
+      parents.append(parent2)
+
+    # The generation number is the commit's topological level.
+    return parents, high >> 2, ((high & 0x3) << 32) | low
+
+
+class GitHistory:
+  """A walker of the commit history of a repository based on its commit-graph file.
+
+    The commit-graph file contains the parents, the commit date, and the
+    generation number of each commit. Generation numbers allow for
+    answering reachability questions without walking the entire
+    history. Commits not (yet) contained in the commit-graph file are
+    read from the object store. Whenever a commit cannot be found a
+    LookupError is raised and clients are expected to ask git instead.
+  """
+  def __init__(self, graph, objects):
+    """Initialize the walker with a commit graph and an object store."""
+    self._graph = graph
+    self._objects = objects
+    # A mapping from SHA1 hashes to (parents, generation, date) tuples.
+    self._commits = {}
+
+
+  @classmethod
+  def open(cls, objects_dir, objects):
+    """Open the history of the given objects directory, return None if there is no usable commit-graph."""
+    try:
+      graph = _CommitGraph(join(objects_dir, COMMIT_GRAPH))
+    except (KeyError, OSError, StructError, ValueError):
+      return None
+
+    return cls(graph, objects)
+
+
+  @property
+  def graph(self):
+    """Retrieve the commit-graph the history is based on."""
+    return self._graph
+
+
+  def _readCommit(self, sha1):
+    """Read the parents and the commit date of a commit from the object store."""
+    object_ = self._objects.read(sha1)
+    if object_ is None or object_[0] != "commit":
+      raise LookupError(sha1)
+
+    header, _, _ = object_[1].partition(b"\n\n")
+    parents = []
+    date = 0
+    for line in header.split(b"\n"):
+      if line.startswith(b"parent "):
+        parents.append(line[7:].decode("ascii"))
+      elif line.startswith(b"committer "):
+        match = IDENTITY_DATE_RE.search(line.decode("utf-8", "replace"))
+        date = int(match.group(1)) if match is not None else 0
+
+    return parents, date
+
+
+  def _commit(self, sha1):
+    """Retrieve a commit as (parents, generation, date) tuple."""
+    commit = self._commits.get(sha1)
+    if commit is not None:
+      return commit
+
+    # The generation number of a commit not in the graph depends on
+    # those of its parents. We determine them in a depth first manner
+    # without recursion, as histories may be deep.
+    read = {}
+    stack = [sha1]
+    while stack:
+      current = stack[-1]
+      if current in self._commits:
+        stack.pop()
+        continue
+
+      position = self._graph.find(bytes.fromhex(current))
+      if position is not None:
+        parents, generation, date = self._graph.commit(position)
+        parents = [self._graph.sha1(x).hex() for x in parents]
+        self._commits[current] = (parents, generation, date)
+        stack.pop()
+        continue
+
+      if current not in read:
+        read[current] = self._readCommit(current)
+
+      parents, date = read[current]
+      missing = [x for x in parents if x not in self._commits]
+      if missing:
+        stack += missing
+        continue
+
+      generation = 1 + max((self._commits[x][1] for x in parents), default=0)
+      self._commits[current] = (parents, generation, date)
+      stack.pop()
+
+    return self._commits[sha1]
+
+
+  def isAncestor(self, ancestor, tips):
+    """Check whether a commit is reachable from (or one of) the given tips."""
+    _, target, _ = self._commit(ancestor)
+    seen = set()
+    stack = list(tips)
+
+    while stack:
+      commit = stack.pop()
+      if commit == ancestor:
+        return True
+
+      if commit not in seen:
+        seen.add(commit)
+        parents, generation, _ = self._commit(commit)
+        # Only commits with a generation number greater than that of the
+        # ancestor can possibly reach it.
+        if generation > target:
+          stack += parents
+
+    return False
+
+
+  def changedPathKeys(self, paths):
+    """Compute the changed-path Bloom filter keys for the given paths.
+
+      None is returned if the commit-graph does not contain Bloom filters
+      that we can use.
+    """
+    if not self._graph.hasBloomFilters:
+      return None
+
+    version, count = self._graph.bloomSettings
+    keys = []
+    for path in paths:
+      data = path.encode("utf-8")
+      # The first version of git's hash function treated bytes as signed
+      # characters, which only makes a difference outside of ASCII. We do
+      # not emulate that.
+      if version not in (1, 2) or (version == 1 and not data.isascii()):
+        return None
+
+      # Git adds a path along with all its leading directories to a
+      # commit's filter. A commit may only have changed the path if all
+      # of them are contained.
+      path_keys = []
+      components = data.split(b"/")
+      for i in range(len(components), 0, -1):
+        key = b"/".join(components[:i])
+        hash0, hash1 = (_murmur3(x, key) for x in BLOOM_SEEDS)
+        path_keys.append([(hash0 + j * hash1) & 0xffffffff for j in range(count)])
+
+      keys.append(path_keys)
+
+    return keys
+
+
+  def mayChangePaths(self, commit, keys):
+    """Check whether a commit may have changed any of the paths described by the given keys."""
+    # Bloom filters describe the changes relative to the first parent
+    # and so they do not tell the full story for merge commits.
+    if len(self._commit(commit)[0]) > 1:
+      return True
+
+    position = self._graph.find(bytes.fromhex(commit))
+    if position is None:
+      return True
+
+    filter_ = self._graph.bloomFilter(position)
+    # An empty filter means that git did not compute one.
+    bits = len(filter_) * 8
+    if bits == 0:
+      return True
+
+    def contains(hashes):
+      """Check whether the filter contains a key."""
+      return all(filter_[x % bits // 8] & (1 << (x % bits % 8)) for x in hashes)
+
+    return any(all(map(contains, path_keys)) for path_keys in keys)
+
+
+  def walk(self, tips, exclude=()):
+    """Retrieve all commits reachable from the tips but not from the excluded commits.
+
+      The commits are reported most recent first, similar to
+      git-rev-list.
+    """
+    # A mapping from commits we encountered to whether they are
+    # reachable from an excluded commit.
+    excluded = {}
+    queued = set()
+    queue = []
+    pending = 0
+
+    def push(commit, exclude):
+      """Queue a commit for visiting."""
+      nonlocal pending
+      if commit in excluded:
+        if exclude and not excluded[commit]:
+          excluded[commit] = True
+          if commit in queued:
+            pending -= 1
+        return
+
+      excluded[commit] = exclude
+      queued.add(commit)
+      heappush(queue, (-self._commit(commit)[1], commit))
+      if not exclude:
+        pending += 1
+
+    for commit in exclude:
+      push(commit, True)
+    for commit in tips:
+      push(commit, False)
+
+    # We visit commits in order of decreasing generation number. That
+    # way, all commits from which a given one is reachable are visited
+    # before it and by the time we get to it, we know whether it is
+    # reachable from an excluded commit. We can stop as soon as only
+    # such commits are left to visit.
+    commits = set()
+    while pending > 0:
+      _, commit = heappop(queue)
+      queued.remove(commit)
+      if not excluded[commit]:
+        pending -= 1
+        commits.add(commit)
+
+      for parent in self._commit(commit)[0]:
+        push(parent, excluded[commit])
+
+    # Now report the commits ordered by date, the way git-rev-list does.
+    # Commits with equal dates are reported in the order we found them.
+    result = []
+    queue = [(-self._commit(x)[2], i, x) for i, x in enumerate(set(tips) & commits)]
+    heapify(queue)
+    seen = {x for _, _, x in queue}
+    while queue:
+      _, _, commit = heappop(queue)
+      result.append(commit)
+      for parent in self._commit(commit)[0]:
+        if parent in commits and parent not in seen:
+          seen.add(parent)
+          heappush(queue, (-self._commit(parent)[2], len(seen), parent))
+
+    return result
+
+
+def _retrieveRepositoryRoot(print_commands=False):
+  """Retrieve the root directory of the current git repository."""
+  refs = GitRefStore.discover()
+  if refs is not None:
+    return refs.root
+
+  # This function does not invoke git with the "-C" parameter because it
+  # is the one that retrieves the argument to use with it.
+  try:
+    out = _execute(_findCommand("git"), "rev-parse", "--show-toplevel",
+                   verbose=print_commands)
+  except ProcessError:
+    # A bare repository has no working tree. We work in its git
+    # directory instead, which suffices for imports not requiring one.
+    out = _execute(_findCommand("git"), "rev-parse", "--is-bare-repository",
+                   "--absolute-git-dir", verbose=print_commands)
+    bare, git_dir = out.decode("utf-8").splitlines()
+    if bare != "true":
+      raise
+    return git_dir
+
+  return out[:-1].decode("utf-8")
+
+
+def _formatIsoDate(identity):
+  """Format the date of an identity (e.g., an author header) like git's strict ISO 8601 format."""
+  # The datetime module is only imported here as it is not needed for
+  # most invocations.
+  from datetime import (
+    datetime,
+    timedelta,
+    timezone,
+  )
+
+  match = IDENTITY_DATE_RE.search(identity)
+  if match is None:
+    return None
+
+  timestamp, sign, hours, minutes = match.groups()
+  offset = timedelta(hours=int(hours), minutes=int(minutes))
+  zone = timezone(-offset if sign == "-" else offset)
+  return datetime.fromtimestamp(int(timestamp), zone).isoformat()
+
+
+class GitImporter:
+  """A class handling subrepo imports."""
+  def __init__(self, debug_commands=False, root=None):
+    """Initialize the git subrepo importer object."""
+    if root is None:
+      root = _retrieveRepositoryRoot(debug_commands)
+
+    self._git = GitExecutor(root, debug_commands)
+    self._objects = None
+    self._history = None
+    self._refs = None
+    self._snapshot = None
+    self._config = None
+    self.refresh(debug_commands)
+
+
+  def refresh(self, debug_commands=False):
+    """Prepare the importer for another operation.
+
+      State that may have changed since the last operation (the refs
+      and the commit-graph) is reloaded, while data that cannot change
+      (objects and the results of scans of the history up to a given
+      commit) stays cached.
+    """
+    root = self.root
+    self._git = GitExecutor(root, debug_commands)
+    self._snapshot = None
+    self._config = None
+    self._refs = GitRefStore.discover(root)
+    if self._refs is not None:
+      objects_dir = join(self._refs.commonDir, "objects")
+      if self._objects is None:
+        self._objects = GitObjectStore(objects_dir)
+      self._history = GitHistory.open(objects_dir, self._objects)
+    else:
+      self._objects = None
+      self._history = None
+
+
+  def _resolveRef(self, name):
+    """Resolve a ref using the ref store, return None if it could not be resolved."""
+    if self._refs is None:
+      return None
+
+    return self._refs.resolve(name)
+
+
+  def preflight(self, remote_commits=(), index=True):
+    """Retrieve a snapshot of the state of the repository for the checks preceding an operation.
+
+      The snapshot comprises HEAD, the checked out branch, whether the
+      index is clean (only checked if 'index' is True and we do not work
+      on a private index), and the SHA1 hashes of the given (repo,
+      commit) tuples as resolved by resolveRemoteCommit. It is gathered
+      using at most two git invocations and later checks consult it
+      instead of asking git again, until HEAD changes.
+    """
+    head = None
+    branch = None
+    clean = True
+    names = []
+    if index and self._git.indexFile is None:
+      # Untracked files are of no concern to us and neither is the
+      # content of the working trees of submodules.
+      out = self._git.execute("status", "--porcelain=v2", "--branch", "--untracked-files=no",
+                              "--ignore-submodules=dirty")
+      for line in out.decode("utf-8").splitlines():
+        if line.startswith("# branch.oid "):
+          head = line[13:] if line[13:] != "(initial)" else None
+        elif line.startswith("# branch.head "):
+          branch = line[14:] if line[14:] != "(detached)" else None
+        elif line.startswith(("1 ", "2 ")):
+          # The first character of the XY field describes the changes
+          # staged in the index.
+          clean = clean and line[2] == "."
+        elif line.startswith("u "):
+          clean = False
+    else:
+      head = self._resolveRef("HEAD")
+      if head is None:
+        names += ["HEAD"]
+
+    commits = {}
+    for repo, commit in remote_commits:
+      to_import = "refs/remotes/%s/%s" % (repo, commit)
+      commits[(repo, commit)] = self._resolveRef(to_import)
+      # Names that cannot be represented in git-cat-file's line based
+      # input are left to resolveRemoteCommit to handle.
+      if commits[(repo, commit)] is None and "\n" not in to_import:
+        names += [to_import, commit]
+
+    if names:
+      # Each name gets resolved to a commit. For names that cannot be
+      # resolved git prints the name followed by the reason instead of a
+      # SHA1 hash.
+      data = "".join("%s^{commit}\n" % x for x in names).encode("utf-8")
+      out = self._git.execute("cat-file", "--batch-check=%(objectname)", stdin=data)
+      lines = out.decode("utf-8").splitlines()
+      resolved = {x: y if HEX_SHA1_RE.fullmatch(y) else None for x, y in zip(names, lines)}
+
+      if "HEAD" in resolved:
+        head = resolved["HEAD"]
+
+      for repo, commit in commits:
+        if commits[(repo, commit)] is None:
+          to_import = "refs/remotes/%s/%s" % (repo, commit)
+          commits[(repo, commit)] = resolved.get(to_import) or resolved.get(commit)
+
+    self._snapshot = Snapshot(head, branch, clean, commits)
+    return self._snapshot
+
+
+  def resolveCommit(self, commit):
+    """Resolve a commit into a SHA1 hash."""
+    if commit == "HEAD":
+      if self._snapshot is not None and self._snapshot.head is not None:
+        return self._snapshot.head
+
+      sha1 = self._resolveRef(commit)
+      if sha1 is not None:
+        return sha1
+
+    out = self._git.execute("rev-parse", "--verify", "%s^{commit}" % commit)
+    return out.decode("utf-8")[:-1]
+
+
+  def resolveRemoteCommit(self, repo, commit):
+    """Resolve a potentially symbolic commit name in a remote repository to a SHA1 hash.
+
+      Note that there no guarantee is provided that the given commit
+      (which may be a symbolic name), truly belongs to the given remote
+      repository. Further checks are required to enforce this constraint
+      on the client side.
+    """
+    if self._snapshot is not None:
+      sha1 = self._snapshot.commits.get((repo, commit))
+      if sha1 is not None:
+        return sha1
+
+    to_import = "refs/remotes/%s/%s" % (repo, commit)
+    sha1 = self._resolveRef(to_import)
+    if sha1 is not None:
+      return sha1
+
+    try:
+      return self.resolveCommit(to_import)
+    except ProcessError as e:
+      # If we already got supplied a SHA1 hash the above command will fail
+      # because we prefixed the hash with the repository, which git will
+      # not understand. In such a case we want to make sure we are really
+      # dealing with the SHA1 hash (and not something else we do not know
+      # how to handle correctly) and ask git to parse it again.
+      try:
+        return self.resolveCommit(commit)
+      except ProcessError:
+        raise e
+
+
+  def _retrieveRemoteTips(self, repo):
+    """Retrieve the SHA1 hashes of all refs of a remote repository, or None if that failed."""
+    # Git interprets the argument to --remotes as a pattern. We only
+    # handle the common case of it not containing any special chars.
+    if self._refs is None or any(x in repo for x in "*?[\\"):
+      return None
+
+    refs = self._refs.listRefs("refs/remotes/%s/" % repo)
+    if refs is None:
+      return None
+
+    tips = [self._refs.resolve(x) for x in refs]
+    return tips if None not in tips else None
+
+
+  def _isAncestor(self, ancestor, tips):
+    """Check whether a commit is reachable from any of the given tips using the history walker.
+
+      None is returned if the question could not be answered.
+    """
+    if self._history is None:
+      return None
+
+    try:
+      return self._history.isAncestor(ancestor, tips)
+    except (LookupError, StructError, ValueError):
+      return None
+
+
+  def belongsToRepository(self, repo, sha1):
+    """Check whether a given commit belongs to a remote repository."""
+    tips = self._retrieveRemoteTips(repo)
+    if tips is not None:
+      result = self._isAncestor(sha1, tips)
+      if result is not None:
+        return result
+
+    def countRemoteCommits(*args):
+      """Count the number of reachable commits in a remote repository."""
+      out = self._git.execute("rev-list", "--count", "--remotes=%s" % repo, *args)
+      return int(out[:-1].decode("utf-8"))
+
+    # It is tougher than anticipated to simply find out whether a given
+    # commit belongs to a given remote repository or not. The approach
+    # chosen here is to count the number of reachable commits in a remote
+    # repository with and without the given commit. If there is a
+    # difference in commit count then we deduce that the commit is indeed
+    # part of this repository. A potentially simpler approach is to do a
+    # git-rev-list showing all commits and then "grep" for the commit of
+    # interest. The problem with this approach is that either we need to
+    # read a potentially huge list of commits into a Python string or we
+    # have a dependency to the 'grep' program -- neither of which is
+    # deemed acceptable.
+    including = countRemoteCommits()
+    excluding = countRemoteCommits("^%s" % sha1)
+    # We excluded a single commit but it might be the parent of others
+    # that now are also not listed. So every difference greater zero
+    # indicates that the commit is indeed part of the repository.
+    return including - excluding > 0
+
+
+  def hasCachedChanges(self):
+    """Check if the repository has changes."""
+    try:
+      # When using the --exit-code option the command will return 1 (i.e.,
+      # cause an exception to be raised) in case there are changes and 0
+      # otherwise.
+      # Note that we cannot safely use git-diff-index or git-diff-tree
+      # here because we cannot guarantee that a HEAD exists (and those
+      # commands require some form of tree-ish or commit to be provided).
+      self._git.execute("diff", "--cached", "--no-patch", "--exit-code", "--quiet")
+      return False
+    except ProcessError:
+      return True
+
+
+  @staticmethod
+  def removeSubsumedFiles(files):
+    """Remove files that are subsumed by directories."""
+    if len(files) <= 1:
+      return files
+
+    # We work on a sorted list of files. This way we are sure that
+    # directories potentially subsuming files appear before said files.
+    files = sorted(files)
+    subsumer, *files = files
+
+    new_files = [subsumer]
+    subsumer = trail(subsumer)
+
+    for file_ in files:
+      # Find the longest string both paths have in common. Note that
+      # commonprefix really operates on a string/character level. It has
+      # no knowledge of paths and path components. For that reason we need
+      # some more checks below to not detect a subsumes relationship where
+      # there is none. Consider for example the paths
+      #   foo/bar
+      #   foo/barbaz
+      # where foo/bar is a common prefix of foo/barbaz on a string-level
+      # but not on a path-level.
+      prefix = commonprefix([file_, subsumer])
+      if prefix == subsumer:
+        # We determined that the given file could indeed be subsumed by
+        # 'subsumer'. However, we need to rule out false positives caused
+        # by working on a string level as opposed on a path level by
+        # checking the determined prefix does not lie in the middle of
+        # file_'s path. Note that usage of commonpath (available starting
+        # from Python 3.5) instead of commonprefix above would relieve us
+        # from these additional checks.
+        length = len(prefix)
+        is_file = length < len(file_) and file_[length - 1] == sep
+        is_same = length == len(file_)
+
+        if is_file or is_same:
+          continue
+
+      new_files += [file_]
+      subsumer = trail(file_)
+
+    return new_files
+
+
+  def _diffAwayFiles(self, files):
+    """Create a git command pipeline for removing a set of files/directories."""
+    def diffAwayFile(file_):
+      """If a file object exists, create a git command for creating a patch to remove it."""
+      # Note that we deliberately choose to perform the weakest check
+      # possible here to detect presence of the given file/directory (that
+      # is, we just check if it exists at all, not if we have write access
+      # etc.). We let git handle the rest. Without a working tree, we
+      # diff against the index and files not present are just skipped.
+      if self._git.indexFile is not None or lexists(join(self.root, file_)):
+        return [git_diff_index + ["-R", empty_tree, "--", file_]]
+      else:
+        return []
+
+    commands = []
+    empty_tree = self._retrieveEmptyTree()
+    git_diff_index = self._git.diffIndexCommand()
+
+    for file_ in files:
+      commands += diffAwayFile(file_)
+
+    return commands
+
+
+  def isUpToDate(self, imports):
+    """Check whether importing a dict of subrepos (subrepo -> sha1) would leave everything unchanged.
+
+      That is the case if each subrepo is currently imported at the
+      given commit and the files at its prefix in HEAD are exactly
+      those of this commit.
+    """
+    # An import into the root directory does not touch all files, so
+    # we cannot compare trees for it.
+    if not self._hasHead() or any(x.prefix == ROOT_PREFIX for x in imports):
+      return False
+
+    prefixes = frozenset(x.prefix for x in imports)
+    current_imports = self._searchImportedSubrepos(self.resolveCommit("HEAD"), flat=True,
+                                                   prefixes=prefixes)
+    for subrepo, sha1 in imports.items():
+      if current_imports.get(subrepo) != sha1:
+        return False
+
+      tree = self._retrieveTree(sha1, ROOT_PREFIX)
+      if tree is None or tree != self._retrieveTree("HEAD", subrepo.prefix):
+        return False
+
+    return True
+
+
+  def import_(self, subrepo, sha1, renames=False):
+    """Import a remote repository at a given commit at a given prefix."""
+    self.importAll({subrepo: sha1}, renames=renames)
+
+
+  def importAll(self, imports, renames=False):
+    """Import a dict of remote repositories (subrepo -> sha1) with a single patch application.
+
+      The prefixes of the given subrepos must not overlap. If 'renames'
+      is True, a subrepo whose files are unchanged since its previous
+      import is updated using a patch between the two imported states,
+      in which git detects renamed and copied files.
+    """
+    for subrepo, sha1 in imports.items():
+      assert trail(subrepo.prefix) == subrepo.prefix, subrepo.prefix
+      assert self.resolveRemoteCommit(subrepo.repo, sha1) == sha1, sha1
+
+    empty_tree = self._retrieveEmptyTree()
+    remote_keys = {subrepo: {subrepo} for subrepo in imports}
+    current_imports = {}
+
+    # If we can find a subrepo import commit for the same repository at
     # the same prefix then we can not only revert the files/directories
     # created by the new import commit but also by this previous one.
     # This logic properly handles file/directory file deletions and
@@ -835,29 +2453,84 @@ class GitImporter:
     # simply may not be able to access the commit data (in order to see
     # which files/directories are contained in the state it represents).
     if self._hasHead():
-      # We lookup *all* imports that happened in our history as well as
-      # in the past of the given commit.
+      # We lookup *all* imports that happened in the past of the given
+      # commit. In our own history we are only interested in the files
+      # last imported at the same prefixes and so we can restrict the
+      # search to commits changing files below them.
+      # When importing multiple subrepos a single scan of our history
+      # covers all of them.
       head_sha1 = self.resolveCommit("HEAD")
-      current_imports = self._searchImportedSubrepos(head_sha1, flat=True)
-      remote_imports = self._searchImportedSubrepos(sha1, flat=True)
+      for subrepo, sha1 in imports.items():
+        remote_keys[subrepo] |= self._searchImportedSubrepos(sha1, flat=True).keys()
+
+      prefixes = frozenset(x.prefix for keys in remote_keys.values() for x in keys)
+      current_imports = self._searchImportedSubrepos(head_sha1, flat=True, prefixes=prefixes)
+
+    files = set()
+    pipe_cmds = []
+    renamed = []
+    for subrepo, sha1 in sorted(imports.items()):
+      remote_tree = "%s^{tree}" % sha1
+      if renames:
+        base = self._findRenameBase(subrepo, remote_keys[subrepo], current_imports)
+        if base is not None:
+          renamed.append((subrepo, base, remote_tree))
+          continue
+
+      files |= self._readCommitFiles(sha1, subrepo.prefix)
 
       # Next we take all repository imports that happened in both
       # repositories (but potentially for different states) plus the
       # latest import of the remote repository to import itself (if any)
       # and revert the files associated with them as well.
-      for remote_key in remote_imports.keys() | {subrepo}:
+      for remote_key in remote_keys[subrepo]:
         if remote_key in current_imports:
           imported_sha1 = current_imports[remote_key]
           if self._isValidCommit(imported_sha1):
             files |= self._readCommitFiles(imported_sha1, remote_key.prefix)
 
-    files = self.removeSubsumedFiles(files)
-    pipe_cmds += self._diffAwayFiles(files)
+      # Last but not least we need a patch that adds the desired bits of
+      # the remote repository to this one.
+      paths = []
+      if subrepo.prefix == ROOT_PREFIX:
+        paths = ["--", ":(exclude)%s" % MANIFEST]
 
-    # Last but not least we need a patch that adds the desired bits of the
-    # remote repository to this one.
-    pipe_cmds += [git_diff_tree + [empty_tree, remote_tree]]
-    self._git.springWithSafeApply(pipe_cmds)
+      git_diff_tree = self._git.diffTreeCommand(subrepo.prefix)
+      pipe_cmds += [git_diff_tree + [empty_tree, remote_tree] + paths]
+
+    if pipe_cmds:
+      # The manifest of a repository imported into the root directory
+      # must not replace our own.
+      files = self.removeSubsumedFiles(files - {MANIFEST})
+      self._git.springWithSafeApply(self._diffAwayFiles(files) + pipe_cmds)
+
+    # Git does not prefix the paths of renamed and copied files as
+    # specified by --src-prefix and --dst-prefix and so we create these
+    # patches without prefix and have git-apply add it.
+    for subrepo, base, remote_tree in renamed:
+      git_diff_tree = self._git.diffTreeCommand(ROOT_PREFIX) + ["-M", "-C"]
+      self._git.springWithSafeApply([git_diff_tree + [base, remote_tree]], subrepo.prefix)
+
+
+  def _findRenameBase(self, subrepo, remote_keys, current_imports):
+    """Find the tree of the previous import of a subrepo to diff the new state against, if any.
+
+      The files at the subrepo's prefix have to be exactly those of the
+      previous import, as they are not reverted separately.
+    """
+    sha1 = current_imports.get(subrepo)
+    if sha1 is None or subrepo.prefix == ROOT_PREFIX:
+      return None
+
+    # Files of other imports would have to be reverted as well.
+    if any(x in current_imports for x in remote_keys - {subrepo}):
+      return None
+
+    base = self._retrieveTree(sha1, ROOT_PREFIX)
+    if base is None or base != self._retrieveTree("HEAD", subrepo.prefix):
+      return None
+
+    return base
 
 
   def _performReimport(self, match, new_commit, old_commit, verbose=False):
@@ -876,6 +2549,7 @@ class GitImporter:
       # Reimport the subrepo at a new commit. The incremental changes
       # (if any) will be staged, not committed yet.
       self.import_(subrepo, new_commit)
+      self._stageManifest(subrepo, new_commit, self._searchImportedSubrepos(new_commit, flat=True))
       # We amend the HEAD commit with the newly staged changes. We also
       # adjust the message to reference the correct new commit that we
       # updated to.
@@ -967,6 +2641,7 @@ class GitImporter:
     # for a deletion commit to exist (legitimately) there must have been
     # an import beforehand.
     self.delete(subrepo, commit="HEAD^")
+    self._stageManifest(subrepo)
     self.amendCommit(new_message)
 
 
@@ -976,6 +2651,9 @@ class GitImporter:
       return
 
     old_message = self._retrieveMessage("HEAD")
+    if old_message.startswith("%s\n" % IMPORTS_MSG):
+      raise ReimportError("Cannot reimport a commit importing multiple subrepos.")
+
     match = IMPORT_MSG_RE.search(old_message)
     if match is not None:
       self._reimportImport(match, remote=remote, branch=branch, use_date=use_date, verbose=verbose)
@@ -987,17 +2665,240 @@ class GitImporter:
       return
 
 
+  def _isManifestEnabled(self):
+    """Check whether we maintain a manifest of imported subrepos."""
+    # Once a manifest exists we keep it up to date, no matter how we
+    # are configured.
+    if self._git.indexFile is None:
+      if lexists(join(self.root, MANIFEST)):
+        return True
+    elif self._hasHead() and self._readManifest(self.resolveCommit("HEAD")) is not None:
+      return True
+
+    return self._readConfigBool("subrepo.manifest")
+
+
+  def _readConfigBool(self, name):
+    """Read a boolean setting from the configuration, return False if it is not present."""
+    # We read all settings of interest at once and only once for each
+    # operation.
+    if self._config is None:
+      try:
+        out = self._git.execute("config", "--null", "--get-regexp", CONFIG_R)
+      except ProcessError:
+        # None of the settings is present.
+        out = b""
+
+      self._config = {}
+      # Each entry is terminated by a NUL byte and separates the value,
+      # if any, from the name by a newline.
+      for entry in out.decode("utf-8").split("\0")[:-1]:
+        key, newline, value = entry.partition("\n")
+        self._config[key] = value if newline else None
+
+    if name not in self._config:
+      return False
+
+    # A setting without a value counts as true.
+    value = self._config[name]
+    if value is None:
+      return True
+
+    value = value.strip().lower()
+    if value in ("true", "yes", "on"):
+      return True
+    if value in ("false", "no", "off", ""):
+      return False
+
+    try:
+      return int(value) != 0
+    except ValueError:
+      raise SubrepoError("Invalid boolean value for configuration setting %s: %s" % (name, value))
+
+
+  def _stageManifest(self, subrepo, sha1=None, imports=None):
+    """Update the manifest for an import (or a deletion, if no commit is given) and stage it."""
+    self._stageManifestChanges({subrepo: (sha1, imports)})
+
+
+  def _stageManifestChanges(self, changes):
+    """Update the manifest for a dict of imports and deletions (subrepo -> (sha1, imports)) and stage it."""
+    if not self._isManifestEnabled():
+      return
+
+    current = {}
+    if self._hasHead():
+      # Note that if there is no manifest yet, we create it based on
+      # the history.
+      current = dict(self._searchImportedSubrepos(self.resolveCommit("HEAD")))
+
+    for subrepo, (sha1, imports) in changes.items():
+      if sha1 is not None:
+        current[subrepo] = (sha1, importDependencies(imports, subrepo.prefix))
+      else:
+        current.pop(subrepo, None)
+
+    data = manifestForImports(current)
+    if self._git.indexFile is not None:
+      out = self._git.execute("hash-object", "-w", "--stdin", stdin=data.encode("utf-8"))
+      info = "100644,%s,%s" % (out.decode("utf-8").strip(), MANIFEST)
+      self._git.execute("update-index", "--add", "--cacheinfo", info)
+      return
+
+    with open(join(self.root, MANIFEST), "w") as file_:
+      file_.write(data)
+
+    self._git.execute("update-index", "--add", "--", MANIFEST)
+
+
+  @contextmanager
+  def privateIndex(self):
+    """Work on a private index initialized from HEAD, without a working tree.
+
+      Neither the repository's index nor its working tree (if it has
+      one at all) are touched while in this context. Commits are created
+      from the private index using plumbing commands only.
+    """
+    # Just like in GitExecutor.springWithSafeApply we only import the
+    # comparably costly tempfile module when it is actually needed.
+    from tempfile import (
+      TemporaryDirectory,
+    )
+
+    git = self._git
+    with TemporaryDirectory(prefix="subrepo-index") as directory:
+      self._git = git.withIndex(join(directory, "index"))
+      try:
+        if self._hasHead():
+          self._git.execute("read-tree", "HEAD")
+        else:
+          self._git.execute("read-tree", "--empty")
+
+        yield
+      finally:
+        self._git = git
+
+
+  def _readCommitHeader(self, commit):
+    """Retrieve the (parents, author) of a commit, the latter being a tuple as matched by IDENTITY_RE."""
+    data = self._readObject(commit, "commit")
+    if data is None:
+      data = self._git.execute("cat-file", "commit", commit)
+
+    parents = []
+    author = None
+    for line in data.partition(b"\n\n")[0].decode("utf-8", "replace").split("\n"):
+      key, _, value = line.partition(" ")
+      if key == "parent":
+        parents.append(value)
+      elif key == "author" and author is None:
+        author = IDENTITY_RE.fullmatch(value)
+
+    if author is None:
+      raise SubrepoError("Unable to read the author of commit %s." % commit)
+
+    return parents, author.groups()
+
+
+  def _commitIndex(self, message, amend=False, allow_empty=False):
+    """Commit the content of the index on top of HEAD (or replacing it) and advance HEAD.
+
+      Other than git-commit we neither refresh the index nor look at the
+      working tree, as the tree to commit is known already.
+    """
+    out = self._git.execute("write-tree")
+    tree = out.decode("utf-8").strip()
+
+    old_head = ""
+    parents = []
+    env = None
+    if self._hasHead():
+      old_head = self.resolveCommit("HEAD")
+      parents = [old_head]
+
+      # Just like git-commit we refuse to create a commit not changing
+      # anything, unless asked to. An amend may just change the message.
+      if not allow_empty and not amend and tree == self._retrieveTree(old_head, ROOT_PREFIX):
+        raise SubrepoError("Nothing to commit.")
+
+    if amend:
+      # Just like git-commit --amend we keep the parents and the author
+      # of the commit we replace, but not the committer.
+      parents, (name, email, date) = self._readCommitHeader(old_head)
+      env = {
+        "GIT_AUTHOR_NAME": name,
+        "GIT_AUTHOR_EMAIL": email,
+        "GIT_AUTHOR_DATE": date,
+      }
+
+    args = []
+    for parent in parents:
+      args += ["-p", parent]
+
+    # Other than git-commit, git-commit-tree does not honor the
+    # commit.gpgSign setting on its own.
+    if self._readConfigBool("commit.gpgsign"):
+      args += ["-S"]
+
+    # Git terminates commit messages with a newline. We do the same.
+    data = ("%s\n" % message).encode("utf-8")
+    out = self._git.execute("commit-tree", tree, *args, stdin=data, env=env)
+    commit = out.decode("utf-8").strip()
+
+    # We create the same reflog entry git-commit would. By passing in
+    # the old value of HEAD we make sure not to overwrite a concurrent
+    # update (an empty value denotes that the ref must not exist).
+    subject = message.splitlines()[0]
+    if amend:
+      reflog = "commit (amend): %s" % subject
+    elif not parents:
+      reflog = "commit (initial): %s" % subject
+    else:
+      reflog = "commit: %s" % subject
+
+    self._git.execute("update-ref", "-m", reflog, "HEAD", commit, old_head)
+
+
+  def _commit(self, message, edit=False, amend=False, allow_empty=False):
+    """Commit the staged changes, letting the user edit the message if desired."""
+    try:
+      if not edit:
+        self._commitIndex(message, amend=amend, allow_empty=allow_empty)
+        return
+
+      # Only git-commit is able to bring up an editor. Note that we do
+      # not support editing without a working tree.
+      assert self._git.indexFile is None
+      options = ["--amend"] if amend else []
+      options += ["--allow-empty"] if allow_empty else []
+      self._git.execute("commit", "--no-verify", "--edit", "--message=%s" % message, *options)
+    finally:
+      # HEAD changed and so any snapshot is outdated.
+      self._snapshot = None
+
+
   def commitImport(self, subrepo, sha1, edit=False):
     """Create a commit for an import."""
-    options = ["--edit"] if edit else []
     imports = self._searchImportedSubrepos(sha1, flat=True)
+    self._stageManifest(subrepo, sha1, imports)
     message = importMessageForCommit(subrepo, sha1, imports)
-    self._git.execute("commit", "--no-verify", "--message=%s" % message, *options)
+    self._commit(message, edit)
+
+
+  def commitImports(self, imports, edit=False):
+    """Create a single commit for the import of a dict of subrepos (subrepo -> sha1)."""
+    changes = {}
+    for subrepo, sha1 in imports.items():
+      changes[subrepo] = (sha1, self._searchImportedSubrepos(sha1, flat=True))
+
+    self._stageManifestChanges(changes)
+    message = importMessageForCommits((k, v, i) for k, (v, i) in changes.items())
+    self._commit(message, edit)
 
 
   def amendCommit(self, message):
     """Amend the HEAD commit with the currently staged changes."""
-    self._git.execute("commit", "--amend", "--no-verify", "--message=%s" % message)
+    self._commit(message, amend=True)
 
 
   def _findCommits(self, repo, arguments, branch=None):
@@ -1050,6 +2951,10 @@ class GitImporter:
 
     # Retrieve the full dependency tree for this repository. That is,
     # all the imported subrepos along with the subrepos they pulled in.
+    # Note that we cannot limit the search to commits changing files
+    # below the prefix: an import may pull in the subrepo as a
+    # dependency without changing any of its files, if they are present
+    # already.
     head_sha1 = self.resolveCommit(commit if commit is not None else "HEAD")
     imports = self._searchImportedSubrepos(head_sha1)
 
@@ -1177,7 +3082,7 @@ class GitImporter:
     # is not necessarily what we want because one of those subrepos
     # could be imported directly in which case we do not want to
     # delete it. So check the list of ignored files here.
-    delete_files -= ignore_files
+    delete_files -= ignore_files | {MANIFEST}
 
     delete_files = self.removeSubsumedFiles(delete_files)
     pipe_cmds = self._diffAwayFiles(delete_files)
@@ -1186,7 +3091,6 @@ class GitImporter:
 
   def commitDelete(self, subrepo, edit=False):
     """Create a commit for a subrepo deletion."""
-    options = ["--edit"] if edit else []
     delete_deps, _ = self._findSubreposForDeletion(subrepo)
     # The set of dependencies includes the one we want to delete. Remove
     # it from there as it is passed in separately to make sure it is
@@ -1194,52 +3098,364 @@ class GitImporter:
     delete_deps = {(subrepo_, sha1) for subrepo_, sha1 in delete_deps
                      if subrepo_ != subrepo}
 
-    message = deleteMessageForCommit(subrepo, delete_deps)
-    self._git.execute("commit", "--no-verify", "--message=%s" % message, *options)
+    self._stageManifest(subrepo)
+    message = deleteMessageForCommit(subrepo, delete_deps)
+    self._commit(message, edit)
+
+
+  def commitCheckpoint(self, edit=False):
+    """Create an empty commit recording the current state of imports."""
+    imports = {}
+    if self._hasHead():
+      # The checkpoint stands in for the history before it and so its
+      # state has to be that of the history, not that of a manifest.
+      imports = self._searchImportedSubrepos(self.resolveCommit("HEAD"), manifest=False)
+
+    message = checkpointMessage(imports)
+    # A checkpoint does not change any files.
+    self._commit(message, edit, allow_empty=True)
+
+
+  @property
+  def root(self):
+    """Retrieve the root directory of the git repository this importer is bound to."""
+    return self._git.root
+
+
+  @lru_cache(maxsize=1)
+  def _retrieveEmptyTree(self):
+    """Retrieve the SHA1 sum of the empty tree."""
+    # Note that the SHA1 sum of the empty tree is constant and *should*
+    # not change. It is '4b825dc642cb6eb9a060e54bf8d69288fbee4904'.
+    # However, to be safe here (and to document how to derive it), we
+    # query it on the fly.
+    out = self._git.execute("hash-object", "-t", "tree", devnull)
+    return out[:-1].decode("utf-8")
+
+
+  def _isValidCommit(self, commit):
+    """Check whether a given SHA1 hash references a valid commit."""
+    try:
+      self._git.execute("rev-parse", "--quiet", "--verify", "%s^{commit}" % commit)
+      return True
+    except ProcessError:
+      return False
+
+
+  def _hasHead(self):
+    """Check if the repository has a HEAD."""
+    if self._snapshot is not None:
+      return self._snapshot.head is not None
+
+    return self._resolveRef("HEAD") is not None or self._isValidCommit("HEAD")
+
+
+  def _isHeadCommit(self, commit):
+    """Check whether a SHA1 hash is the one HEAD refers to."""
+    if self._snapshot is not None:
+      return self._snapshot.head == commit
+
+    head = self._resolveRef("HEAD")
+    if head is None:
+      try:
+        out = self._git.execute("rev-parse", "--quiet", "--verify", "HEAD^{commit}")
+        head = out.decode("utf-8").strip()
+      except ProcessError:
+        return False
+
+    return head == commit
+
+
+  @lru_cache(maxsize=1)
+  def _retrieveGitDirs(self):
+    """Retrieve the git directory and the common git directory (shared by all worktrees)."""
+    if self._refs is not None:
+      return self._refs.gitDir, self._refs.commonDir
+
+    out = self._git.execute("rev-parse", "--absolute-git-dir", "--git-common-dir")
+    git_dir, common_dir = out.decode("utf-8").splitlines()
+    # The common directory may be reported relative to the root.
+    return git_dir, normpath(join(self.root, common_dir))
+
+
+  def writeCommitGraph(self):
+    """Write a commit-graph file with changed-path Bloom filters for all reachable commits."""
+    self._git.execute("commit-graph", "write", "--reachable", "--changed-paths")
+
+    if self._objects is not None:
+      objects_dir = join(self._retrieveGitDirs()[1], "objects")
+      self._history = GitHistory.open(objects_dir, self._objects)
+
+
+  def refreshCaches(self):
+    """Bring the caches used for history scans and completions up to date with HEAD."""
+    if self._hasHead():
+      head = self.resolveCommit("HEAD")
+      self._searchImportedSubrepos(head, manifest=False)
+      self.retrieveCompletionImports()
+
+
+  def retrieveMaintenanceState(self):
+    """Retrieve the state of the commit-graph, our caches, and the manifest (if any).
+
+      The result is a list of (name, path, details, fresh) tuples, with
+      'fresh' indicating whether the respective file covers HEAD or, in
+      case of the manifest, whether it agrees with the history.
+    """
+    git_dir, common_dir = self._retrieveGitDirs()
+    head = self.resolveCommit("HEAD") if self._hasHead() else None
+
+    graph_path = join(common_dir, "objects", COMMIT_GRAPH)
+    try:
+      graph = _CommitGraph(graph_path)
+      details = "%d commits" % graph.count
+      if graph.hasBloomFilters:
+        details += " with changed-path Bloom filters"
+      fresh = head is None or graph.find(bytes.fromhex(head)) is not None
+    except (KeyError, OSError, StructError, ValueError):
+      details = "unsupported format"
+      fresh = False
+
+    import_path = join(git_dir, IMPORT_CACHE)
+    results = self._readImportCache(import_path)
+    import_details = "%d scans" % len(results)
+    import_fresh = head is None or any(x == head and not y for x, y, _ in results)
+
+    completion_path = join(git_dir, COMPLETION_CACHE)
+    imports = self._readCompletionCache(completion_path, head) if head is not None else {}
+
+    state = [
+      ("commit-graph", graph_path, details, fresh),
+      ("import cache", import_path, import_details, import_fresh),
+      ("completion cache", completion_path,
+       "%d subrepos" % len(imports or {}), imports is not None),
+    ]
+
+    # If there is a manifest we verify it against the history.
+    manifest = self._readManifest(head) if head is not None else None
+    if manifest is not None:
+      def normalize(imports):
+        """Normalize a tree of imports for comparison."""
+        return {k: (v, sorted(d)) for k, (v, d) in imports.items()}
+
+      scanned = self._searchImportedSubrepos(head, manifest=False)
+      state.append(("manifest", join(self.root, MANIFEST), "%d subrepos" % len(manifest),
+                    normalize(manifest) == normalize(scanned)))
+
+    return state
+
+
+  def retrieveCompletionImports(self):
+    """Retrieve the flattened subrepo imports in the history of HEAD, for use in completions.
+
+      Walking the history is costly on larger repositories and doing so
+      on every completion request is prohibitive. The result is cached
+      in a file inside the git directory, keyed by the SHA1 of HEAD, and
+      only regenerated once HEAD changed.
+    """
+    head = self._resolveRef("HEAD")
+    if head is not None:
+      git_dir = self._refs.gitDir
+    else:
+      try:
+        out = self._git.execute("rev-parse", "--absolute-git-dir", "HEAD^{commit}")
+      except ProcessError:
+        # We may not have a HEAD yet.
+        return {}
+
+      git_dir, head = out.decode("utf-8").splitlines()
+
+    path = join(git_dir, COMPLETION_CACHE)
+    imports = self._readCompletionCache(path, head)
+    if imports is None:
+      imports = self._searchImportedSubrepos(head, flat=True)
+      self._writeCompletionCache(path, head, imports)
+
+    return imports
+
+
+  @staticmethod
+  def _readCompletionCache(path, head):
+    """Read the completion cache, return None if it is missing or stale."""
+    # The cache file's first line contains the SHA1 of the HEAD commit it
+    # was created for. Each subsequent line represents an import in the
+    # form <repo> TAB <prefix> TAB <sha1>.
+    try:
+      with open(path, "r") as file_:
+        if file_.readline().rstrip("\n") != head:
+          return None
+
+        imports = {}
+        for line in file_:
+          repo, prefix, sha1 = line.rstrip("\n").split("\t")
+          imports[Subrepo(repo, prefix)] = sha1
+
+        return imports
+    except (OSError, ValueError):
+      # A corrupted cache is treated just like a missing one.
+      return None
+
+
+  @staticmethod
+  def _writeCompletionCache(path, head, imports):
+    """Write the completion cache for the given HEAD commit."""
+    lines = [head] + ["%s\t%s\t%s" % (s.repo, s.prefix, v) for s, v in imports.items()]
+    _writeCacheFile(path, lines)
+
+
+  def _readObject(self, sha1, type_):
+    """Read an object of the given type using the object store, return None if that failed."""
+    if self._objects is None or not HEX_SHA1_RE.fullmatch(sha1):
+      return None
+
+    object_ = self._objects.read(sha1)
+    if object_ is None or object_[0] != type_:
+      return None
+
+    return object_[1]
+
+
+  def _readCommit(self, commit):
+    """Read a commit using the object store, return a (headers, message) tuple or None."""
+    if commit == "HEAD":
+      commit = self._resolveRef(commit)
+      if commit is None:
+        return None
+
+    data = self._readObject(commit, "commit")
+    if data is None:
+      return None
+
+    header, _, message = data.partition(b"\n\n")
+    headers = {}
+    for line in header.split(b"\n"):
+      # Lines starting with a space continue the previous header (e.g.,
+      # a signature) and are of no interest to us.
+      if not line.startswith(b" "):
+        key, _, value = line.partition(b" ")
+        headers.setdefault(key.decode("utf-8"), value.decode("utf-8", "replace"))
+
+    # Git re-encodes messages in other encodings for display. We leave
+    # that to it.
+    if headers.get("encoding", "utf-8").lower() not in ("utf-8", "utf8"):
+      return None
+
+    return headers, message.decode("utf-8")
+
+
+  def _readTreeEntries(self, sha1):
+    """Read the entries of a commit's tree using the object store, or return None.
+
+      The result is a list of (name, sha1) tuples, with the name being
+      a bytes object.
+    """
+    commit = self._readCommit(sha1)
+    if commit is None or "tree" not in commit[0]:
+      return None
+
+    data = self._readObject(commit[0]["tree"], "tree")
+    if data is None:
+      return None
+
+    return [(name, sha1) for _, name, sha1 in self._parseTree(data)]
+
+
+  @staticmethod
+  def _parseTree(data):
+    """Parse a tree object into a list of (mode, name, sha1) tuples, with mode and name being bytes."""
+    entries = []
+    pos = 0
+    while pos < len(data):
+      # Each entry has the form <mode> SP <name> NUL <20 byte SHA1>.
+      start = data.index(b" ", pos) + 1
+      end = data.index(b"\0", start)
+      entries.append((data[pos:start - 1], data[start:end], data[end + 1:end + 21].hex()))
+      pos = end + 21
+
+    return entries
+
+
+  def _retrieveTree(self, commit, prefix):
+    """Retrieve the SHA1 hash of the tree at a prefix in a commit, return None if there is none."""
+    commit_ = self._readCommit(commit)
+    if commit_ is not None and "tree" in commit_[0]:
+      tree = commit_[0]["tree"]
+      components = normpath(prefix).split(sep) if prefix != ROOT_PREFIX else []
+      for component in components:
+        data = self._readObject(tree, "tree")
+        if data is None:
+          break
+
+        # Sub-trees have mode 40000.
+        trees = {n: s for m, n, s in self._parseTree(data) if m == b"40000"}
+        tree = trees.get(component.encode("utf-8"))
+        if tree is None:
+          return None
+      else:
+        return tree
+
+    try:
+      path = untrail(prefix) if prefix != ROOT_PREFIX else ""
+      out = self._git.execute("rev-parse", "--quiet", "--verify", "%s:%s^{tree}" % (commit, path))
+      return out.decode("utf-8").strip()
+    except ProcessError:
+      return None
 
 
-  @property
-  def root(self):
-    """Retrieve the root directory of the git repository this importer is bound to."""
-    return self._git.root
+  def _readTreeNames(self, sha1):
+    """Read the names of the entries of a commit's tree using the object store, or return None."""
+    entries = self._readTreeEntries(sha1)
+    if entries is None:
+      return None
 
+    names = []
+    for name, _ in entries:
+      if QUOTED_NAME_RE.search(name):
+        # Git would print the name quoted. Rather than emulating that
+        # we let it do the work.
+        return None
 
-  @lru_cache(maxsize=1)
-  def _retrieveEmptyTree(self):
-    """Retrieve the SHA1 sum of the empty tree."""
-    # Note that the SHA1 sum of the empty tree is constant and *should*
-    # not change. It is '4b825dc642cb6eb9a060e54bf8d69288fbee4904'.
-    # However, to be safe here (and to document how to derive it), we
-    # query it on the fly.
-    out = self._git.execute("hash-object", "-t", "tree", devnull)
-    return out[:-1].decode("utf-8")
+      names.append(name.decode("utf-8"))
 
+    return names
 
-  def _isValidCommit(self, commit):
-    """Check whether a given SHA1 hash references a valid commit."""
-    try:
-      self._git.execute("rev-parse", "--quiet", "--verify", "%s^{commit}" % commit)
-      return True
-    except ProcessError:
-      return False
 
+  def _readManifest(self, commit):
+    """Read the manifest of imported subrepos contained in a commit, return None if there is none."""
+    data = None
+    entries = self._readTreeEntries(commit)
+    if entries is not None:
+      sha1 = dict(entries).get(MANIFEST.encode("utf-8"))
+      if sha1 is None:
+        return None
 
-  def _hasHead(self):
-    """Check if the repository has a HEAD."""
-    return self._isValidCommit("HEAD")
+      data = self._readObject(sha1, "blob")
+
+    if data is None:
+      try:
+        data = self._git.execute("cat-file", "blob", "%s:%s" % (commit, MANIFEST))
+      except ProcessError:
+        return None
+
+    try:
+      return parseManifest(data.decode("utf-8"))
+    except UnicodeDecodeError:
+      return None
 
 
   def _readCommitFiles(self, sha1, prefix):
     """Given a commit, retrieve the top-level file objects contained in the state it represents."""
-    out = self._git.execute("ls-tree", "%s^{tree}" % sha1)
-    out = out.decode("utf-8")
-    files = set()
-
-    for line in out.splitlines():
-      match = LS_TREE_RE.match(line)
-      if match is not None:
-        file_, = match.groups()
-        files.add(file_)
+    files = self._readTreeNames(sha1)
+    if files is None:
+      out = self._git.execute("ls-tree", "%s^{tree}" % sha1)
+      out = out.decode("utf-8")
+      files = set()
+
+      for line in out.splitlines():
+        match = LS_TREE_RE.match(line)
+        if match is not None:
+          file_, = match.groups()
+          files.add(file_)
 
     return {normpath(join(prefix, x)) for x in files}
 
@@ -1252,12 +3468,30 @@ class GitImporter:
 
   def _retrieveSubject(self, commit):
     """Retrieve the subject line of the given commit."""
+    commit_ = self._readCommit(commit)
+    if commit_ is not None:
+      # Just like git, we skip leading blank lines and join all lines of
+      # the first paragraph.
+      subject = []
+      for line in commit_[1].split("\n"):
+        line = line.rstrip(WHITESPACE)
+        if line:
+          subject.append(line)
+        elif subject:
+          break
+
+      return " ".join(subject)
+
     # %s in a git format string represents the subject line.
     return self._retrieveProperty(commit, "s")
 
 
   def _retrieveMessage(self, commit):
     """Retrieve the message (description) of the given commit."""
+    commit_ = self._readCommit(commit)
+    if commit_ is not None:
+      return commit_[1]
+
     # %B in a git format string represents the raw description, containing
     # the subject line and the description body.
     return self._retrieveProperty(commit, "B")
@@ -1270,14 +3504,31 @@ class GitImporter:
     # (but not everywhere else), in the hope that author dates are less
     # likely to be duplicated (there can easily be multiple equivalent
     # commit dates when using a rebase operation).
+    commit_ = self._readCommit(commit)
+    if commit_ is not None and "author" in commit_[0]:
+      date = _formatIsoDate(commit_[0]["author"])
+      if date is not None:
+        return date
+
     return self._retrieveProperty(commit, "aI")
 
 
   # This method can be rather expensive on large repositories. We cache
   # the return value in order to speed up repeated invocations.
   @lru_cache(maxsize=32)
-  def _searchImportedSubrepos(self, head_commit, flat=False):
-    """Find all subrepos that are imported in the history described by the given commit."""
+  def _searchImportedSubrepos(self, head_commit, flat=False, prefixes=None, manifest=True):
+    """Find all subrepos that are imported in the history described by the given commit.
+
+      If the commit contains a manifest of imported subrepos it is used
+      instead of scanning the history, unless 'manifest' is False.
+
+      If a set of prefixes is given, only commits changing files below
+      any of them are guaranteed to be looked at. The result then only
+      is meaningful for subrepos imported at these prefixes and it
+      merely reflects the imports that changed their files. An import
+      of a nested subrepo whose files were present already may be
+      missing.
+    """
     def importsAndDeletions(message, regex):
       """Extract all subrepo imports and deletions from a commit message."""
       # Note that a message can contain multiple imports/deletions in
@@ -1302,47 +3553,83 @@ class GitImporter:
           # the program are free to prohibit such imports.
           yield Subrepo(repo, prefix), imported_commit
 
-    def extractImports(commits, regex):
-      """Extract all subrepo imports from the given list of commits."""
-      imports = {}
-      for commit in commits:
-        message = self._retrieveMessage(commit)
-        it = importsAndDeletions(message, regex)
-        subrepo, sha1 = next(it)
-        # Ignore all subsequent import messages of subrepos that we
-        # already accounted for (with more recent commits).
-        if subrepo in imports:
-          continue
+    def checkpointImports(message):
+      """Retrieve the tree of imports recorded by a checkpoint, if the message is one."""
+      subject, _, body = message.partition("\n")
+      return parseManifest(body) if subject == CHECKPOINT_MSG else None
 
-        # We are interested in top-level deletions but those on a lower
-        # level have no value for us in this report.
-        # TODO: We potentially do not want to include the SHA1 of
-        #       imports at a lower level because unless we imported the
-        #       repository directly as well, there is no way to access
-        #       the commit (it simply is not known if the repository was
-        #       not added as remote repository). Problem is that for the
-        #       "flat" case we have to include the SHA1 sums at the
-        #       moment (fix this?).
-        imports[subrepo] = (sha1, [(k, v) for k, v in it if v is not None])
+    def extractImports(messages, regex):
+      """Extract all subrepo imports from the given list of commit messages."""
+      imports = {}
+      for message in messages:
+        checkpoint = checkpointImports(message)
+        if checkpoint is not None:
+          # A checkpoint describes the state reached by all the commits
+          # before it. More recent imports and deletions take precedence.
+          for subrepo, import_ in checkpoint.items():
+            imports.setdefault(subrepo, import_)
+          break
+
+        # A commit importing multiple subrepos is treated just like a
+        # series of commits importing one each.
+        for group in importMessageGroups(message):
+          it = importsAndDeletions(group, regex)
+          subrepo, sha1 = next(it)
+          # Ignore all subsequent import messages of subrepos that we
+          # already accounted for (with more recent commits).
+          if subrepo in imports:
+            continue
+
+          # We are interested in top-level deletions but those on a lower
+          # level have no value for us in this report.
+          # TODO: We potentially do not want to include the SHA1 of
+          #       imports at a lower level because unless we imported the
+          #       repository directly as well, there is no way to access
+          #       the commit (it simply is not known if the repository was
+          #       not added as remote repository). Problem is that for the
+          #       "flat" case we have to include the SHA1 sums at the
+          #       moment (fix this?).
+          imports[subrepo] = (sha1, [(k, v) for k, v in it if v is not None])
 
       # We want to filter out all the deletions as they should not be
       # visible to clients.
       return {k: (v, d) for k, (v, d) in imports.items() if v is not None}
 
-    def extractImportsFlat(commits, regex):
+    def extractImportsFlat(messages, regex):
       """Extract all subrepo imports into a flat dict."""
       imports = {}
-      for commit in commits:
-        message = self._retrieveMessage(commit)
-        for subrepo, sha1 in importsAndDeletions(message, regex):
-          if subrepo not in imports:
-            imports[subrepo] = sha1
+      for message in messages:
+        checkpoint = checkpointImports(message)
+        if checkpoint is not None:
+          for subrepo, sha1 in flattenImports(checkpoint).items():
+            imports.setdefault(subrepo, sha1)
+          break
+
+        for group in importMessageGroups(message):
+          for subrepo, sha1 in importsAndDeletions(group, regex):
+            if subrepo not in imports:
+              imports[subrepo] = sha1
 
       return {k: v for k, v in imports.items() if v is not None}
 
+    def flattenImports(imports):
+      """Flatten a tree of imports read from a manifest or checkpoint into a dict."""
+      # A direct import takes precedence over one as a dependency.
+      flat = {k: v for k, (v, _) in imports.items()}
+      for _, dependencies in imports.values():
+        for subrepo, sha1 in dependencies:
+          flat.setdefault(subrepo, sha1)
+
+      return flat
+
     # For the caching to work reliably the provided commit must be a
     # SHA1 hash and not just a symbolic name.
-    assert head_commit == self.resolveCommit(head_commit)
+    assert HEX_SHA1_RE.fullmatch(head_commit), head_commit
+
+    if manifest:
+      imports = self._readManifest(head_commit)
+      if imports is not None:
+        return imports if not flat else flattenImports(imports)
 
     # We create a pattern that is able to match subrepo imports as well
     # as deletions.
@@ -1352,6 +3639,198 @@ class GitImporter:
     delete_pattern = deleteMessage(subrepo)
     pattern = "%s|%s" % (import_pattern, delete_pattern)
 
+    # We match the message body line-based. We must not create a new
+    # matching group for the entire pattern, however, so use the
+    # '(?:XX) trickery here which is not available in git's regular
+    # expression syntax.
+    regex = compileRe("^(?:%s)$" % pattern, IGNORECASE)
+
+    # A nested import resides below the prefix of the import it is part
+    # of. So the commit that last changed files below a prefix reports
+    # the subrepo the files came from, no matter at which level it was
+    # imported.
+    paths = ()
+    if prefixes is not None:
+      paths = tuple(sorted({normpath(x) for x in prefixes}))
+      # An import into the root directory may change any file and names
+      # containing tabs or newlines cannot be represented in our cache.
+      if any(x == curdir or "\t" in x or "\n" in x for x in paths):
+        paths = ()
+
+    messages = self._scanImportMessages(head_commit, pattern, regex, paths)
+    if not messages:
+      return {}
+
+    extract = extractImports if not flat else extractImportsFlat
+    return extract(messages, regex)
+
+
+  def _scanImportMessages(self, head_commit, pattern, regex, paths=()):
+    """Retrieve the import and deletion lines of all commits in the history of a commit.
+
+      The result is a list of messages, one per commit importing or
+      deleting subrepos, most recent first. Each message only comprises
+      the lines matching the given regular expression. If paths are
+      given, commits not changing any file below them may be skipped.
+      Scanning the entire history is costly and so we cache the result
+      for HEAD in the git directory. If the cache contains the result
+      for an ancestor of the given commit, only the commits that are new
+      since then are scanned. The scan ends with the most recent checkpoint,
+      which is reported with all of its lines.
+    """
+    path = join(self._retrieveGitDirs()[0], IMPORT_CACHE)
+    cached = self._readImportCache(path)
+
+    for i, (tip, tip_paths, entries) in enumerate(cached):
+      # The result of a full scan can stand in for that of a path
+      # limited one, but not the other way round.
+      if tip_paths and tip_paths != paths:
+        continue
+
+      if tip == head_commit:
+        paths = tip_paths
+        break
+      elif self._isAncestorCommit(tip, head_commit):
+        entries = self._findImportCommits(head_commit, tip, pattern, regex, paths) + entries
+        break
+    else:
+      i = None
+      entries = self._findImportCommits(head_commit, None, pattern, regex, paths)
+
+    entries = self._boundByCheckpoint(entries)
+    # Only scans of our own HEAD are persisted. The histories of the
+    # commits we import are scanned once per process (the result is
+    # kept in memory by _searchImportedSubrepos) and must not evict the
+    # entries for our branch, of which we keep a couple around.
+    if (i != 0 or cached[0][0] != head_commit or cached[0][1] != paths) and\
+       self._isHeadCommit(head_commit):
+      # The most recently used result is kept first. The result we
+      # built upon is superseded by the new one, unless the latter is
+      # path limited and the former is not.
+      others = [x for j, x in enumerate(cached)
+                if x[1] != paths or (j != i and x[0] != head_commit)]
+      results = [(head_commit, paths, entries)] + others[:IMPORT_CACHE_SIZE - 1]
+      self._writeImportCache(path, results)
+
+    return ["\n".join(lines) for _, lines in entries]
+
+
+  def _boundByCheckpoint(self, entries):
+    """Remove all entries superseded by the most recent checkpoint from a list of scan entries."""
+    for i, (commit, lines) in enumerate(entries):
+      if lines[0] == CHECKPOINT_MSG:
+        # Commits that are not part of the checkpoint's history (e.g.,
+        # because they were merged later on) still count. The checkpoint
+        # itself goes last, as it stands in for everything before it.
+        rest = [x for x in entries[i + 1:] if x[1][0] != CHECKPOINT_MSG]
+        ancestors = self._findAncestorCommits([x[0] for x in rest], commit)
+        rest = [x for x in rest if x[0] not in ancestors]
+        return entries[:i] + rest + [entries[i]]
+
+    return entries
+
+
+  def _isAncestorCommit(self, ancestor, commit):
+    """Check whether a commit is an ancestor of another one."""
+    result = self._isAncestor(ancestor, [commit])
+    if result is not None:
+      return result
+
+    try:
+      self._git.execute("merge-base", "--is-ancestor", ancestor, commit)
+      return True
+    except ProcessError:
+      # Note that the ancestor may not even exist anymore.
+      return False
+
+
+  def _findAncestorCommits(self, commits, commit):
+    """Find the set of the given commits that are ancestors of another one."""
+    results = {x: self._isAncestor(x, [commit]) for x in commits}
+    unknown = [x for x, y in results.items() if y is None]
+    if unknown:
+      # Instead of asking git about each commit separately, we have it
+      # list all commits that are not reachable from the given one.
+      try:
+        out = self._git.execute("rev-list", *unknown, "^%s" % commit)
+        unreachable = set(out.decode("utf-8").splitlines())
+        results.update({x: x not in unreachable for x in unknown})
+      except ProcessError:
+        # Some of the commits may not exist anymore.
+        results.update({x: self._isAncestorCommit(x, commit) for x in unknown})
+
+    return {x for x, y in results.items() if y}
+
+
+  def _findImportCommits(self, head_commit, since, pattern, regex, paths=()):
+    """Find all commits importing or deleting subrepos in the history of a commit.
+
+      If 'since' is given, only commits not reachable from it are
+      considered. If paths are given, commits not changing any file
+      below them may be omitted. The result is a list of (commit, lines)
+      tuples, most recent first, with each commit's lines matching the
+      given regular expression. Checkpoints are reported as well, but a
+      scan of the entire history does not look beyond the most recent
+      one.
+    """
+    def matchingLines(message):
+      """Retrieve all lines of a message matching the regular expression."""
+      lines = message.splitlines()
+      if lines and lines[0] == CHECKPOINT_MSG:
+        # A checkpoint is only of value if it describes a valid state.
+        lines = [x for x in lines if x]
+        return lines if parseManifest("\n".join(lines[1:])) is not None else []
+      elif lines and lines[0] == IMPORTS_MSG:
+        # The imports are listed in the body, their dependencies
+        # indented. We keep the subject to tell them apart later on.
+        matches = [x for x in lines[1:] if regex.match(x[1:] if x.startswith(" ") else x)]
+        return lines[:1] + matches if matches else []
+
+      return [x for x in lines if regex.match(x)]
+
+    # If we only need to look at a few new commits we walk the history
+    # ourselves. For scanning the entire history git is better suited.
+    if since is not None and self._history is not None:
+      try:
+        # The changed-path Bloom filters in the commit-graph allow us to
+        # rule out most commits without reading them. Only for the
+        # remaining candidates we check the message.
+        keys = self._history.changedPathKeys(paths) if paths else None
+        entries = []
+        for commit in self._history.walk([head_commit], [since]):
+          if keys is not None and not self._history.mayChangePaths(commit, keys):
+            continue
+
+          commit_ = self._readCommit(commit)
+          if commit_ is None:
+            raise LookupError(commit)
+
+          lines = matchingLines(commit_[1])
+          if lines:
+            entries.append((commit, lines))
+
+        return entries
+      except (LookupError, StructError, ValueError):
+        pass
+
+    # The most recent checkpoint records the state reached by all the
+    # commits before it, so that we only have to look at those that are
+    # not reachable from it.
+    checkpoint = None
+    if since is None and paths:
+      # A checkpoint does not change any files and so a path limited
+      # walk never reports it. We have to look for it separately, which
+      # takes git a walk to the checkpoint and no further.
+      out = self._git.execute("rev-list", "--max-count=1", "--grep=^%s$" % CHECKPOINT_MSG,
+                              head_commit)
+      commit = out.decode("utf-8").strip()
+      if commit:
+        lines = matchingLines(self._retrieveMessage(commit))
+        checkpoint = (commit, lines) if lines else None
+    else:
+      # Otherwise checkpoints are found by the very same walk.
+      pattern = "%s|%s" % (pattern, CHECKPOINT_MSG)
+
     # The git pattern match is line based, meaning we can assume the
     # message to match starts at the beginning of the line and ends at
     # the end.
@@ -1361,23 +3840,99 @@ class GitImporter:
       "--regexp-ignore-case",
       head_commit,
     ]
+    if since is not None:
+      args += ["^%s" % since]
+    if checkpoint is not None:
+      args += ["^%s" % checkpoint[0]]
+
+    if paths:
+      # With a path limited walk git consults the changed-path Bloom
+      # filters (if any) before diffing trees and only matches the
+      # messages of the commits that changed one of the paths. We do not
+      # want it to simplify away any side branches, though.
+      args = ["--full-history"] + args + ["--"] + [":(literal)%s" % x for x in paths]
+
     out = self._git.execute("rev-list", *args)
-    if out == b"":
-      return {}
+    commits = deque(out.decode("utf-8").splitlines())
+    entries = []
+    while commits:
+      commit = commits.popleft()
+      lines = matchingLines(self._retrieveMessage(commit))
+      if not lines:
+        continue
 
-    extract = extractImports if not flat else extractImportsFlat
-    commits = out.decode("utf-8").splitlines()
-    # We match the message body line-based as well. We must not create a
-    # new matching group for the entire pattern, however, so use the
-    # '(?:XX) trickery here which is not available in git's regular
-    # expression syntax.
-    regex = compileRe("^(?:%s)$" % pattern, IGNORECASE)
-    return extract(commits, regex)
+      if checkpoint is None and since is None and lines[0] == CHECKPOINT_MSG:
+        # We cut the result at the most recent checkpoint. Note that
+        # commits listed after it are not necessarily reachable from it
+        # (they may be part of a branch merged later on), nor is the
+        # reverse true in the presence of clock skew.
+        checkpoint = (commit, lines)
+        ancestors = self._findAncestorCommits(list(commits) + [x for x, _ in entries], commit)
+        commits = deque(x for x in commits if x not in ancestors)
+        entries = [x for x in entries if x[0] not in ancestors]
+        continue
+
+      entries.append((commit, lines))
+
+    if checkpoint is not None:
+      entries.append(checkpoint)
+
+    return entries
+
+
+  @staticmethod
+  def _readImportCache(path):
+    """Read the import cache, return a list of (tip, paths, entries) tuples."""
+    # The cache contains the results of a couple of history scans. Each
+    # starts with a line "tip <sha1>", followed by the paths the scan was
+    # limited to (if any), each preceded by a tab. Then come the commits
+    # importing or deleting subrepos in the form "commit <sha1>", each
+    # followed by the matching lines of its message, indented by a space.
+    results = []
+    try:
+      with open(path, "r") as file_:
+        for line in file_:
+          line = line.rstrip("\n")
+          if line.startswith(" "):
+            results[-1][2][-1][1].append(line[1:])
+            continue
+
+          kind, _, rest = line.partition(" ")
+          sha1, *paths = rest.split("\t")
+          if not HEX_SHA1_RE.fullmatch(sha1):
+            return []
+          elif kind == "tip":
+            results.append((sha1, tuple(paths), []))
+          elif kind == "commit" and not paths:
+            results[-1][2].append((sha1, []))
+          else:
+            return []
+    except (IndexError, OSError, ValueError):
+      # A corrupted cache is treated just like a missing one.
+      return []
+
+    return results
+
+
+  @staticmethod
+  def _writeImportCache(path, results):
+    """Write the import cache."""
+    lines = []
+    for tip, paths, entries in results:
+      lines += ["\t".join(("tip %s" % tip,) + paths)]
+      for commit, matches in entries:
+        lines += ["commit %s" % commit] + [" %s" % x for x in matches]
+
+    _writeCacheFile(path, lines)
 
 
 def _retrieveSubrepoFromNamespace(namespace, git):
   """Given a namespace retrieve a Subrepo object for the prefix:repo attributes."""
-  repo = getattr(namespace, "remote-repository")
+  return _retrieveSubrepo(getattr(namespace, "remote-repository"), namespace.prefix, git)
+
+
+def _retrieveSubrepo(repo, prefix, git):
+  """Retrieve a Subrepo object for a repository and a prefix relative to the working directory."""
   # The user-given prefix is to be treated relative to the current
   # working directory. This directory is not necessarily equal to the
   # current repository's root. So we have to perform some path magic in
@@ -1385,7 +3940,7 @@ def _retrieveSubrepoFromNamespace(namespace, git):
   # repository's root. If we did nothing here git would always treat the
   # prefix relative to the root directory which would result in
   # unexpected behavior.
-  prefix = relpath(namespace.prefix)
+  prefix = relpath(prefix)
   prefix = relpath(prefix, start=git.root)
   prefix = trail(prefix)
   return Subrepo(repo, prefix)
@@ -1393,13 +3948,49 @@ def _retrieveSubrepoFromNamespace(namespace, git):
 
 def performImport(git, namespace):
   """Perform a subrepo import."""
+  entries = [(getattr(namespace, "remote-repository"), namespace.prefix, namespace.commit)]
+  return _performImportEntries(git, namespace, entries)
+
+
+def performImportManifest(git, namespace):
+  """Perform the import of all subrepos listed in a manifest."""
+  try:
+    entries = _readImportManifest(namespace.manifest)
+  except OSError as e:
+    print("%s" % e, file=stderr)
+    return 1
+
+  return _performImportEntries(git, namespace, entries, manifest=True)
+
+
+def _performImportEntries(git, namespace, entries, manifest=False):
+  """Import a list of (remote-repository, prefix, commit) tuples, possibly without a working tree."""
+  if namespace.no_worktree:
+    if namespace.edit:
+      print("Cannot import: --edit requires a working tree.", file=stderr)
+      return 1
+
+    with git.privateIndex():
+      return _performImport(git, namespace, entries, manifest)
+
+  return _performImport(git, namespace, entries, manifest)
+
+
+def _performImport(git, namespace, entries, manifest=False):
+  """Import a list of (remote-repository, prefix, commit) tuples into the current index and commit them."""
+  # We gather everything the checks preceding the import need at once.
+  snapshot = git.preflight([(repo, commit) for repo, _, commit in entries])
+
   # If the user has cached changes we do not continue as they would be
-  # discarded.
-  if git.hasCachedChanges():
+  # discarded. Note that a private index is always clean.
+  if not snapshot.clean:
     print("Cannot import: Your index contains uncommitted changes.\n"
           "Please commit or stash them.", file=stderr)
     return 1
 
+  if manifest:
+    return _performManifestImport(git, namespace, entries)
+
   subrepo = _retrieveSubrepoFromNamespace(namespace, git)
   # We always resolve the possibly symbolic commit name into a SHA1
   # hash. The main reason is that we want this hash to be contained in
@@ -1412,11 +4003,16 @@ def performImport(git, namespace):
     print(msg, file=stderr)
     return 1
 
-  git.import_(subrepo, sha1)
+  # Behave similarly to git commit when invoked with no changes made to
+  # the repository's state and return 1. If we can tell upfront that
+  # nothing is going to change we do not even create the patches.
+  if git.isUpToDate({subrepo: sha1}):
+    print("No changes", file=stderr)
+    return 1
+
+  git.import_(subrepo, sha1, renames=namespace.renames)
 
   if not git.hasCachedChanges():
-    # Behave similarly to git commit when invoked with no changes made
-    # to the repository's state and return 1.
     print("No changes", file=stderr)
     return 1
 
@@ -1424,6 +4020,73 @@ def performImport(git, namespace):
   return 0
 
 
+def _readImportManifest(path):
+  """Read a list of (remote-repository, prefix, commit) tuples to import from a file."""
+  entries = []
+  with open(path, "r") as file_:
+    for number, line in enumerate(file_, 1):
+      # Empty lines and comments are ignored.
+      if not line.strip() or line.lstrip().startswith("#"):
+        continue
+
+      fields = line.split()
+      if len(fields) != 3:
+        raise SubrepoError("%s:%d: Expected <remote-repository> <prefix> <commit>." % (path, number))
+
+      entries.append(tuple(fields))
+
+  return entries
+
+
+def _performManifestImport(git, namespace, entries):
+  """Import all subrepos listed in a manifest into the current index and commit them at once."""
+  imports = {}
+  for repo, prefix, commit in entries:
+    subrepo = _retrieveSubrepo(repo, prefix, git)
+    sha1 = git.resolveRemoteCommit(subrepo.repo, commit)
+
+    if not namespace.force and not git.belongsToRepository(subrepo.repo, sha1):
+      msg = "{sha1} is not a reachable commit in remote repository {repo}."
+      msg = msg.format(sha1=sha1, repo=subrepo.repo)
+      print(msg, file=stderr)
+      return 1
+
+    # All subrepos are imported using a single patch and so none of
+    # them must end up in the directory of another.
+    for other in imports:
+      if other.prefix.startswith(subrepo.prefix) or subrepo.prefix.startswith(other.prefix) or\
+         ROOT_PREFIX in (subrepo.prefix, other.prefix):
+        msg = "Cannot import: The prefixes of {a} and {b} overlap."
+        print(msg.format(a=other, b=subrepo), file=stderr)
+        return 1
+
+    imports[subrepo] = sha1
+
+  if not imports:
+    print("Nothing to import", file=stderr)
+    return 1
+
+  if git.isUpToDate(imports):
+    print("No changes", file=stderr)
+    return 1
+
+  git.importAll(imports, renames=namespace.renames)
+
+  if not git.hasCachedChanges():
+    print("No changes", file=stderr)
+    return 1
+
+  if len(imports) == 1:
+    # A single import is recorded just like one given on the command
+    # line.
+    (subrepo, sha1), = imports.items()
+    git.commitImport(subrepo, sha1, namespace.edit)
+  else:
+    git.commitImports(imports, namespace.edit)
+
+  return 0
+
+
 def performReimport(git, namespace):
   """Perform a subrepo reimport, if necessary."""
   if git.hasCachedChanges():
@@ -1450,6 +4113,18 @@ def performDelete(git, namespace):
   return 0
 
 
+def performCheckpoint(git, namespace):
+  """Create a checkpoint of the current state of imports."""
+  # The checkpoint commit is meant to be empty.
+  if git.hasCachedChanges():
+    print("Cannot checkpoint: Your index contains uncommitted changes.\n"
+          "Please commit or stash them.", file=stderr)
+    return 1
+
+  git.commitCheckpoint(namespace.edit)
+  return 0
+
+
 def performTree(git, namespace):
   """Dump the dependency tree of all imported subrepos."""
   def indent(*args):
@@ -1500,13 +4175,487 @@ def performTree(git, namespace):
   return 0
 
 
-def main(argv):
-  """The main function interprets the arguments and acts upon them."""
-  parser = setupArgumentParser()
-  namespace = parser.parse_args(argv[1:])
+def _formatSize(size):
+  """Format a size in bytes for humans."""
+  for unit in ["B", "KiB", "MiB"]:
+    if size < 1024:
+      break
+    size /= 1024
+  else:
+    unit = "GiB"
+
+  return "%d %s" % (size, unit) if unit == "B" else "%.1f %s" % (size, unit)
+
+
+def performMaintenance(git, namespace):
+  """Write the commit-graph and refresh our caches, report their state."""
+  if not namespace.report:
+    git.writeCommitGraph()
+    git.refreshCaches()
+
+  for name, path, details, fresh in git.retrieveMaintenanceState():
+    try:
+      info = stat(path)
+    except OSError:
+      print("%s: missing" % name)
+      continue
+
+    print("%s: %s, %s, updated %s, %s" % (
+      name,
+      details,
+      _formatSize(info.st_size),
+      strftime("%Y-%m-%d %H:%M:%S", localtime(info.st_mtime)),
+      "up to date" if fresh else "stale",
+    ))
+
+  return 0
+
+
+def _fleetImport(git, subrepo, sha1, force=False, renames=False):
+  """Import a subrepo into the current index as part of the 'fleet' command, return the outcome."""
+  if not force and not git.belongsToRepository(subrepo.repo, sha1):
+    msg = "{sha1} is not a reachable commit in remote repository {repo}."
+    raise SubrepoError(msg.format(sha1=sha1, repo=subrepo.repo))
+
+  if git.isUpToDate({subrepo: sha1}):
+    return "unchanged", ""
+
+  git.import_(subrepo, sha1, renames=renames)
+  if not git.hasCachedChanges():
+    return "unchanged", ""
+
+  git.commitImport(subrepo, sha1)
+  return "imported", git.resolveCommit("HEAD")
+
+
+def _fleetWorker(path, subrepo, commit, fetch=False, status=False, no_worktree=False,
+                 force=False, renames=False):
+  """Work on a single repository for the 'fleet' command, return an (outcome, details) tuple."""
+  # Workers are separate processes, each working on one repository at
+  # a time, so that we are free to change the working directory.
+  try:
+    chdir(path)
+    git = GitImporter()
+    if fetch:
+      git._git.execute("fetch", "--quiet", subrepo.repo)
+
+    # The index is of no concern if we do not touch it.
+    snapshot = git.preflight([(subrepo.repo, commit)], index=not status and not no_worktree)
+    sha1 = git.resolveRemoteCommit(subrepo.repo, commit)
+    if status:
+      current = None
+      if git._hasHead():
+        imports = git._searchImportedSubrepos(git.resolveCommit("HEAD"), flat=True)
+        current = imports.get(subrepo)
+
+      if current is None:
+        return "not imported", ""
+
+      return ("up to date", current) if current == sha1 else ("outdated", current)
+
+    if no_worktree:
+      with git.privateIndex():
+        return _fleetImport(git, subrepo, sha1, force, renames)
+
+    if not snapshot.clean:
+      return "failed", "Your index contains uncommitted changes."
+
+    return _fleetImport(git, subrepo, sha1, force, renames)
+  except (OSError, ProcessError, SubrepoError) as e:
+    return "failed", str(e)
+
+
+def _readRepositoryList(path):
+  """Read the list of repository paths for the 'fleet' command."""
+  if path == "-":
+    lines = stdin.read().splitlines()
+  else:
+    with open(path, "r") as file_:
+      lines = file_.read().splitlines()
+
+  # Empty lines and comments are ignored. Relative paths are interpreted
+  # relative to the current working directory.
+  return [abspath(x.strip()) for x in lines if x.strip() and not x.lstrip().startswith("#")]
+
+
+def performFleet(git, namespace):
+  """Import a subrepo into many repositories in parallel and report the outcome."""
+  # The concurrent.futures module is costly to load and only needed
+  # here.
+  from concurrent.futures import (
+    ProcessPoolExecutor,
+  )
+
+  try:
+    paths = _readRepositoryList(namespace.repositories)
+  except OSError as e:
+    print("%s" % e, file=stderr)
+    return 1
+
+  if namespace.jobs is not None and namespace.jobs < 1:
+    print("The number of jobs must be positive.", file=stderr)
+    return 1
+
+  repo = getattr(namespace, "remote-repository")
+  subrepo = Subrepo(repo, trail(normpath(namespace.prefix)))
+
+  # We must never work on a repository from two workers at the same
+  # time and so each repository is listed once, no matter how it is
+  # referenced.
+  repositories = {}
+  for path in paths:
+    repositories.setdefault(realpath(path), path)
+
+  args = (subrepo, namespace.commit, namespace.fetch, namespace.status, namespace.no_worktree,
+          namespace.force, namespace.renames)
+  results = {}
+  with ProcessPoolExecutor(max_workers=namespace.jobs) as executor:
+    futures = {path: executor.submit(_fleetWorker, path, *args)
+               for path in repositories.values()}
+    for path, future in futures.items():
+      try:
+        results[path] = future.result()
+      except Exception as e:
+        # E.g., a worker died unexpectedly.
+        results[path] = ("failed", str(e) or type(e).__name__)
+
+  counts = {}
+  for path in repositories.values():
+    outcome, details = results[path]
+    counts[outcome] = counts.get(outcome, 0) + 1
+    if outcome == "failed":
+      print("%s: %s" % (path, outcome))
+      for line in details.splitlines():
+        print("  %s" % line)
+    else:
+      print("%s: %s" % (path, " ".join(filter(None, (outcome, details)))))
+
+  summary = ", ".join("%d %s" % (v, k) for k, v in sorted(counts.items()))
+  print("%d repositories: %s" % (len(repositories), summary or "nothing to do"))
+  return 1 if "failed" in counts else 0
 
+
+def performServe(git, namespace):
+  """Serve subrepo operations requested over a Unix domain socket."""
+  # The server changes the working directory for each request.
+  SubrepoServer().serve(abspath(namespace.socket), namespace.timeout)
+  return 0
+
+
+@contextmanager
+def _capturedOutput(output):
+  """Capture everything written to stdout and stderr, appending the two strings to a list."""
+  # We redirect on the file descriptor level, so that nothing escapes,
+  # no matter how it is written.
+  from tempfile import (
+    TemporaryFile,
+  )
+
+  with TemporaryFile() as out,\
+       TemporaryFile() as err:
+    stdout.flush()
+    stderr.flush()
+    saved = [dup(1), dup(2)]
+    dup2(out.fileno(), 1)
+    dup2(err.fileno(), 2)
+    try:
+      yield
+    finally:
+      stdout.flush()
+      stderr.flush()
+      dup2(saved[0], 1)
+      dup2(saved[1], 2)
+      close(saved[0])
+      close(saved[1])
+
+      for file_ in (out, err):
+        file_.seek(0)
+        output.append(file_.read().decode("utf-8", "replace"))
+
+
+@contextmanager
+def _clientEnvironment(cwd, env):
+  """Temporarily adopt the working directory and git environment variables of a client."""
+  old_cwd = getcwd()
+  old_environ = dict(environ)
+  for key in [x for x in environ if x.startswith("GIT_")]:
+    del environ[key]
+
+  environ.update({k: v for k, v in env.items() if k.startswith("GIT_")})
+  try:
+    chdir(cwd)
+    yield
+  finally:
+    chdir(old_cwd)
+    environ.clear()
+    environ.update(old_environ)
+
+
+class SubrepoServer:
+  """A server performing subrepo operations requested over a Unix domain socket.
+
+    Starting git-subrepo and building up its caches anew for every
+    operation is wasteful when many operations are to be performed. A
+    server keeps an importer per repository root around between
+    requests. Each request is a single line containing a JSON object:
+      {"command": <command>, "cwd": <directory>, "args": [<argument>...],
+       "env": {<GIT_* variable>: <value>...}}
+    The response is a JSON object on a single line as well:
+      {"status": <exit status>, "stdout": <output>, "stderr": <output>,
+       "result": {...}, "timings": {<phase>: <seconds>...}}
+    Requests are answered one after the other, which serializes the
+    operations on each repository. That is inevitable, as operations
+    work relative to the process' working directory and environment.
+  """
+  def __init__(self):
+    """Initialize the server."""
+    self._importers = {}
+    self._importer = None
+    self._started = monotonic()
+    self._requests = 0
+
+
+  def _retrieveImporter(self, debug_commands=False):
+    """Retrieve the importer for the repository in the current working directory."""
+    root = _retrieveRepositoryRoot(debug_commands)
+    importer = self._importers.get(root)
+    if importer is None:
+      importer = GitImporter(debug_commands, root)
+      self._importers[root] = importer
+    else:
+      importer.refresh(debug_commands)
+
+    self._importer = importer
+    return importer
+
+
+  @staticmethod
+  def _describeResult(git, command):
+    """Describe the state of the repository after a successful operation."""
+    def describe(subrepo, sha1):
+      """Describe an import."""
+      return {"repo": subrepo.repo, "prefix": subrepo.prefix, "commit": sha1}
+
+    if not git._hasHead():
+      return {}
+
+    head = git.resolveCommit("HEAD")
+    if command != "tree":
+      return {"head": head}
+
+    imports = []
+    for subrepo, (sha1, dependencies) in git._searchImportedSubrepos(head).items():
+      import_ = describe(subrepo, sha1)
+      import_["dependencies"] = [describe(*x) for x in dependencies]
+      imports.append(import_)
+
+    return {"head": head, "imports": imports}
+
+
+  def _perform(self, command, args, timings):
+    """Perform a command in the current working directory, return its status and result."""
+    start = monotonic()
+    try:
+      namespace = setupArgumentParser(command).parse_args([command] + args)
+    except SystemExit as e:
+      # The parser reports errors (and help requests) by exiting.
+      return e.code if isinstance(e.code, int) else 1, {}
+    finally:
+      timings["parse"] = monotonic() - start
+
+    if getattr(namespace, "edit", False):
+      print("Cannot %s: --edit is not supported by the server." % command, file=stderr)
+      return 1, {}
+
+    start = monotonic()
+    self._importer = None
+    try:
+      status = _runCommand(namespace, self._retrieveImporter)
+      result = {}
+      if status == 0 and self._importer is not None:
+        result = self._describeResult(self._importer, command)
+      return status, result
+    except Exception as e:
+      # An unexpected error must not take down the server.
+      print("%s" % e, file=stderr)
+      return 1, {}
+    finally:
+      timings["command"] = monotonic() - start
+
+
+  def answer(self, request):
+    """Answer a request, i.e., a dict decoded from JSON."""
+    start = monotonic()
+    self._requests += 1
+    timings = {}
+    result = {}
+    output = []
+
+    command = request.get("command")
+    cwd = request.get("cwd")
+    args = request.get("args", [])
+    env = request.get("env", {})
+
+    if command == "status":
+      status = 0
+      output = ["", ""]
+      result = {
+        "pid": getpid(),
+        "uptime": monotonic() - self._started,
+        "requests": self._requests,
+        "repositories": sorted(self._importers.keys()),
+      }
+    elif command not in SERVER_COMMANDS:
+      status = 1
+      output = ["", "Unsupported command: %s\n" % command]
+    elif not isinstance(cwd, str) or not isinstance(args, list) or\
+         not all(isinstance(x, str) for x in args) or not isinstance(env, dict) or\
+         not all(isinstance(x, str) for x in env.values()):
+      status = 1
+      output = ["", "Malformed request.\n"]
+    else:
+      with _capturedOutput(output):
+        try:
+          with _clientEnvironment(cwd, env):
+            status, result = self._perform(command, args, timings)
+        except OSError as e:
+          # The working directory of the client is not accessible.
+          print("%s" % e, file=stderr)
+          status = 1
+
+    timings["total"] = monotonic() - start
+    return {
+      "status": status,
+      "stdout": output[0],
+      "stderr": output[1],
+      "result": result,
+      "timings": timings,
+    }
+
+
+  def _answerConnection(self, connection):
+    """Read a request from a connection and send back the response."""
+    # The JSON module is only needed when talking to a server or client.
+    from json import (
+      dumps,
+      loads,
+    )
+
+    connection.settimeout(SERVER_REQUEST_TIMEOUT)
+    try:
+      with connection.makefile("rb") as file_:
+        request = loads(file_.readline().decode("utf-8"))
+
+      if not isinstance(request, dict):
+        raise ValueError("Malformed request.")
+
+      response = self.answer(request)
+    except OSError:
+      # The client went away or did not send a request in time.
+      return
+    except ValueError as e:
+      response = {"status": 1, "stdout": "", "stderr": "%s\n" % e, "result": {}, "timings": {}}
+
+    try:
+      connection.settimeout(None)
+      connection.sendall((dumps(response) + "\n").encode("utf-8"))
+    except OSError:
+      pass
+
+
+  def serve(self, path, timeout=None):
+    """Serve requests on a Unix domain socket until no request arrived for 'timeout' seconds."""
+    from socket import (
+      AF_UNIX,
+      SOCK_STREAM,
+      socket,
+    )
+
+    if lexists(path):
+      # A socket left behind by a server that is no longer running is
+      # removed. Anything else we leave alone.
+      if not S_ISSOCK(stat(path).st_mode):
+        raise SubrepoError("%s exists and is not a socket." % path)
+
+      with socket(AF_UNIX, SOCK_STREAM) as probe:
+        if probe.connect_ex(path) == 0:
+          raise SubrepoError("A server is listening on %s already." % path)
+
+      unlink(path)
+
+    with socket(AF_UNIX, SOCK_STREAM) as server:
+      # Only the user running the server may talk to it.
+      old_umask = umask(0o077)
+      try:
+        server.bind(path)
+      finally:
+        umask(old_umask)
+
+      try:
+        server.listen()
+        server.settimeout(timeout)
+        while True:
+          try:
+            connection, _ = server.accept()
+          except OSError:
+            # The only error we expect is a timeout.
+            break
+
+          with connection:
+            self._answerConnection(connection)
+      finally:
+        unlink(path)
+
+
+def _requestServer(path, command, args):
+  """Let a server perform a command, return its exit status or None if it cannot be reached."""
+  from json import (
+    dumps,
+    loads,
+  )
+  from socket import (
+    AF_UNIX,
+    SOCK_STREAM,
+    socket,
+  )
+
+  request = {
+    "command": command,
+    "cwd": getcwd(),
+    "args": args,
+    "env": {k: v for k, v in environ.items() if k.startswith("GIT_")},
+  }
+  with socket(AF_UNIX, SOCK_STREAM) as connection:
+    try:
+      connection.connect(path)
+    except OSError:
+      # We just perform the operation ourselves.
+      return None
+
+    try:
+      connection.sendall((dumps(request) + "\n").encode("utf-8"))
+      with connection.makefile("rb") as file_:
+        response = loads(file_.readline().decode("utf-8"))
+
+      print(response["stdout"], end="")
+      print(response["stderr"], end="", file=stderr)
+      return response["status"]
+    except (KeyError, OSError, TypeError, ValueError):
+      # At this point the operation may have been performed already, so
+      # we cannot just retry it ourselves.
+      raise SubrepoError("Invalid response from server at %s." % path)
+
+
+def _runCommand(namespace, importer):
+  """Perform the command described by a namespace, reporting errors.
+
+    'importer' is invoked to create the GitImporter object to work with.
+  """
   try:
-    git = GitImporter(namespace.debug_commands)
+    git = None
+    if getattr(namespace, "repository", True):
+      git = importer(namespace.debug_commands)
+
     assert hasattr(namespace, "perform_command")
     return namespace.perform_command(git, namespace)
   except (AttributeError, ProcessError, SubrepoError) as e:
@@ -1522,5 +4671,29 @@ def main(argv):
       return 1
 
 
+def main(argv):
+  """The main function interprets the arguments and acts upon them."""
+  command = findCommandName(argv[1:])
+  parser = setupArgumentParser(command)
+  namespace = parser.parse_args(argv[1:])
+
+  # If a server is available we let it perform the operation. Only it
+  # cannot bring up an editor for us.
+  path = environ.get(SERVER_SOCKET_ENV)
+  if path and command in SERVER_COMMANDS and not getattr(namespace, "edit", False):
+    args = argv[1:]
+    args = args[args.index(command) + 1:]
+    try:
+      status = _requestServer(path, command, args)
+    except SubrepoError as e:
+      print("%s" % e, file=stderr)
+      return 1
+
+    if status is not None:
+      return status
+
+  return _runCommand(namespace, GitImporter)
+
+
 if __name__ == "__main__":
   exit(main(sysargv))
@@ -21,6 +21,7 @@
 
 from contextlib import (
   contextmanager,
+  redirect_stdout,
 )
 from deso.execute import (
   execute,
@@ -35,13 +36,26 @@ from deso.git.repo import (
   write,
 )
 from deso.git.subrepo import (
+  GitHistory,
   GitImporter,
+  GitObjectStore,
+  GitRefStore,
+)
+from io import (
+  StringIO,
+)
+from json import (
+  dumps,
+  loads,
 )
 from os import (
   chdir,
+  chmod,
   getcwd,
+  listdir,
   mkdir,
   pardir,
+  unlink,
 )
 from os.path import (
   basename,
@@ -53,9 +67,18 @@ from os.path import (
 from random import (
   randint,
 )
+from socket import (
+  AF_UNIX,
+  SOCK_STREAM,
+  socket,
+)
+from subprocess import (
+  Popen,
+)
 from sys import (
   argv as sysargv,
   executable,
+  modules,
 )
 from tempfile import (
   TemporaryDirectory,
@@ -69,6 +92,7 @@ from unittest import (
   TestCase,
 )
 from unittest.mock import (
+  call,
   patch,
 )
 
@@ -78,13 +102,13 @@ GIT = findCommand("git")
 GIT_SUBREPO = realpath(join(dirname(__file__), pardir, "git-subrepo.py"))
 
 
-def _subrepo(*args, **kwargs):
+def _subrepo(*args, python_args=(), **kwargs):
   """Invoke git-subrepo with the given arguments."""
   env = {}
   PathMixin.inheritEnv(env)
   PythonMixin.inheritEnv(env)
 
-  return execute(executable, GIT_SUBREPO, *args, env=env, **kwargs)
+  return execute(executable, *python_args, GIT_SUBREPO, *args, env=env, **kwargs)
 
 
 @contextmanager
@@ -98,6 +122,43 @@ def changeDir(directory):
     chdir(cwd)
 
 
+@contextmanager
+def countForks():
+  """Count the processes git-subrepo launches, with context manager support."""
+  module = modules["deso.git.subrepo.git-subrepo"]
+  execute_ = module.execute_
+  spring_ = module.spring_
+  forks = []
+
+  def execute(*args, **kwargs):
+    """Count and run a single command."""
+    forks.append(args)
+    return execute_(*args, **kwargs)
+
+  def spring(commands, **kwargs):
+    """Count and run each command of a spring."""
+    for command in commands:
+      # The first element of a spring may be a list of commands.
+      forks.extend(command if isinstance(command[0], list) else [command])
+
+    return spring_(commands, **kwargs)
+
+  with patch.object(module, "execute_", execute),\
+       patch.object(module, "spring_", spring):
+    yield forks
+
+
+def _subrepoInProcess(repo, *args):
+  """Invoke git-subrepo in the current process, return its exit status and output."""
+  module = modules["deso.git.subrepo.git-subrepo"]
+  output = StringIO()
+  with changeDir(repo.path()), redirect_stdout(output),\
+       patch.object(module, "stderr", StringIO()):
+    status = module.main([GIT_SUBREPO] + list(args))
+
+  return status, output.getvalue()
+
+
 class GitRepository(PathMixin, PythonMixin, Repository):
   """A git repository with subrepo support."""
   def __init__(self):
@@ -536,6 +597,28 @@ class TestGitSubrepo(TestCase):
     doTest("prefix")
 
 
+  def testImportSubrepoAtCurrentStateModified(self):
+    """Verify that importing a subrepo at its current commit restores locally modified files."""
+    with GitRepository() as r1,\
+         GitRepository() as r2:
+      write(r1, "test.py", data="# test.py")
+      r1.add("test.py")
+      r1.commit()
+
+      r2.remote("add", "--fetch", "test", r1.path())
+      r2.subrepo("import", "test", "prefix", "master")
+
+      write(r2, "prefix", "test.py", data="# modified")
+      r2.add(r2.path("prefix", "test.py"))
+      r2.commit()
+
+      r2.subrepo("import", "test", "prefix", "master")
+      self.assertEqual(read(r2, "prefix", "test.py"), "# test.py")
+
+      with self.assertRaisesRegex(ProcessError, r"No changes"):
+        r2.subrepo("import", "test", "prefix", "master")
+
+
   def testImportEmptySubrepo(self):
     """Try importing an empty subrepo."""
     def doTest(prefix):
@@ -1536,6 +1619,26 @@ class TestGitSubrepo(TestCase):
     doTest("foo")
 
 
+  def testCannotDeleteRemovedSubrepo(self):
+    """Verify that deleting an already removed subrepo fails without creating a commit."""
+    with GitRepository() as r1,\
+         GitRepository() as r2:
+      write(r1, "r1.c", data="r1")
+      r1.add("r1.c")
+      r1.commit()
+
+      r2.remote("add", "--fetch", "r1", r1.path())
+      r2.subrepo("import", "r1", "lib", "master")
+      r2.git("rm", "-r", "--quiet", "lib")
+      r2.commit()
+
+      sha1 = r2.revParse("HEAD")
+      with self.assertRaisesRegex(ProcessError, r"Nothing to commit"):
+        r2.subrepo("delete", "r1", "lib")
+
+      self.assertEqual(r2.revParse("HEAD"), sha1)
+
+
   def testCannotDeleteSubrepoAtOtherPrefix(self):
     """Verify that subrepo deletion only works with the correct prefix."""
     def doTest(import_prefix, delete_prefix):
@@ -1652,7 +1755,8 @@ class TestGitSubrepo(TestCase):
   def testCompletion(self):
     """Verify that commands and arguments can be completed properly."""
     self.performCompletion(["--h"], {"--help"})
-    self.performCompletion(["imp"], {"import"})
+    self.performCompletion(["imp"], {"import", "import-manifest"})
+    self.performCompletion(["import-manifest", "--r"], {"--renames"})
     self.performCompletion(["import", "--debug"], {"--debug-commands", "--debug-exceptions"})
     self.performCompletion(["import", "--f"], {"--force"})
     self.performCompletion(["re"], {"reimport"})
@@ -1736,6 +1840,46 @@ class TestGitSubrepo(TestCase):
         self.performCompletion(["delete", "r1", "."], {"./"}, r3)
 
 
+  def testCompletionCache(self):
+    """Verify that completions use a cache that is invalidated on HEAD changes."""
+    with GitRepository() as r1,\
+         GitRepository() as r2:
+      write(r1, "1.rst", data="// number one")
+      r1.add("1.rst")
+      r1.commit()
+
+      r2.commit("--allow-empty")
+      r2.remote("add", "--fetch", "r1", r1.path())
+      r2.subrepo("import", "r1", "prefix1", "master")
+
+      cache = (".git", "subrepo-completion-cache")
+      self.assertFalse(exists(r2.path(*cache)))
+      self.performCompletion(["delete", "r"], {"r1"}, r2)
+      self.assertTrue(exists(r2.path(*cache)))
+
+      # Tamper with the cache. As long as HEAD is unchanged the cached
+      # content is used for completion.
+      head = r2.revParse("HEAD")
+      sha1 = r1.revParse("HEAD")
+      write(r2, *cache, data="%s\nrx\tpx\t%s\n" % (head, sha1))
+      self.performCompletion(["delete", "r"], {"rx"}, r2)
+      self.performCompletion(["delete", "rx", "p"], {"px/"}, r2)
+
+      r2.commit("--allow-empty")
+      self.performCompletion(["delete", "r"], {"r1"}, r2)
+      self.assertEqual(read(r2, *cache).splitlines()[0], r2.revParse("HEAD"))
+
+      # If the cache cannot be written, completion still works and no
+      # temporary file is left behind.
+      unlink(r2.path(*cache))
+      mkdir(r2.path(*cache))
+      write(r2, *cache, "blocker", data="")
+      r2.commit("--allow-empty")
+      self.performCompletion(["delete", "r"], {"r1"}, r2)
+      self.assertEqual(listdir(r2.path(".git")).count(cache[1]), 1)
+      self.assertFalse([x for x in listdir(r2.path(".git")) if x.startswith(cache[1] + ".")])
+
+
   def testCompleteReimport(self):
     """Verify that completion works properly for the 'reimport' command's parameters."""
     with GitRepository() as remote,\
@@ -1756,6 +1900,23 @@ class TestGitSubrepo(TestCase):
       self.performCompletion(["reimport", "--remote", ""], {"remote"}, repo)
 
 
+  def testCompletePackedRemoteRefs(self):
+    """Verify that completion of remote refs covers packed and nested refs."""
+    with GitRepository() as remote,\
+         GitRepository() as repo:
+      remote.commit("--allow-empty")
+      remote.branch("feature/nested")
+      remote.branch("fix")
+
+      repo.remote("add", "--fetch", "remote", remote.path())
+      repo.git("pack-refs", "--all")
+      self.assertFalse(exists(repo.path(".git", "refs", "remotes", "remote", "master")))
+
+      self.performCompletion(["import", "remote", "prefix", "m"], {"master"}, repo)
+      self.performCompletion(["import", "remote", "prefix", "f"], {"feature/nested", "fix"}, repo)
+      self.performCompletion(["reimport", "--branch", "fe"], {"feature/nested"}, repo)
+
+
   def testCompleteOutsideOfRepository(self):
     """Verify that completion outside of a git repository does not cause unexpected failures."""
     with TemporaryDirectory() as dir_:
@@ -1767,5 +1928,994 @@ class TestGitSubrepo(TestCase):
         self.performCompletion(["delete", "."], 1)
 
 
+  def testCompletionServer(self):
+    """Verify that a completion server answers multiple completion requests."""
+    with GitRepository() as repo:
+      requests = [
+        [repo.path(), "1", "git-subrepo", "re"],
+        [repo.path(), "2", "git-subrepo", "import", "--f"],
+        [repo.path(), "2", "git-subrepo", "delete", "--d"],
+      ]
+      data = "".join("\t".join(x) + "\n" for x in requests).encode()
+      out, _ = _subrepo("--_complete-server", "10", stdin=data, stdout=b"")
+
+      lines = out.decode().splitlines()
+      self.assertEqual(lines[0:2], ["1", "reimport"])
+      self.assertEqual(lines[2:4], ["1", "--force"])
+      self.assertEqual(lines[4], "2")
+      self.assertSetEqual(set(lines[5:]), {"--debug-commands", "--debug-exceptions"})
+
+
+  def testCompletionImportTime(self):
+    """Verify that a completion stays within its import time budget."""
+    # The budget for importing all modules, in microseconds. It is
+    # intentionally generous as we do not want to fail on a slow or
+    # loaded machine. The main purpose is to catch heavy imports
+    # sneaking back in.
+    budget = 250000
+    argv = ["--_complete", "2", sysargv[0], "import", "--debug"]
+
+    with TemporaryDirectory() as dir_:
+      with changeDir(dir_):
+        _, err = _subrepo(*argv, python_args=["-X", "importtime"], stdout=b"")
+
+    modules = {}
+    total = 0
+    for line in err.decode().splitlines():
+      # Each line has the format:
+      # import time: <self [us]> | <cumulative> | <imported package>
+      if not line.startswith("import time:") or "self [us]" in line:
+        continue
+
+      _, cumulative, module = line.split("|")
+      modules[module.strip()] = int(cumulative)
+      # Only top-level imports contribute to the total, all others are
+      # already accounted for in their parent's cumulative time.
+      if not module.startswith("  "):
+        total += int(cumulative)
+
+    self.assertIn("deso.argcomp", modules)
+    # None of these modules is required for completing arguments.
+    for module in ["tempfile", "concurrent.futures", "logging"]:
+      self.assertNotIn(module, modules)
+
+    self.assertLess(total, budget)
+
+
+  def testRefStoreResolve(self):
+    """Verify that the ref store resolves loose, packed, and symbolic refs like git does."""
+    with GitRepository() as repo:
+      store = GitRefStore.discover(repo.path())
+      self.assertEqual(store.root, repo.path())
+      self.assertIsNone(store.resolve("HEAD"))
+
+      repo.commit("--allow-empty")
+      for i in range(32):
+        repo.branch("branch%02d" % i)
+        repo.commit("--allow-empty")
+
+      repo.tag("--annotate", "--message=tag", "annotated", "branch07")
+      repo.symbolicRef("refs/heads/symbolic", "refs/heads/branch13")
+      repo.packRefs("--all")
+      self.assertFalse(exists(repo.path(".git", "refs", "heads", "branch00")))
+      # Make sure that a loose ref takes precedence over a packed one.
+      repo.updateRef("refs/heads/branch21", "branch03")
+
+      refs = ["HEAD", "refs/heads/master", "refs/heads/symbolic", "refs/tags/annotated"]
+      refs += ["refs/heads/branch%02d" % i for i in range(32)]
+      for ref in refs:
+        self.assertEqual(store.resolve(ref), repo.revParse("%s^{commit}" % ref), ref)
+
+      self.assertIsNone(store.resolve("refs/heads/branch"))
+      self.assertIsNone(store.resolve("refs/heads/zzz"))
+      self.assertIsNone(store.resolve("refs/heads/../../config"))
+
+      repo.checkout("--detach", "branch05")
+      self.assertEqual(store.resolve("HEAD"), repo.revParse("branch05"))
+
+
+  def testRefStoreDiscovery(self):
+    """Verify that the ref store discovers repositories, worktrees, and gitfiles."""
+    with GitRepository() as repo,\
+         TemporaryDirectory() as dir_:
+      repo.commit("--allow-empty")
+      mkdir(repo.path("sub"))
+      self.assertEqual(GitRefStore.discover(repo.path("sub")).root, repo.path())
+      self.assertIsNone(GitRefStore.discover(repo.path(".git")))
+      self.assertIsNone(GitRefStore.discover(dir_))
+
+      worktree = join(realpath(dir_), "worktree")
+      repo.branch("other")
+      repo.commit("--allow-empty")
+      repo.worktree("add", worktree, "other")
+
+      store = GitRefStore.discover(worktree)
+      self.assertEqual(store.root, worktree)
+      self.assertEqual(store.resolve("HEAD"), repo.revParse("other"))
+      self.assertEqual(store.resolve("refs/heads/master"), repo.revParse("master"))
+
+      gitfile = join(realpath(dir_), "gitfile")
+      mkdir(gitfile)
+      with open(join(gitfile, ".git"), "w") as file_:
+        file_.write("gitdir: %s\n" % repo.path(".git"))
+
+      store = GitRefStore.discover(gitfile)
+      self.assertEqual(store.root, gitfile)
+      self.assertEqual(store.resolve("HEAD"), repo.revParse("master"))
+
+      with patch.dict("os.environ", {"GIT_DIR": repo.path(".git")}):
+        self.assertIsNone(GitRefStore.discover(repo.path()))
+
+
+  def testObjectStoreRead(self):
+    """Verify that the object store reads loose and packed objects like git does."""
+    def checkObjects(repo, store):
+      """Check that all objects in the repository are read correctly."""
+      out, _ = repo.catFile("--batch-all-objects", "--batch-check", stdout=b"")
+      objects = [x.split(" ")[:2] for x in out.decode().splitlines()]
+      self.assertGreater(len(objects), 100)
+
+      for sha1, type_ in objects:
+        data, _ = repo.catFile(type_, sha1, stdout=b"")
+        self.assertEqual(store.read(sha1), (type_, data), sha1)
+
+    with GitRepository() as repo:
+      store = GitObjectStore(repo.path(".git", "objects"))
+      self.assertIsNone(store.read("0" * 40))
+
+      # Create a history of similar trees and messages so that packing
+      # results in deltas.
+      mkdir(repo.path("dir"))
+      for i in range(40):
+        write(repo, "file%d" % (i % 7), data="%d\n" % i * 200)
+        write(repo, "dir", "file%d" % (i % 3), data="line\n" * i, truncate=False)
+        repo.add("--all")
+        repo.commit("--message=Commit number %d\n\n%s" % (i, "body\n" * i))
+
+      checkObjects(repo, store)
+
+      # Offset deltas are what git uses by default.
+      repo.repack("-a", "-d", "-f", "--depth=10")
+      out, _ = repo.countObjects("-v", stdout=b"")
+      self.assertIn("count: 0\n", out.decode())
+      checkObjects(repo, store)
+
+      repo.config("repack", "useDeltaBaseOffset", "false")
+      repo.repack("-a", "-d", "-f", "--depth=10")
+      checkObjects(repo, store)
+
+
+  def testObjectStoreCommitProperties(self):
+    """Verify that commit properties read through the object store match those reported by git."""
+    with GitRepository() as repo:
+      messages = [
+        "Simple subject",
+        "Subject\nspanning lines\n\nAnd a body\n",
+        "\n\n  Leading blank lines \t\nand whitespace  \n\n\nbody\n\n",
+      ]
+      env = {"GIT_AUTHOR_DATE": "2020-01-02T03:04:05-05:30"}
+      for i, message in enumerate(messages):
+        write(repo, "file with space", data="%d" % i)
+        repo.add("--all")
+        repo.git("commit", "--cleanup=verbatim", "--message=%s" % message, env=env)
+
+      mkdir(repo.path("dir"))
+      write(repo, "dir", "file", data="data")
+      write(repo, "tab\tfile", data="data")
+      repo.add("--all")
+      repo.commit()
+      repo.gc()
+
+      with changeDir(repo.path()):
+        importer = GitImporter()
+
+      out, _ = repo.revList("--all", stdout=b"")
+      for sha1 in out.decode().splitlines():
+        with patch.object(importer, "_objects", None):
+          expected = (
+            importer._retrieveSubject(sha1),
+            importer._retrieveMessage(sha1),
+            importer._retrieveCommitDate(sha1),
+            importer._readCommitFiles(sha1, "prefix"),
+          )
+
+        actual = (
+          importer._retrieveSubject(sha1),
+          importer._retrieveMessage(sha1),
+          importer._retrieveCommitDate(sha1),
+          importer._readCommitFiles(sha1, "prefix"),
+        )
+        self.assertEqual(actual, expected)
+
+
+
+  def testHistoryWalk(self):
+    """Verify that the commit-graph based history walker agrees with git."""
+    with GitRepository() as repo:
+      date = 1500000000
+
+      def commit(*args):
+        """Create a commit with a distinct commit date."""
+        nonlocal date
+        date += 60
+        repo.commit("--allow-empty", *args, env={"GIT_COMMITTER_DATE": "%d +0000" % date})
+        return repo.revParse("HEAD")
+
+      commits = [commit() for _ in range(3)]
+      repo.checkout("-b", "side1")
+      commits += [commit() for _ in range(3)]
+      repo.checkout("-b", "side2", commits[1])
+      commits += [commit() for _ in range(2)]
+      repo.checkout("master")
+      commits += [commit()]
+      # Merge both branches in an octopus merge.
+      repo.merge("--no-ff", "--no-commit", "side1", "side2")
+      commits += [commit()]
+
+      repo.commitGraph("write", "--reachable")
+      self.assertTrue(exists(repo.path(".git", "objects", "info", "commit-graph")))
+      # Commits created after the commit-graph was written are read from
+      # the object store.
+      repo.merge("--no-ff", "--no-commit", "side2")
+      commits += [commit() for _ in range(2)]
+
+      objects = repo.path(".git", "objects")
+      history = GitHistory.open(objects, GitObjectStore(objects))
+
+      out, _ = repo.revList("HEAD", stdout=b"")
+      self.assertEqual(history.walk([commits[-1]]), out.decode().splitlines())
+
+      for excluded in [commits[0], commits[4], commits[7], commits[9], commits[-1]]:
+        out, _ = repo.revList("HEAD", "^%s" % excluded, stdout=b"")
+        self.assertEqual(history.walk([commits[-1]], [excluded]), out.decode().splitlines())
+
+      for ancestor in commits:
+        for tip in commits:
+          try:
+            repo.mergeBase("--is-ancestor", ancestor, tip)
+            expected = True
+          except ProcessError:
+            expected = False
+
+          self.assertEqual(history.isAncestor(ancestor, [tip]), expected)
+
+
+  def testCommitOwnershipVerificationWithCommitGraph(self):
+    """Verify that commit ownership is checked using the commit-graph."""
+    with GitRepository() as lib,\
+         GitRepository() as app:
+      write(lib, "lib.txt", data="lib")
+      lib.add("lib.txt")
+      lib.commit()
+      lib_commit = lib.revParse("HEAD")
+      lib.commit("--allow-empty")
+
+      app.commit("--allow-empty")
+      app_commit = app.revParse("HEAD")
+      app.remote("add", "--fetch", "lib", lib.path())
+      app.packRefs("--all")
+      app.commitGraph("write", "--reachable")
+
+      with changeDir(app.path()):
+        importer = GitImporter()
+
+      self.assertIsNotNone(importer._history)
+      with patch.object(importer._git, "execute", side_effect=AssertionError):
+        self.assertTrue(importer.belongsToRepository("lib", lib_commit))
+        self.assertFalse(importer.belongsToRepository("lib", app_commit))
+        self.assertFalse(importer.belongsToRepository("unknown", lib_commit))
+
+
+  def testImportScanCache(self):
+    """Verify that scanning for imports only looks at commits new since the last scan."""
+    with GitRepository() as r1,\
+         GitRepository() as r2:
+      write(r1, "1.rst", data="// number one")
+      r1.add("1.rst")
+      r1.commit()
+      sha1 = r1.revParse("HEAD")
+
+      r2.commit("--allow-empty")
+      r2.remote("add", "--fetch", "r1", r1.path())
+      r2.subrepo("import", "r1", "prefix1", "master")
+
+      def scan():
+        """Scan the history of HEAD for imports."""
+        with changeDir(r2.path()):
+          importer = GitImporter()
+          return importer._searchImportedSubrepos(r2.revParse("HEAD"), flat=True)
+
+      self.assertEqual(scan(), {("r1", "prefix1/"): sha1})
+
+      # Scans of commits other than HEAD do not touch the cache.
+      cache = (".git", "subrepo-import-cache")
+      data = read(r2, *cache)
+      with changeDir(r2.path()):
+        self.assertEqual(GitImporter()._searchImportedSubrepos(sha1, flat=True), {})
+      self.assertEqual(read(r2, *cache), data)
+
+      # Tamper with the cache. Commits it covers are not scanned again.
+      self.assertIn("Import subrepo prefix1/:r1", data)
+      write(r2, *cache, data=data.replace("prefix1/:r1", "prefix2/:r1"))
+
+      r2.commit("--allow-empty")
+      r2.subrepo("import", "r1", "prefix3", "master")
+      r2.commitGraph("write", "--reachable")
+      r2.commit("--allow-empty")
+      self.assertEqual(scan(), {("r1", "prefix2/"): sha1, ("r1", "prefix3/"): sha1})
+
+      # Rewriting history invalidates the cache.
+      r2.reset("--hard", "HEAD~2")
+      self.assertEqual(scan(), {("r1", "prefix1/"): sha1})
+
+
+  def testPathLimitedImportScan(self):
+    """Verify that a scan limited to a prefix only reads commits that changed files below it."""
+    with GitRepository() as r1,\
+         GitRepository() as r2,\
+         GitRepository() as r3:
+      write(r1, "1.rst", data="// number one")
+      r1.add("1.rst")
+      r1.commit()
+      sha1 = r1.revParse("HEAD")
+
+      r2.commit("--allow-empty")
+      r2.remote("add", "--fetch", "r1", r1.path())
+      r2.subrepo("import", "r1", "lib", "master")
+      sha2 = r2.revParse("HEAD")
+
+      r3.commit("--allow-empty")
+      r3.remote("add", "--fetch", "r1", r1.path())
+      r3.remote("add", "--fetch", "r2", r2.path())
+      r3.subrepo("import", "r1", "prefix1", "master")
+      r3.commitGraph("write", "--reachable", "--changed-paths")
+
+      def importer():
+        """Create an importer for the third repository."""
+        with changeDir(r3.path()):
+          return GitImporter()
+
+      prefixes = frozenset(["prefix2/lib/"])
+      head = r3.revParse("HEAD")
+      self.assertEqual(importer()._searchImportedSubrepos(head, flat=True, prefixes=prefixes), {})
+
+      for i in range(5):
+        write(r3, "other%d.rst" % i, data="%d" % i)
+        r3.add("other%d.rst" % i)
+        r3.commit()
+
+      # The nested import of r1 is found as part of the import of r2.
+      r3.subrepo("import", "r2", "prefix2", "master")
+      import_commit = r3.revParse("HEAD")
+      r3.commit("--allow-empty")
+      r3.commitGraph("write", "--reachable", "--changed-paths")
+
+      importer_ = importer()
+      head = r3.revParse("HEAD")
+      with patch.object(importer_._git, "execute", side_effect=AssertionError),\
+           patch.object(importer_, "_readCommit", wraps=importer_._readCommit) as read:
+        imports = importer_._searchImportedSubrepos(head, flat=True, prefixes=prefixes)
+
+      self.assertEqual(imports, {("r2", "prefix2/"): sha2, ("r1", "prefix2/lib/"): sha1})
+      # Besides HEAD, which is read when looking for a manifest, all other
+      # new commits are ruled out by the Bloom filters.
+      self.assertEqual(read.call_args_list, [call(head), call(import_commit)])
+
+      self.assertEqual(importer()._searchImportedSubrepos(head, flat=True), {
+        ("r1", "prefix1/"): sha1,
+        ("r2", "prefix2/"): sha2,
+        ("r1", "prefix2/lib/"): sha1,
+      })
+
+
+  def testCheckpoint(self):
+    """Verify that scanning for imports stops at the most recent checkpoint."""
+    with GitRepository() as r1,\
+         GitRepository() as r2,\
+         GitRepository() as r3:
+      write(r1, "1.rst", data="// number one")
+      r1.add("1.rst")
+      r1.commit()
+      sha1 = r1.revParse("HEAD")
+
+      r2.commit("--allow-empty")
+      r2.remote("add", "--fetch", "r1", r1.path())
+      r2.subrepo("import", "r1", "lib", "master")
+      sha2 = r2.revParse("HEAD")
+
+      r3.commit("--allow-empty")
+      r3.remote("add", "--fetch", "r1", r1.path())
+      r3.remote("add", "--fetch", "r2", r2.path())
+      r3.subrepo("import", "r1", "prefix1", "master")
+      import_commit = r3.revParse("HEAD")
+      r3.subrepo("import", "r2", "prefix2", "master")
+      r3.subrepo("checkpoint")
+      checkpoint = r3.revParse("HEAD")
+
+      out, _ = r3.log("-1", "--format=%B", stdout=b"")
+      expected = "Checkpoint subrepo imports\n\n"\
+                 "prefix1/:r1 {sha1}\n"\
+                 "prefix2/:r2 {sha2}\n"\
+                 " prefix2/lib/:r1 {sha1}\n"
+      self.assertEqual(out.decode().strip("\n"), expected.format(sha1=sha1, sha2=sha2).strip("\n"))
+
+      # Deleting a subrepo requires the dependency information recorded
+      # by the checkpoint.
+      r3.subrepo("delete", "r1", "prefix1")
+      write(r3, "2.rst", data="// number two")
+      r3.add("2.rst")
+      r3.commit()
+
+      def scan(flat=False):
+        """Scan the history of HEAD from scratch, report the commits whose message got read."""
+        write(r3, ".git", "subrepo-import-cache", data="")
+        with changeDir(r3.path()):
+          importer = GitImporter()
+
+        with patch.object(importer, "_retrieveMessage", wraps=importer._retrieveMessage) as message:
+          imports = importer._searchImportedSubrepos(r3.revParse("HEAD"), flat=flat)
+
+        return imports, {x for (x,), _ in message.call_args_list}
+
+      imports, commits = scan()
+      self.assertEqual(imports, {("r2", "prefix2/"): (sha2, [(("r1", "prefix2/lib/"), sha1)])})
+      self.assertIn(checkpoint, commits)
+      self.assertNotIn(import_commit, commits)
+
+      imports, _ = scan(flat=True)
+      self.assertEqual(imports, {("r2", "prefix2/"): sha2, ("r1", "prefix2/lib/"): sha1})
+
+
+  def testImportWithoutWorktree(self):
+    """Verify that an import can be performed without a working tree."""
+    with GitRepository() as r1,\
+         GitRepository() as r2,\
+         TemporaryDirectory() as dir_:
+      write(r1, "1.rst", data="// number one")
+      r1.add("1.rst")
+      r1.commit()
+      sha1 = r1.revParse("HEAD")
+
+      r2.commit("--allow-empty")
+      r2.remote("add", "--fetch", "r1", r1.path())
+      # Staged changes are of no concern, as neither the index nor the
+      # working tree get touched.
+      write(r2, "2.rst", data="// number two")
+      r2.add("2.rst")
+      r2.subrepo("import", "--no-worktree", "r1", "lib", "master")
+
+      self.assertEqual(r2.message("HEAD"), "Import subrepo lib/:r1 at %s\n" % sha1)
+      self.assertFalse(exists(join(r2.path(), "lib")))
+      out, _ = r2.show("HEAD:lib/1.rst", stdout=b"")
+      self.assertEqual(out, b"// number one")
+      out, _ = r2.reflog("--format=%gs", "-1", stdout=b"")
+      self.assertEqual(out.decode(), "commit: Import subrepo lib/:r1 at %s\n" % sha1)
+      out, _ = r2.diff("--cached", "--name-only", "HEAD", stdout=b"")
+      self.assertEqual(out.decode().splitlines(), ["2.rst", "lib/1.rst"])
+
+      bare = join(dir_, "bare.git")
+      r2.clone("--bare", r2.path(), bare)
+      r1.mv("1.rst", "3.rst")
+      r1.commit()
+      sha3 = r1.revParse("HEAD")
+
+      def git(*args):
+        """Run git in the bare repository."""
+        out, _ = execute(GIT, "-C", bare, *args, stdout=b"")
+        return out.decode()
+
+      git("config", "user.name", "subrepo")
+      git("config", "user.email", "subrepo@example.com")
+      git("remote", "add", "--fetch", "r1", r1.path())
+      with changeDir(bare):
+        _subrepo("import", "--no-worktree", "r1", "lib", "master")
+
+      self.assertEqual(git("log", "-1", "--format=%s"), "Import subrepo lib/:r1 at %s\n" % sha3)
+      self.assertEqual(git("ls-tree", "-r", "--name-only", "HEAD").splitlines(), ["lib/3.rst"])
+
+
+  def testAmendCommitWithPlumbing(self):
+    """Verify that amending a commit keeps its parents and author and records a reflog entry."""
+    with GitRepository() as repo:
+      repo.commit("--allow-empty")
+      parent = repo.revParse("HEAD")
+      write(repo, "1.rst", data="// number one")
+      repo.add("1.rst")
+      env = {"GIT_AUTHOR_NAME": "Some One", "GIT_AUTHOR_DATE": "1577836800 +0100"}
+      repo.commit("--message=first", env=env)
+
+      write(repo, "2.rst", data="// number two")
+      repo.add("2.rst")
+      with changeDir(repo.path()):
+        GitImporter().amendCommit("second")
+
+      out, _ = repo.show("--no-patch", "--format=%P%n%an%n%ad%n%B", "--date=raw", "HEAD",
+                         stdout=b"")
+      self.assertEqual(out.decode(), "%s\nSome One\n1577836800 +0100\nsecond\n\n" % parent)
+      out, _ = repo.lsTree("--name-only", "HEAD", stdout=b"")
+      self.assertEqual(out.decode().splitlines(), ["1.rst", "2.rst"])
+      out, _ = repo.reflog("--format=%gs", "-1", stdout=b"")
+      self.assertEqual(out.decode(), "commit (amend): second\n")
+      out, _ = repo.status("--porcelain", stdout=b"")
+      self.assertEqual(out, b"")
+
+
+  def testCommitSigning(self):
+    """Verify that commits are signed if commit.gpgSign is set, with and without an editor."""
+    with GitRepository() as lib,\
+         GitRepository() as app,\
+         TemporaryDirectory() as dir_:
+      # A stand-in for gpg producing a bogus signature.
+      gpg = join(dir_, "gpg")
+      with open(gpg, "w") as file_:
+        file_.write("#!/bin/sh\n"
+                    "cat > /dev/null\n"
+                    "echo '[GNUPG:] SIG_CREATED D 1 8 00 0 0' >&2\n"
+                    "printf -- '-----BEGIN PGP SIGNATURE-----\\n\\nbogus\\n"
+                    "-----END PGP SIGNATURE-----\\n'\n")
+      chmod(gpg, 0o755)
+
+      write(lib, "1.rst", data="// number one")
+      lib.add("1.rst")
+      lib.commit()
+
+      app.commit("--allow-empty")
+      app.remote("add", "--fetch", "lib", lib.path())
+      app.config("commit", "gpgSign", "true")
+      app.config("gpg", "program", gpg)
+      app.config("core", "editor", TRUE)
+
+      app.subrepo("import", "lib", "lib", "master")
+      out, _ = app.catFile("commit", "HEAD", stdout=b"")
+      self.assertIn(b"\ngpgsig -----BEGIN PGP SIGNATURE-----", out)
+
+      # A checkpoint does not change any files but still is committed
+      # when the message is edited.
+      app.subrepo("checkpoint", "--edit")
+      out, _ = app.catFile("commit", "HEAD", stdout=b"")
+      self.assertIn(b"\ngpgsig -----BEGIN PGP SIGNATURE-----", out)
+      self.assertIn(b"\n\nCheckpoint subrepo imports\n", out)
+
+
+  def testPreflight(self):
+    """Verify that a preflight snapshot captures the state required by later checks."""
+    with GitRepository() as r1,\
+         GitRepository() as r2:
+      write(r1, "1.rst", data="// number one")
+      r1.add("1.rst")
+      r1.commit()
+      r1.tag("--annotate", "--message=tag", "v1")
+      sha1 = r1.revParse("HEAD")
+
+      with changeDir(r2.path()):
+        snapshot = GitImporter().preflight()
+        self.assertEqual(snapshot, (None, "master", True, {}))
+
+      r2.commit("--allow-empty")
+      r2.remote("add", "--fetch", "--tags", "r1", r1.path())
+      write(r2, "2.rst", data="// number two")
+      r2.add("2.rst")
+
+      with changeDir(r2.path()):
+        importer = GitImporter()
+        remote_commits = [("r1", "master"), ("r1", sha1), ("r1", "v1"), ("r1", "unknown")]
+        snapshot = importer.preflight(remote_commits)
+        self.assertEqual(snapshot.head, r2.revParse("HEAD"))
+        self.assertEqual(snapshot.branch, "master")
+        self.assertFalse(snapshot.clean)
+        self.assertEqual(snapshot.commits, {
+          ("r1", "master"): sha1,
+          ("r1", sha1): sha1,
+          ("r1", "v1"): sha1,
+          ("r1", "unknown"): None,
+        })
+
+        # Later checks are answered from the snapshot.
+        with patch.object(importer._git, "execute", side_effect=AssertionError):
+          self.assertTrue(importer._hasHead())
+          self.assertEqual(importer.resolveCommit("HEAD"), snapshot.head)
+          self.assertEqual(importer.resolveRemoteCommit("r1", "v1"), sha1)
+
+
+  def testImportFromManifest(self):
+    """Verify that the subrepos listed in a manifest are imported in a single commit."""
+    with GitRepository() as r1,\
+         GitRepository() as r2,\
+         GitRepository() as r3,\
+         GitRepository() as r4:
+      write(r3, "3.rst", data="// number three")
+      r3.add("3.rst")
+      r3.commit()
+      sha3 = r3.revParse("HEAD")
+
+      write(r1, "1.rst", data="// number one")
+      r1.add("1.rst")
+      r1.commit()
+      r1.remote("add", "--fetch", "r3", r3.path())
+      r1.subrepo("import", "r3", "dep", "master")
+      sha1 = r1.revParse("HEAD")
+
+      write(r2, "2.rst", data="// number two")
+      r2.add("2.rst")
+      r2.commit()
+      sha2 = r2.revParse("HEAD")
+
+      r4.commit("--allow-empty")
+      r4.remote("add", "--fetch", "r1", r1.path())
+      r4.remote("add", "--fetch", "r2", r2.path())
+      write(r4, "imports", data="# Our dependencies.\nr2 lib2 master\n\nr1 lib1 master\n")
+      r4.subrepo("import-manifest", r4.path("imports"))
+
+      message = "Import subrepos\n\n"\
+                "Import subrepo lib1/:r1 at %s\n"\
+                " Import subrepo lib1/dep/:r3 at %s\n"\
+                "Import subrepo lib2/:r2 at %s\n" % (sha1, sha3, sha2)
+      self.assertEqual(r4.message("HEAD"), message)
+      self.assertEqual(read(r4, "lib1", "1.rst"), "// number one")
+      self.assertEqual(read(r4, "lib1", "dep", "3.rst"), "// number three")
+      self.assertEqual(read(r4, "lib2", "2.rst"), "// number two")
+
+      # The files imported as part of the combined commit are found again
+      # when updating one of the subrepos individually.
+      r2.mv("2.rst", "4.rst")
+      r2.commit()
+      r4.fetch("r2")
+      r4.subrepo("import", "r2", "lib2", "master")
+      self.assertFalse(exists(r4.path("lib2", "2.rst")))
+      self.assertTrue(exists(r4.path("lib2", "4.rst")))
+
+      # Deleting a subrepo imported by the combined commit removes its
+      # dependencies as well.
+      r4.subrepo("delete", "r1", "lib1")
+      self.assertFalse(exists(r4.path("lib1")))
+
+      # Overlapping prefixes are rejected.
+      write(r4, "imports", data="r1 lib1 master\nr2 lib1/lib2 master\n")
+      regex = r"prefixes .* overlap"
+      with self.assertRaisesRegex(ProcessError, regex):
+        r4.subrepo("import-manifest", r4.path("imports"))
+
+      # A regular import still requires all of its arguments.
+      with self.assertRaisesRegex(ProcessError, r"arguments are required: prefix, commit"):
+        r4.subrepo("import", "r1")
+
+
+  def testImportWithRenames(self):
+    """Verify that an import with rename detection produces the same state as a regular one."""
+    with GitRepository() as lib,\
+         GitRepository() as app:
+      mkdir(lib.path("src"))
+      write(lib, "src", "a.c", data="int a;\n" * 100)
+      write(lib, "src", "b.c", data="int b;\n" * 100)
+      lib.add("src")
+      lib.commit()
+
+      app.commit("--allow-empty")
+      app.remote("add", "--fetch", "lib", lib.path())
+      app.subrepo("import", "--renames", "lib", "lib", "master")
+      self.assertEqual(read(app, "lib", "src", "a.c"), "int a;\n" * 100)
+
+      lib.mv("src", "source")
+      write(lib, "source", "b.c", data="int b;\n" * 99 + "long b;\n")
+      lib.add("source")
+      lib.commit()
+      app.fetch("lib")
+      app.subrepo("import", "--renames", "lib", "lib", "master")
+
+      self.assertFalse(exists(app.path("lib", "src")))
+      self.assertEqual(read(app, "lib", "source", "a.c"), "int a;\n" * 100)
+      self.assertEqual(read(app, "lib", "source", "b.c"), "int b;\n" * 99 + "long b;\n")
+      self.assertEqual(app.message("HEAD"), "Import subrepo lib/:lib at %s\n" % lib.revParse("HEAD"))
+
+      # If the imported files were modified locally, a regular import
+      # replaces them.
+      write(app, "lib", "source", "a.c", data="local")
+      app.add(app.path("lib", "source", "a.c"))
+      app.commit()
+
+      lib.mv("source", "src")
+      lib.commit()
+      app.fetch("lib")
+      app.subrepo("import", "--renames", "lib", "lib", "master")
+
+      self.assertFalse(exists(app.path("lib", "source")))
+      self.assertEqual(read(app, "lib", "src", "a.c"), "int a;\n" * 100)
+      self.assertEqual(read(app, "lib", "src", "b.c"), "int b;\n" * 99 + "long b;\n")
+
+
+  def assertForkBudget(self, repo, budget, *args, status=0, cold=True):
+    """Run a git-subrepo command and verify that it launched at most the given number of processes."""
+    # The number of processes depends on the results of earlier history
+    # scans that are cached, so by default we start out without any.
+    path = repo.path(".git", "subrepo-import-cache")
+    if cold and exists(path):
+      unlink(path)
+
+    with countForks() as forks:
+      result, _ = _subrepoInProcess(repo, *args)
+
+    self.assertEqual(result, status)
+    self.assertLessEqual(len(forks), budget, forks)
+
+
+  def testForkBudgetTree(self):
+    """Verify that the processes launched by 'tree' do not depend on the number of imports."""
+    for count in (1, 8):
+      with GitRepository() as lib,\
+           GitRepository() as app:
+        app.commit("--allow-empty")
+        app.remote("add", "lib", lib.path())
+        for i in range(count):
+          write(lib, "%d.rst" % i, data="// number %d" % i)
+          lib.add("%d.rst" % i)
+          lib.commit()
+          app.fetch("lib")
+          app.subrepo("import", "lib", "lib%d" % i, "master")
+
+        # Scanning the history takes a single git invocation finding the
+        # imports as well as any checkpoint. Afterwards, the result is
+        # cached.
+        self.assertForkBudget(app, 1, "tree")
+        self.assertForkBudget(app, 0, "tree", cold=False)
+
+        # With a checkpoint, the imports listed after it have to be told
+        # apart from those that are part of the checkpoint's history,
+        # which takes one more invocation without a commit-graph.
+        app.subrepo("checkpoint")
+        app.subrepo("import", "lib", "lib", "master")
+        self.assertForkBudget(app, 2, "tree")
+        self.assertForkBudget(app, 1, "tree", cold=False)
+
+
+  def testForkBudgetImport(self):
+    """Verify that importing subrepos launches a bounded number of processes per subrepo."""
+    for count in (1, 4):
+      with GitRepository() as app:
+        app.commit("--allow-empty")
+        libs = []
+        for i in range(count):
+          lib = GitRepository()
+          libs.append(lib.__enter__())
+          write(lib, "%d.rst" % i, data="// number %d" % i)
+          lib.add("%d.rst" % i)
+          lib.commit()
+          app.remote("add", "--fetch", "lib%d" % i, lib.path())
+
+        try:
+          lines = ["lib%d lib%d master\n" % (i, i) for i in range(count)]
+          write(app, "imports", data="".join(lines))
+          self.assertForkBudget(app, 9 + 10 * count, "import-manifest", app.path("imports"))
+
+          write(libs[0], "0.rst", data="// updated")
+          libs[0].add("0.rst")
+          libs[0].commit()
+          app.fetch("lib0")
+          self.assertForkBudget(app, 21, "import", "lib0", "lib0", "master")
+          self.assertForkBudget(app, 5, "import", "lib0", "lib0", "master", status=1)
+          self.assertForkBudget(app, 2, "reimport")
+          self.assertForkBudget(app, 7, "checkpoint")
+          self.assertForkBudget(app, 12, "delete", "lib0", "lib0")
+          self.assertForkBudget(app, 0, "maintenance", "--report")
+        finally:
+          for lib in libs:
+            lib.__exit__(None, None, None)
+
+
+  def testFleet(self):
+    """Verify that the 'fleet' command imports a subrepo into many repositories."""
+    with GitRepository() as r1,\
+         GitRepository() as r2,\
+         GitRepository() as r3,\
+         TemporaryDirectory() as dir_:
+      write(r1, "1.rst", data="// number one")
+      r1.add("1.rst")
+      r1.commit()
+      sha1 = r1.revParse("HEAD")
+
+      for repo in (r2, r3):
+        repo.commit("--allow-empty")
+        repo.remote("add", "r1", r1.path())
+
+      # Each repository is worked on only once, no matter how often it is
+      # listed.
+      repositories = join(dir_, "repositories")
+      data = "# superprojects\n%s\n%s\n\n%s/\n" % (r2.path(), r3.path(), r2.path())
+      with open(repositories, "w") as file_:
+        file_.write(data)
+
+      out, _ = _subrepo("fleet", "--jobs=2", "--fetch", repositories, "r1", "lib", "master",
+                        stdout=b"")
+      self.assertEqual(out.decode().splitlines(), [
+        "%s: imported %s" % (r2.path(), r2.revParse("HEAD")),
+        "%s: imported %s" % (r3.path(), r3.revParse("HEAD")),
+        "2 repositories: 2 imported",
+      ])
+      for repo in (r2, r3):
+        self.assertEqual(repo.message("HEAD"), "Import subrepo lib/:r1 at %s\n" % sha1)
+
+      out, _ = _subrepo("fleet", repositories, "r1", "lib/", sha1, stdout=b"")
+      self.assertEqual(out.decode().splitlines()[-1], "2 repositories: 2 unchanged")
+
+      out, _ = _subrepo("fleet", "--status", repositories, "r1", "lib", "master", stdout=b"")
+      self.assertEqual(out.decode().splitlines(), [
+        "%s: up to date %s" % (r2.path(), sha1),
+        "%s: up to date %s" % (r3.path(), sha1),
+        "2 repositories: 2 up to date",
+      ])
+
+      r1.git("mv", "1.rst", "2.rst")
+      r1.commit()
+      sha2 = r1.revParse("HEAD")
+
+      out, _ = _subrepo("fleet", "--fetch", "--renames", "--no-worktree", repositories, "r1",
+                        "lib", "master", stdout=b"")
+      self.assertEqual(out.decode().splitlines()[-1], "2 repositories: 2 imported")
+      for repo in (r2, r3):
+        self.assertEqual(repo.message("HEAD"), "Import subrepo lib/:r1 at %s\n" % sha2)
+        data, _ = repo.catFile("blob", "HEAD:lib/2.rst", stdout=b"")
+        self.assertEqual(data, b"// number one")
+
+
+  def testServer(self):
+    """Verify that a server performs operations on behalf of clients."""
+    with GitRepository() as r1,\
+         GitRepository() as r2,\
+         TemporaryDirectory() as dir_:
+      write(r1, "1.rst", data="// number one")
+      r1.add("1.rst")
+      r1.commit()
+      sha1 = r1.revParse("HEAD")
+
+      r2.commit("--allow-empty")
+      r2.remote("add", "--fetch", "r1", r1.path())
+
+      env = {}
+      PathMixin.inheritEnv(env)
+      PythonMixin.inheritEnv(env)
+      path = join(dir_, "socket")
+      server = Popen([executable, GIT_SUBREPO, "serve", "--timeout=60", path], env=env)
+      try:
+        for _ in range(200):
+          if exists(path):
+            break
+          sleep(0.05)
+
+        def request(**request):
+          """Send a request to the server and retrieve the response."""
+          with socket(AF_UNIX, SOCK_STREAM) as connection:
+            connection.connect(path)
+            connection.sendall(dumps(request).encode() + b"\n")
+            with connection.makefile("rb") as file_:
+              return loads(file_.readline().decode())
+
+        # The command line client forwards the operation to the server.
+        with changeDir(r2.path()):
+          execute(executable, GIT_SUBREPO, "import", "r1", "lib", "master",
+                  env=dict(env, GIT_SUBREPO_SOCKET=path))
+
+        self.assertEqual(r2.message("HEAD"), "Import subrepo lib/:r1 at %s\n" % sha1)
+
+        response = request(command="tree", cwd=r2.path(), args=[], env={})
+        self.assertEqual(response["status"], 0)
+        self.assertEqual(response["stdout"], "└── lib/:r1 at %s\n" % sha1)
+        self.assertEqual(response["result"], {
+          "head": r2.revParse("HEAD"),
+          "imports": [{"repo": "r1", "prefix": "lib/", "commit": sha1, "dependencies": []}],
+        })
+        self.assertEqual(set(response["timings"].keys()), {"parse", "command", "total"})
+
+        response = request(command="delete", cwd=r2.path(), args=["r1", "foo"])
+        self.assertEqual(response["status"], 1)
+        self.assertEqual(response["stderr"], "Subrepo foo/:r1 not found.\n")
+
+        response = request(command="status")
+        self.assertEqual(response["status"], 0)
+        self.assertEqual(response["result"]["requests"], 4)
+        self.assertEqual(response["result"]["repositories"], [r2.path()])
+      finally:
+        server.terminate()
+        server.wait()
+
+
+  def testMaintenance(self):
+    """Verify that the 'maintenance' command writes the commit-graph and refreshes the caches."""
+    with GitRepository() as r1,\
+         GitRepository() as r2:
+      write(r1, "1.rst", data="// number one")
+      r1.add("1.rst")
+      r1.commit()
+
+      r2.commit("--allow-empty")
+      r2.remote("add", "--fetch", "r1", r1.path())
+      r2.subrepo("import", "r1", "prefix1", "master")
+
+      out, _ = r2.subrepo("maintenance", stdout=b"")
+      lines = out.decode().splitlines()
+      self.assertEqual(len(lines), 3)
+      self.assertRegex(lines[0], r"^commit-graph: 3 commits with changed-path Bloom filters, .*, up to date$")
+      self.assertRegex(lines[1], r"^import cache: \d+ scans, .*, up to date$")
+      self.assertRegex(lines[2], r"^completion cache: 1 subrepos, .*, up to date$")
+
+      r2.commit("--allow-empty")
+      out, _ = r2.subrepo("maintenance", "--report", stdout=b"")
+      lines = out.decode().splitlines()
+      self.assertTrue(all(x.endswith(", stale") for x in lines), lines)
+
+      out, _ = r2.subrepo("maintenance", stdout=b"")
+      lines = out.decode().splitlines()
+      self.assertRegex(lines[0], r"^commit-graph: 4 commits")
+      self.assertTrue(all(x.endswith(", up to date") for x in lines), lines)
+
+    with GitRepository() as repo:
+      out, _ = repo.subrepo("maintenance", "--report", stdout=b"")
+      self.assertEqual(out.decode().splitlines(), [
+        "commit-graph: missing",
+        "import cache: missing",
+        "completion cache: missing",
+      ])
+
+
+  def testManifest(self):
+    """Verify that the manifest of imported subrepos is maintained and used."""
+    with GitRepository() as r1,\
+         GitRepository() as r2,\
+         GitRepository() as r3:
+      write(r1, "1.rst", data="// number one")
+      r1.add("1.rst")
+      r1.commit()
+      sha1 = r1.revParse("HEAD")
+
+      r2.config("subrepo", "manifest", "true")
+      r2.commit("--allow-empty")
+      r2.remote("add", "--fetch", "r1", r1.path())
+      r2.subrepo("import", "r1", "lib", "master")
+      sha2 = r2.revParse("HEAD")
+      self.assertEqual(read(r2, ".gitsubrepo").splitlines()[1:], [
+        "lib/:r1 %s" % sha1,
+      ])
+
+      # Imports that happened before the manifest got enabled are
+      # contained as well.
+      r3.commit("--allow-empty")
+      r3.remote("add", "--fetch", "r1", r1.path())
+      r3.remote("add", "--fetch", "r2", r2.path())
+      r3.subrepo("import", "r1", "prefix1", "master")
+      r3.config("subrepo", "manifest", "true")
+      # The manifest of r2 must not replace ours.
+      r3.subrepo("import", "r2", ".", "master")
+      expected = [
+        "./:r2 %s" % sha2,
+        " lib/:r1 %s" % sha1,
+        "prefix1/:r1 %s" % sha1,
+      ]
+      out, _ = r3.show("HEAD:.gitsubrepo", stdout=b"")
+      self.assertEqual(out.decode().splitlines()[1:], expected)
+
+      with changeDir(r3.path()):
+        importer = GitImporter()
+
+      head = r3.revParse("HEAD")
+      with patch.object(importer, "_scanImportMessages", side_effect=AssertionError):
+        self.assertEqual(importer._searchImportedSubrepos(head, flat=True), {
+          ("r2", "./"): sha2,
+          ("r1", "lib/"): sha1,
+          ("r1", "prefix1/"): sha1,
+        })
+
+      out, _ = r3.subrepo("maintenance", stdout=b"")
+      self.assertRegex(out.decode().splitlines()[-1], r"^manifest: 2 subrepos, .*, up to date$")
+
+      r3.subrepo("delete", "r1", "prefix1")
+      self.assertEqual(read(r3, ".gitsubrepo").splitlines()[1:], expected[:2])
+      self.assertEqual(r3.git("status", "--porcelain", stdout=b"")[0], b"")
+
+      # A manifest that disagrees with the history is reported.
+      write(r3, ".gitsubrepo", data="./:r2 %s\n" % sha1)
+      r3.add(".gitsubrepo")
+      r3.commit()
+      out, _ = r3.subrepo("maintenance", "--report", stdout=b"")
+      self.assertRegex(out.decode().splitlines()[-1], r"^manifest: 1 subrepos, .*, stale$")
+
+
 if __name__ == "__main__":
   main()